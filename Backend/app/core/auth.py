@@ -2,7 +2,7 @@ from datetime import datetime, timedelta
 from typing import Optional
 from jose import JWTError, jwt
 from passlib.context import CryptContext
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Query, status
 from fastapi.security import OAuth2PasswordBearer
 from pydantic import BaseModel
 
@@ -11,6 +11,13 @@ from ..core.database import get_collection
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+optional_oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token", auto_error=False)
+
+# Browsers can't set headers on an EventSource, so the notification stream
+# also accepts a token in its URL. Those tokens are only valid for the stream
+# and expire quickly, since URLs end up in logs and history.
+STREAM_TOKEN_SCOPE = "notification_stream"
+STREAM_TOKEN_SECONDS = 60
 
 class TokenData(BaseModel):
     username: Optional[str] = None
@@ -32,7 +39,15 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, settings.SECRET_KEY, algorithm=settings.ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(token: str = Depends(oauth2_scheme)):
+def create_stream_token(user: dict) -> str:
+    """Short-lived token that only authenticates the notification stream"""
+    return create_access_token(
+        {"sub": user["email"], "role": user.get("role"), "scope": STREAM_TOKEN_SCOPE},
+        timedelta(seconds=STREAM_TOKEN_SECONDS)
+    )
+
+async def _user_for_token(token: str, scope: Optional[str] = None):
+    """The user a token was issued to; only tokens issued for `scope` are accepted"""
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -42,7 +57,7 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
         payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
         username: str = payload.get("sub")
         role: str = payload.get("role")
-        if username is None:
+        if username is None or payload.get("scope") != scope:
             raise credentials_exception
         token_data = TokenData(username=username, role=role)
     except JWTError:
@@ -54,7 +69,28 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
         raise credentials_exception
     return user
 
+async def get_current_user(token: str = Depends(oauth2_scheme)):
+    return await _user_for_token(token)
+
 async def get_current_active_user(current_user = Depends(get_current_user)):
     if not current_user.get("is_active", False):
         raise HTTPException(status_code=400, detail="Inactive user")
-    return current_user
\ No newline at end of file
+    return current_user
+
+
+async def get_stream_user(
+    token: Optional[str] = Query(None),
+    bearer: Optional[str] = Depends(optional_oauth2_scheme)
+):
+    """The user of the notification stream, from a stream token in the URL or the Authorization header"""
+    if token:
+        user = await _user_for_token(token, STREAM_TOKEN_SCOPE)
+    elif bearer:
+        user = await _user_for_token(bearer)
+    else:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Not authenticated",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return await get_current_active_user(user)
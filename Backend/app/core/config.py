@@ -22,6 +22,44 @@ class Settings(BaseSettings):
     CLOUDINARY_API_KEY: str = os.getenv("CLOUDINARY_API_KEY", "")
     CLOUDINARY_API_SECRET: str = os.getenv("CLOUDINARY_API_SECRET", "")
     
+    # Background jobs
+    REMINDER_SHARDS: int = int(os.getenv("REMINDER_SHARDS", "1"))
+    
+    # "local" publishes pushed notifications within each process, "changestream" follows the
+    # notifications collection so every worker sees every insert (needs a replica set)
+    NOTIFICATION_PUSH_BACKEND: str = os.getenv("NOTIFICATION_PUSH_BACKEND", "local")
+    
+    # Read notifications expire this many days after being read; all notifications
+    # older than NOTIFICATION_ARCHIVE_DAYS move to the archive
+    NOTIFICATION_READ_RETENTION_DAYS: int = int(os.getenv("NOTIFICATION_READ_RETENTION_DAYS", "30"))
+    NOTIFICATION_ARCHIVE_DAYS: int = int(os.getenv("NOTIFICATION_ARCHIVE_DAYS", "90"))
+    
+    # Where ad photos and KYC documents are stored: "cloudinary", "s3", or "local" to keep
+    # them under STORAGE_LOCAL_DIR and serve them from MEDIA_BASE_URL/media (development and tests)
+    STORAGE_BACKEND: str = os.getenv("STORAGE_BACKEND", "cloudinary")
+    STORAGE_LOCAL_DIR: str = os.getenv("STORAGE_LOCAL_DIR", "uploads")
+    MEDIA_BASE_URL: str = os.getenv("MEDIA_BASE_URL", "http://localhost:8000")
+    
+    # Uploaded ad photos wait here until the media worker has stored them. By default
+    # each host spools locally and processes its own photos; set MEDIA_SPOOL_SHARED
+    # when MEDIA_SPOOL_DIR is a volume every host mounts, so any host can process them
+    MEDIA_SPOOL_DIR: str = os.getenv("MEDIA_SPOOL_DIR", os.path.join("uploads", "spool"))
+    MEDIA_SPOOL_SHARED: bool = os.getenv("MEDIA_SPOOL_SHARED", "False").lower() == "true"
+    
+    # When true, the orphaned media collector only reports what it would delete
+    MEDIA_GC_DRY_RUN: bool = os.getenv("MEDIA_GC_DRY_RUN", "False").lower() == "true"
+    
+    # S3-compatible storage; set S3_ENDPOINT_URL for anything other than AWS (e.g. MinIO)
+    S3_BUCKET: str = os.getenv("S3_BUCKET", "")
+    S3_ENDPOINT_URL: str = os.getenv("S3_ENDPOINT_URL", "")
+    S3_REGION: str = os.getenv("S3_REGION", "")
+    S3_ACCESS_KEY: str = os.getenv("S3_ACCESS_KEY", "")
+    S3_SECRET_KEY: str = os.getenv("S3_SECRET_KEY", "")
+    S3_PUBLIC_URL: str = os.getenv("S3_PUBLIC_URL", "")
+    
+    # Late fee charged per day overdue, as a fraction of the installment amount
+    LATE_FEE_DAILY_RATE: float = float(os.getenv("LATE_FEE_DAILY_RATE", "0.001"))
+    
     class Config:
         case_sensitive = True
 
@@ -1,10 +1,16 @@
 # app/core/database.py
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import OperationFailure
 from ..core.config import settings
+from ..utils.ad_search import ensure_text_index
+
+INDEX_OPTIONS_CONFLICT = 85
 
 class Database:
     client = None
     db = None
+    # Multi-document transactions need a replica set or sharded cluster
+    supports_transactions = False
 
 async def connect_to_mongo():
     Database.client = AsyncIOMotorClient(settings.MONGODB_URL)
@@ -12,22 +18,103 @@ async def connect_to_mongo():
     await Database.db.command("ping")  # Test the connection
     print("Connected to MongoDB")
     
+    hello = await Database.db.command("hello")
+    Database.supports_transactions = "setName" in hello or hello.get("msg") == "isdbgrid"
+    if not Database.supports_transactions:
+        print("MongoDB is standalone, writes that belong together are not run in transactions")
+    
     # Ensure required collections exist
     collections = await Database.db.list_collection_names()
     required_collections = [
         "users", "loans", "payments", "notifications", 
-        "borrowers", "lenders", "advertisements"
+        "borrowers", "lenders", "advertisements", "installments", "outbox", "media_jobs", "media"
     ]
     
     for collection in required_collections:
         if collection not in collections:
             await Database.db.create_collection(collection)
             print(f"Created missing collection: {collection}")
+    
+    await ensure_indexes()
+
+async def ensure_indexes():
+    """Create the indexes the dashboard and scheduled queries rely on"""
+    await Database.db["loans"].create_index("borrower_id")
+    await Database.db["loans"].create_index("lender_id")
+    # Loans updated since the overdue batch last synced their installments
+    await Database.db["loans"].create_index([("installments_normalized", 1), ("updated_at", 1)])
+    # A lender's loan book in creation order, for exports
+    await Database.db["loans"].create_index([("lender_id", 1), ("created_at", 1), ("_id", 1)])
+    await Database.db["payments"].create_index("loan_id")
+    # _id is part of the keys so reminder scans can resume from a (shard_slot, due_date, _id)
+    # checkpoint, and the overdue batch can walk installments of active loans in (due_date, _id) chunks
+    await Database.db["installments"].create_index([("status", 1), ("shard_slot", 1), ("due_date", 1), ("_id", 1)])
+    await Database.db["installments"].create_index([("status", 1), ("loan_active", 1), ("due_date", 1), ("_id", 1)])
+    await Database.db["installments"].create_index([("loan_id", 1), ("seq", 1)], unique=True)
+    # Late history per borrower for risk analysis
+    await Database.db["installments"].create_index([("borrower_id", 1), ("late_since", 1)])
+    # One reminder per installment and window; entries only matter while the window is open
+    await Database.db["reminder_ledger"].create_index(
+        [("loan_id", 1), ("seq", 1), ("due_date", 1), ("days_until_due", 1)], unique=True
+    )
+    await Database.db["reminder_ledger"].create_index("created_at", expireAfterSeconds=30 * 24 * 3600)
+    # Expired leases are also ignored on acquire, the TTL index just cleans them up
+    await Database.db["job_leases"].create_index("expires_at", expireAfterSeconds=0)
+    await Database.db["payments"].create_index([("user_id", 1), ("created_at", -1)])
+    # Rebuilding a user's notification counters
+    await Database.db["notifications"].create_index([("user_id", 1), ("read", 1)])
+    # Newest-first notification pages, continued from a (timestamp, _id) cursor
+    await Database.db["notifications"].create_index([("user_id", 1), ("timestamp", -1), ("_id", -1)])
+    await _ensure_ttl_index("notifications", "read_at", settings.NOTIFICATION_READ_RETENTION_DAYS * 24 * 3600)
+    # A user's archive buckets by month, and the bucket holding a notification
+    await Database.db["notification_archive"].create_index([("user_id", 1), ("month", 1), ("count", 1)])
+    await Database.db["notification_archive"].create_index("notifications._id")
+    await Database.db["outbox"].create_index([("status", 1), ("available_at", 1)])
+    await Database.db["outbox"].create_index("delivered_at", expireAfterSeconds=7 * 24 * 3600)
+    # Media worker polls for pending photo jobs spooled on its own host
+    await Database.db["media_jobs"].create_index([("status", 1), ("host", 1), ("available_at", 1)])
+    await Database.db["media_jobs"].create_index("finished_at", expireAfterSeconds=7 * 24 * 3600)
+    # Public listings only show published ads
+    await Database.db["advertisements"].create_index([("published", 1), ("created_at", -1)])
+    # Nearby searches, with their loan type and interest rate filters
+    await Database.db["advertisements"].create_index([("geo", "2dsphere"), ("loan_types", 1), ("interest_rate", 1)])
+    # Listings filtered by loan type and interest rate, newest first (equality, sort, range)
+    await Database.db["advertisements"].create_index([("loan_types", 1), ("created_at", -1), ("interest_rate", 1)])
+    await Database.db["advertisements"].create_index([("location.district", 1), ("location.city", 1), ("created_at", -1)])
+    await ensure_text_index(Database.db["advertisements"])
         
+async def _ensure_ttl_index(collection_name: str, field: str, expire_after_seconds: int):
+    """Create a TTL index, or change its expiry if it already exists with a different one"""
+    try:
+        await Database.db[collection_name].create_index(field, expireAfterSeconds=expire_after_seconds)
+    except OperationFailure as e:
+        if e.code != INDEX_OPTIONS_CONFLICT:
+            raise
+        await Database.db.command(
+            "collMod", collection_name,
+            index={"keyPattern": {field: 1}, "expireAfterSeconds": expire_after_seconds}
+        )
+
 async def close_mongo_connection():
     if Database.client:
         Database.client.close()
         print("MongoDB connection closed")
         
 def get_collection(collection_name: str):
-    return Database.db[collection_name]
\ No newline at end of file
+    return Database.db[collection_name]
+
+async def run_in_transaction(write):
+    """
+    Run `write(session)` in one transaction, passing it the session for each of its writes.
+
+    The whole callback is retried when the server reports a transient
+    transaction error (a write conflict, a primary stepping down) or an
+    unknown commit result, so it must only make database writes through the
+    session. On a standalone server the session is None and the writes are
+    applied one by one.
+    """
+    if not Database.supports_transactions:
+        return await write(None)
+    
+    async with await Database.client.start_session() as session:
+        return await session.with_transaction(write)
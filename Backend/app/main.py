@@ -8,8 +8,11 @@ from .core.database import connect_to_mongo, close_mongo_connection
 from .core.config import settings
 from .core.cloudinary_config import initialize_cloudinary
 from .routers import advertisement, auth, borrowers, cards, loans, notifications, payments, risk_analysis, support, users
-from .routers import lenders
+from .routers import exports, lenders, media
 from .utils.scheduled_tasks import start_background_tasks
+from .utils.notification_push import follow_notification_inserts
+from .utils.media_pipeline import run_media_worker
+from .utils.notification_dispatcher import notification_dispatcher
 
 app = FastAPI(
     title=settings.APP_NAME,
@@ -31,11 +34,15 @@ app.add_middleware(
 async def startup_db_client():
     await connect_to_mongo()
     initialize_cloudinary()
+    notification_dispatcher.start()
 
 @app.on_event("startup")
 async def start_scheduler():
     # Start the background tasks
     asyncio.create_task(start_background_tasks())
+    asyncio.create_task(follow_notification_inserts())
+    # Photos are spooled on the host that received them, so every API process runs a media worker
+    asyncio.create_task(run_media_worker())
 
 @app.on_event("startup")
 async def log_timezone_info():
@@ -47,6 +54,8 @@ async def log_timezone_info():
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    # Queued outbox events are written before the connection goes away
+    await notification_dispatcher.stop()
     await close_mongo_connection()
 
 # Include routers
@@ -56,11 +65,14 @@ app.include_router(loans.router)
 app.include_router(advertisement.router)
 app.include_router(payments.router)
 app.include_router(cards.router)
+app.include_router(notifications.stream_router)
 app.include_router(notifications.router)
 app.include_router(support.router)
 app.include_router(users.router)
 app.include_router(risk_analysis.router)
 app.include_router(lenders.router)
+app.include_router(exports.router)
+app.include_router(media.router)
 
 @app.get("/")
 async def root():
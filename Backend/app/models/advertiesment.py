@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field, GetJsonSchemaHandler
-from typing import List, Optional, Any, Annotated
+from typing import List, Optional, Any, Annotated, Dict
 from datetime import datetime
 from bson import ObjectId
 from pydantic.json_schema import JsonSchemaValue
@@ -24,6 +24,9 @@ class PyObjectId(str):
 class Location(BaseModel):
     district: str
     city: str
+    # Optional coordinates; ads with them can be found by nearby searches
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
 
 class AdvertisementBase(BaseModel):
     shop_name: str
@@ -52,6 +55,15 @@ class Advertisement(AdvertisementBase):
     created_at: datetime
     updated_at: datetime
     photos: List[str] = []
+    # {"thumbnail", "medium", "full"} URLs of each photo, plus the "hash" of its content;
+    # "full" is the URL in photos
+    photo_variants: List[Dict[str, str]] = []
+    # Thumbnail of the first photo, for listing cards
+    thumbnail: Optional[str] = None
+    # Photos being processed in the background, one entry per uploaded photo:
+    # {"slot", "status": "processing" | "ready" | "failed", "url", "variants"}
+    media: List[Dict[str, Any]] = []
+    published: bool = True
     is_owner: bool = False
 
     model_config = {
@@ -61,4 +73,13 @@ class Advertisement(AdvertisementBase):
             datetime: lambda v: v.isoformat(),
             ObjectId: lambda v: str(v)
         }
-    }
\ No newline at end of file
+    }
+class NearbyAdvertisement(Advertisement):
+    distance_km: float
+
+class NearbyAdvertisements(BaseModel):
+    advertisements: List[NearbyAdvertisement]
+    next_cursor: Optional[str] = None
+
+class AdvertisementSearchResult(Advertisement):
+    score: float
@@ -24,6 +24,8 @@ class Payment(BaseModel):
     payment_date: Optional[datetime] = None
     method: Optional[str] = None
     due_date: Optional[datetime] = None
+    principal: Optional[float] = None
+    interest: Optional[float] = None
 
 class PaymentCreate(BaseModel):
     loan_id: str
@@ -44,10 +46,12 @@ class Loan(BaseModel):
     purpose: Optional[str] = None
     start_date: Optional[datetime] = None
     end_date: Optional[datetime] = None
+    schedule_type: str = "flat"  # "flat" or "reducing_balance"
     payments: List[Payment] = []
     total_amount: float  # amount + interest
     total_paid: float = 0
     remaining_amount: float = 0  # total_amount - total_paid
+    late_fees: float = 0  # accrued by the overdue batch, owed on top of remaining_amount
     installment_amount: float  # total_amount / term_months
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
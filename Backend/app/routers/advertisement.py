@@ -1,13 +1,60 @@
-from fastapi import APIRouter, Depends, HTTPException, status, File, UploadFile, Form
+from fastapi import APIRouter, Depends, HTTPException, status, File, UploadFile, Form, Query, Request, Response
 from typing import List, Optional
 from bson import ObjectId
 from datetime import datetime
 import json
 
 from ..core.auth import get_current_active_user
-from ..core.database import get_collection
-from ..models.advertiesment import Advertisement, AdvertisementCreate, AdvertisementUpdate, Location
-from ..utils.cloudinary_utils import upload_image, delete_image
+from ..core.database import get_collection, run_in_transaction
+from ..models.advertiesment import Advertisement, AdvertisementCreate, AdvertisementUpdate, AdvertisementSearchResult, Location, NearbyAdvertisements
+from ..utils.ad_search import search
+from ..utils.listing_cache import get_listing, invalidate_listings, listing_key
+from ..utils.media_pipeline import (
+    next_media_slot, photo_variants_for, release_photos, spool_photos, thumbnail_url, unadded_media_variants
+)
+
+# Radius of a nearby search in kilometres, and ads returned per page
+NEARBY_DEFAULT_RADIUS_KM = 10
+NEARBY_MAX_RADIUS_KM = 100
+NEARBY_PAGE_SIZE = 20
+
+def geo_point(location_obj: dict) -> Optional[dict]:
+    """GeoJSON point for the latitude/longitude of a location, if it has them"""
+    if not isinstance(location_obj, dict):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid location format"
+        )
+    latitude, longitude = location_obj.get("latitude"), location_obj.get("longitude")
+    if latitude is None and longitude is None:
+        return None
+    try:
+        latitude, longitude = float(latitude), float(longitude)
+    except (TypeError, ValueError):
+        latitude = longitude = None
+    if latitude is None or not -90 <= latitude <= 90 or not -180 <= longitude <= 180:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid location coordinates"
+        )
+    return {"type": "Point", "coordinates": [longitude, latitude]}
+
+# Listings may be stored by the client but must be revalidated (answered with a 304 when unchanged)
+LISTING_CACHE_CONTROL = "private, no-cache"
+
+def encode_nearby_cursor(ad: dict) -> str:
+    """Opaque page cursor: the ad's distance in metres and its id"""
+    return f"{ad['distance']!r}_{ad['_id']}"
+
+def decode_nearby_cursor(cursor: str):
+    try:
+        distance, ad_id = cursor.split("_", 1)
+        return float(distance), ObjectId(ad_id)
+    except Exception:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid pagination cursor"
+        )
 
 router = APIRouter(
     prefix="/advertisements",
@@ -44,8 +91,12 @@ async def create_advertisement(
             detail="Invalid location format"
         )
     
+    point = geo_point(location_obj)
+    
     # Prepare ad dictionary
+    ad_id = ObjectId()
     ad_dict = {
+        "_id": ad_id,
         "shop_name": shop_name,
         "lender_name": lender_name,
         "contact_number": contact_number,
@@ -56,59 +107,168 @@ async def create_advertisement(
         "lender_id": str(current_user["_id"]),
         "created_at": datetime.utcnow(),
         "updated_at": datetime.utcnow(),
-        "photos": []
+        "photos": [],
+        "photo_variants": [],
+        "media": [],
+        "published": True
     }
+    if point:
+        ad_dict["geo"] = point
     
-    # Upload photos to Cloudinary
+    # Photos are spooled to disk and processed by the media worker; the ad is
+    # published once they are all stored
+    jobs = []
     if photos:
-        photo_urls = []
-        for photo in photos:
-            try:
-                contents = await photo.read()
-                result = upload_image(contents)
-                photo_urls.append(result["url"])
-            except Exception as e:
-                # If an error occurs, continue with the next photo
-                print(f"Error uploading photo: {str(e)}")
-                continue
-        
-        ad_dict["photos"] = photo_urls
+        ad_dict["media"], jobs = await spool_photos(ad_id, photos)
+        ad_dict["published"] = False
+    
+    # Insert ad and its photo jobs together
+    async def write(session):
+        await ads_collection.insert_one(ad_dict, session=session)
+        if jobs:
+            await get_collection("media_jobs").insert_many(jobs, session=session)
     
-    # Insert ad into database
-    result = await ads_collection.insert_one(ad_dict)
+    await run_in_transaction(write)
+    await invalidate_listings()
     
     # Convert ObjectId to string for response
-    ad_dict["_id"] = str(result.inserted_id)
+    ad_dict["_id"] = str(ad_id)
     ad_dict["is_owner"] = True
     
     return ad_dict
 
 @router.get("/", response_model=List[Advertisement])
 async def get_advertisements(
+    request: Request,
+    response: Response,
     district: Optional[str] = None,
     city: Optional[str] = None,
     loan_type: Optional[str] = None,
     max_interest_rate: Optional[float] = None,
     current_user = Depends(get_current_active_user)
 ):
-    ads_collection = get_collection("advertisements")
+    key = listing_key(district, city, loan_type, max_interest_rate)
+    district, city, loan_type, max_interest_rate = key
+    
+    async def load():
+        # Ads whose photos are still processing aren't listed yet
+        query = {"published": {"$ne": False}}
+        if district:
+            query["location.district"] = district
+        if city:
+            query["location.city"] = city
+        if loan_type:
+            query["loan_types"] = {"$in": [loan_type]}
+        if max_interest_rate is not None:
+            query["interest_rate"] = {"$lte": max_interest_rate}
+        
+        cursor = get_collection("advertisements").find(query).sort("created_at", -1)
+        advertisements = await cursor.to_list(length=100)
+        
+        # Add thumbnail field and convert ObjectId to string
+        for ad in advertisements:
+            ad["thumbnail"] = thumbnail_url(ad)
+            ad["_id"] = str(ad["_id"])
+        return advertisements
+    
+    advertisements, etag = await get_listing(key, load)
+    
+    # is_owner is the only per-user part of a listing, so the ETag only varies for lenders whose ads are in it
+    user_id = str(current_user["_id"])
+    if any(ad["lender_id"] == user_id for ad in advertisements):
+        etag = f"{etag}-{user_id}"
+    etag = f'W/"{etag}"'
+    headers = {"ETag": etag, "Cache-Control": LISTING_CACHE_CONTROL}
+    
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    response.headers.update(headers)
+    
+    # Cached ads are shared between requests, so is_owner goes on copies
+    return [{**ad, "is_owner": ad["lender_id"] == user_id} for ad in advertisements]
+
+@router.get("/nearby", response_model=NearbyAdvertisements)
+async def get_nearby_advertisements(
+    latitude: float,
+    longitude: float,
+    radius_km: float = NEARBY_DEFAULT_RADIUS_KM,
+    loan_type: Optional[str] = None,
+    max_interest_rate: Optional[float] = None,
+    after: Optional[str] = None,
+    limit: int = Query(NEARBY_PAGE_SIZE, ge=1, le=100),
+    current_user = Depends(get_current_active_user)
+):
+    """
+    Ads within `radius_km` of a point, nearest first.
+    
+    Pass the `next_cursor` of a page as `after` to get the page after it.
+    Only ads whose location has coordinates are found.
+    """
+    if not 0 < radius_km <= NEARBY_MAX_RADIUS_KM:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"radius_km must be between 0 and {NEARBY_MAX_RADIUS_KM}"
+        )
+    point = geo_point({"latitude": latitude, "longitude": longitude})
     
-    query = {}
-    if district:
-        query["location.district"] = district
-    if city:
-        query["location.city"] = city
+    query = {"published": {"$ne": False}}
     if loan_type:
-        query["loan_types"] = {"$in": [loan_type]}
-    if max_interest_rate:
+        query["loan_types"] = loan_type
+    if max_interest_rate is not None:
         query["interest_rate"] = {"$lte": max_interest_rate}
     
-    cursor = ads_collection.find(query).sort("created_at", -1)
-    advertisements = await cursor.to_list(length=100)
+    geo_near = {
+        "near": point,
+        "distanceField": "distance",
+        "maxDistance": radius_km * 1000,
+        "query": query,
+        "spherical": True
+    }
+    pipeline = [{"$geoNear": geo_near}]
+    
+    # Continue after the cursor: further away, or as far and with a larger id
+    if after:
+        after_distance, after_id = decode_nearby_cursor(after)
+        geo_near["minDistance"] = after_distance
+        pipeline.append({"$match": {"$or": [
+            {"distance": {"$gt": after_distance}},
+            {"distance": after_distance, "_id": {"$gt": after_id}}
+        ]}})
+    pipeline += [{"$sort": {"distance": 1, "_id": 1}}, {"$limit": limit}]
+    
+    ads_collection = get_collection("advertisements")
+    advertisements = await ads_collection.aggregate(pipeline).to_list(length=limit)
+    
+    next_cursor = encode_nearby_cursor(advertisements[-1]) if len(advertisements) == limit else None
+    
+    for ad in advertisements:
+        ad["is_owner"] = ad["lender_id"] == str(current_user["_id"])
+        ad["thumbnail"] = thumbnail_url(ad)
+        ad["distance_km"] = round(ad["distance"] / 1000, 2)
+        ad["_id"] = str(ad["_id"])
+    
+    return {"advertisements": advertisements, "next_cursor": next_cursor}
+
+@router.get("/search", response_model=List[AdvertisementSearchResult])
+async def search_advertisements(
+    q: str = Query(..., min_length=1, max_length=200),
+    district: Optional[str] = None,
+    city: Optional[str] = None,
+    loan_type: Optional[str] = None,
+    max_interest_rate: Optional[float] = None,
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0, le=1000),
+    current_user = Depends(get_current_active_user)
+):
+    """Ads matching the search terms in their shop name, loan types or description, most relevant first"""
+    advertisements = await search(
+        get_collection("advertisements"), q, limit=limit, offset=offset,
+        district=district, city=city, loan_type=loan_type, max_interest_rate=max_interest_rate
+    )
     
-    # Add is_owner field and convert ObjectId to string
     for ad in advertisements:
         ad["is_owner"] = ad["lender_id"] == str(current_user["_id"])
+        ad["thumbnail"] = thumbnail_url(ad)
         ad["_id"] = str(ad["_id"])
     
     return advertisements
@@ -125,9 +285,10 @@ async def get_my_advertisements(current_user = Depends(get_current_active_user))
     cursor = ads_collection.find({"lender_id": str(current_user["_id"])})
     advertisements = await cursor.to_list(length=100)
     
-    # Add is_owner field and convert ObjectId to string
+    # Add is_owner and thumbnail fields and convert ObjectId to string
     for ad in advertisements:
         ad["is_owner"] = True
+        ad["thumbnail"] = thumbnail_url(ad)
         ad["_id"] = str(ad["_id"])
     
     return advertisements
@@ -150,8 +311,9 @@ async def get_advertisement(ad_id: str, current_user = Depends(get_current_activ
             detail="Advertisement not found"
         )
     
-    # Add is_owner field and convert ObjectId to string
+    # Add is_owner and thumbnail fields and convert ObjectId to string
     ad["is_owner"] = ad["lender_id"] == str(current_user["_id"])
+    ad["thumbnail"] = thumbnail_url(ad)
     ad["_id"] = str(ad["_id"])
     
     return ad
@@ -196,6 +358,7 @@ async def update_advertisement(
         update_data["contact_number"] = contact_number
     if description:
         update_data["description"] = description
+    unset_data = {}
     if location:
         try:
             location_obj = json.loads(location)
@@ -205,6 +368,11 @@ async def update_advertisement(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="Invalid location format"
             )
+        point = geo_point(location_obj)
+        if point:
+            update_data["geo"] = point
+        else:
+            unset_data["geo"] = ""
     if interest_rate is not None:
         update_data["interest_rate"] = float(interest_rate)
     if loan_types:
@@ -215,63 +383,55 @@ async def update_advertisement(
         # Parse existing photos JSON
         try:
             existing_photo_urls = json.loads(existing_photos)
-            
-            # If existing photos are provided, use them
-            if isinstance(existing_photo_urls, list):
-                # Find photos to delete (those in ad["photos"] but not in existing_photo_urls)
-                if "photos" in ad:
-                    photos_to_delete = [p for p in ad["photos"] if p not in existing_photo_urls]
-                    
-                    # Delete removed photos from Cloudinary
-                    for photo_url in photos_to_delete:
-                        try:
-                            # Extract public_id from URL
-                            parts = photo_url.split('/')
-                            filename = parts[-1].split('.')[0]
-                            folder = parts[-2]
-                            public_id = f"{folder}/{filename}"
-                            delete_image(public_id)
-                        except Exception as e:
-                            print(f"Error deleting photo: {str(e)}")
-                
-                # Set the existing photos
-                update_data["photos"] = existing_photo_urls
-        except:
+        except (json.JSONDecodeError, TypeError):
             # If parsing fails, ignore existing_photos
-            pass
-    
-    # Upload new photos if provided
-    if photos:
-        photo_urls = []
-        
-        # Start with existing photos if they were provided
-        if "photos" in update_data:
-            photo_urls = update_data["photos"]
-        elif "photos" in ad:
-            photo_urls = ad["photos"]
-        
-        # Add new photos
-        for photo in photos:
-            try:
-                contents = await photo.read()
-                result = upload_image(contents)
-                photo_urls.append(result["url"])
-            except Exception as e:
-                print(f"Error uploading photo: {str(e)}")
-                continue
+            existing_photo_urls = None
         
-        # Update photos list
-        update_data["photos"] = photo_urls
+        # Only photos the ad already has can be kept, and only those can be released
+        if isinstance(existing_photo_urls, list):
+            current_photos = ad.get("photos", [])
+            kept_photos = []
+            for url in existing_photo_urls:
+                if url in current_photos and url not in kept_photos:
+                    kept_photos.append(url)
+            photos_to_delete = [url for url in current_photos if url not in kept_photos]
+            
+            # Release removed photos; ones no other ad uses are deleted from storage
+            if photos_to_delete:
+                await release_photos(photo_variants_for(ad, photos_to_delete))
+            
+            # Set the existing photos
+            update_data["photos"] = kept_photos
+            update_data["photo_variants"] = [
+                variants for variants in ad.get("photo_variants", [])
+                if variants.get("full") in kept_photos
+            ]
     
     update_data["updated_at"] = datetime.utcnow()
     
-    await ads_collection.update_one(
-        {"_id": ObjectId(ad_id)},
-        {"$set": update_data}
-    )
+    update = {"$set": update_data}
+    if unset_data:
+        update["$unset"] = unset_data
+    
+    # New photos are spooled and processed by the media worker, as on creation;
+    # they are added after the ad's current photos once they are all stored
+    jobs = []
+    if photos:
+        media, jobs = await spool_photos(ad["_id"], photos, next_media_slot(ad))
+        update["$push"] = {"media": {"$each": media}}
+    
+    # Update the ad and queue its photo jobs together
+    async def write(session):
+        await ads_collection.update_one({"_id": ObjectId(ad_id)}, update, session=session)
+        if jobs:
+            await get_collection("media_jobs").insert_many(jobs, session=session)
+    
+    await run_in_transaction(write)
+    await invalidate_listings()
     
     updated_ad = await ads_collection.find_one({"_id": ObjectId(ad_id)})
     updated_ad["is_owner"] = True
+    updated_ad["thumbnail"] = thumbnail_url(updated_ad)
     updated_ad["_id"] = str(updated_ad["_id"])
     
     return updated_ad
@@ -293,20 +453,13 @@ async def delete_advertisement(ad_id: str, current_user = Depends(get_current_ac
             detail="You can only delete your own advertisements"
         )
     
-    # Delete associated photos from Cloudinary
-    if "photos" in ad and ad["photos"]:
-        for photo_url in ad["photos"]:
-            try:
-                # Extract public_id from URL
-                # This is a simplified approach - you might need to adjust based on your Cloudinary setup
-                parts = photo_url.split('/')
-                filename = parts[-1].split('.')[0]
-                folder = parts[-2]
-                public_id = f"{folder}/{filename}"
-                delete_image(public_id)
-            except Exception as e:
-                print(f"Error deleting photo: {str(e)}")
+    # Release associated photos, including ones stored but not added to the ad yet;
+    # photos no other ad uses are deleted from storage
+    photos = photo_variants_for(ad, ad.get("photos", [])) + unadded_media_variants(ad)
+    if photos:
+        await release_photos(photos)
     
     await ads_collection.delete_one({"_id": ObjectId(ad_id)})
+    await invalidate_listings()
     
     return None
\ No newline at end of file
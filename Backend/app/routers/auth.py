@@ -1,4 +1,5 @@
-from fastapi import APIRouter, Depends, HTTPException, status, File, UploadFile, Form, Body
+from fastapi import APIRouter, Depends, HTTPException, status, File, UploadFile, Form, Body, Request
+from fastapi.routing import APIRoute
 from fastapi.security import OAuth2PasswordRequestForm
 from datetime import timedelta
 from typing import Dict, List, Optional
@@ -10,12 +11,83 @@ from ..core.auth import get_password_hash, create_access_token, verify_password
 from ..core.config import settings
 from ..core.database import get_collection
 from ..models.user import UserCreate, User, Address
+from ..utils.storage import get_storage
+
+# Registration documents are streamed to storage in chunks of this size, so a
+# request never holds more than one chunk of a document in memory
+DOCUMENT_CHUNK_SIZE = 1024 * 1024
+MAX_DOCUMENT_BYTES = 10 * 1024 * 1024
+MAX_DOCUMENTS_TOTAL_BYTES = 25 * 1024 * 1024
+
+# Largest request body accepted: the documents plus room for the form fields
+MAX_REQUEST_BYTES = MAX_DOCUMENTS_TOTAL_BYTES + 1024 * 1024
+
+def _request_too_large():
+    return HTTPException(
+        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        detail=f"Request is larger than {MAX_REQUEST_BYTES // (1024 * 1024)} MB"
+    )
+
+class _LimitedBodyRoute(APIRoute):
+    """
+    Rejects bodies over MAX_REQUEST_BYTES before the multipart form is parsed,
+    which otherwise spools every upload to disk before the endpoint runs. The
+    declared Content-Length is checked up front, and bodies without one are
+    counted as they arrive.
+    """
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def limited_handler(request: Request):
+            content_length = request.headers.get("content-length")
+            if content_length is not None:
+                if not content_length.isdigit():
+                    raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid Content-Length")
+                if int(content_length) > MAX_REQUEST_BYTES:
+                    raise _request_too_large()
+                return await handler(request)
+
+            received = 0
+
+            async def receive():
+                nonlocal received
+                message = await request.receive()
+                received += len(message.get("body", b""))
+                if received > MAX_REQUEST_BYTES:
+                    raise _request_too_large()
+                return message
+
+            return await handler(Request(request.scope, receive))
+
+        return limited_handler
 
 router = APIRouter(
     prefix="/auth",
-    tags=["authentication"]
+    tags=["authentication"],
+    route_class=_LimitedBodyRoute
 )
 
+async def _document_chunks(file: UploadFile, uploaded: dict):
+    """Read an uploaded document in chunks, enforcing the per-file and total size limits as it goes"""
+    size = 0
+    while True:
+        chunk = await file.read(DOCUMENT_CHUNK_SIZE)
+        if not chunk:
+            return
+        size += len(chunk)
+        uploaded["bytes"] += len(chunk)
+        if size > MAX_DOCUMENT_BYTES:
+            raise HTTPException(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                detail=f"{file.filename} is larger than {MAX_DOCUMENT_BYTES // (1024 * 1024)} MB"
+            )
+        if uploaded["bytes"] > MAX_DOCUMENTS_TOTAL_BYTES:
+            raise HTTPException(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                detail=f"Documents together are larger than {MAX_DOCUMENTS_TOTAL_BYTES // (1024 * 1024)} MB"
+            )
+        yield chunk
+
 @router.post("/token", response_model=Dict[str, str])
 async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
     users_collection = get_collection("users")
@@ -111,23 +183,23 @@ async def register(
     # Handle document uploads if provided
     document_paths = []
     if document_files:
-        # Create directory for user documents if it doesn't exist
-        import os
-        upload_dir = f"uploads/documents/{email}"
-        os.makedirs(upload_dir, exist_ok=True)
+        storage = get_storage()
+        uploaded = {"bytes": 0}
         
-        # Save uploaded files
-        for i, file in enumerate(document_files):
-            if file.filename:  # Only process if filename exists
-                file_extension = file.filename.split(".")[-1]
-                file_path = f"{upload_dir}/document_{i}.{file_extension}"
-                
-                # Save file
-                with open(file_path, "wb") as f:
-                    content = await file.read()
-                    f.write(content)
-                
-                document_paths.append(file_path)
+        # Stream uploaded files to storage; if one fails or is too large, remove the ones already stored
+        try:
+            for i, file in enumerate(document_files):
+                if file.filename:  # Only process if filename exists
+                    file_extension = file.filename.split(".")[-1]
+                    key = f"documents/{email}/document_{i}.{file_extension}"
+                    
+                    await storage.put_stream(key, _document_chunks(file, uploaded), file.content_type)
+                    
+                    document_paths.append(key)
+        except Exception:
+            for key in document_paths:
+                await storage.delete(key)
+            raise
     
     # Set document paths in user data
     user_dict["document_uploads"] = document_paths
@@ -0,0 +1,226 @@
+from fastapi import APIRouter, Depends, HTTPException, status, Query
+from fastapi.responses import StreamingResponse
+from typing import Optional
+from datetime import datetime
+import asyncio
+import csv
+import importlib.util
+import io
+import os
+import tempfile
+
+from ..core.auth import get_current_active_user
+from ..core.database import get_collection
+
+router = APIRouter(
+    prefix="/exports",
+    tags=["exports"],
+    dependencies=[Depends(get_current_active_user)]
+)
+
+# Number of documents fetched per cursor batch and rows buffered per streamed chunk
+CURSOR_BATCH_SIZE = 1000
+CHUNK_ROWS = 500
+
+LOAN_COLUMNS = [
+    ("loan_id", "_id"),
+    ("borrower_nic", "borrower_nic"),
+    ("customer_name", "customer_name"),
+    ("customer_phone", "customer_phone"),
+    ("amount", "amount"),
+    ("interest_rate", "interest_rate"),
+    ("term_months", "term_months"),
+    ("schedule_type", "schedule_type"),
+    ("total_amount", "total_amount"),
+    ("total_paid", "total_paid"),
+    ("remaining_amount", "remaining_amount"),
+    ("status", "status"),
+    ("start_date", "start_date"),
+    ("end_date", "end_date"),
+    ("created_at", "created_at")
+]
+
+PAYMENT_COLUMNS = [
+    ("payment_id", "_id"),
+    ("loan_id", "loan_id"),
+    ("customer_name", "customer_name"),
+    ("borrower_nic", "borrower_nic"),
+    ("amount", "amount"),
+    ("method", "method"),
+    ("status", "status"),
+    ("payment_date", "payment_date"),
+    ("created_at", "created_at")
+]
+
+def _date_range(from_date: Optional[datetime], to_date: Optional[datetime]) -> dict:
+    date_range = {}
+    if from_date:
+        date_range["$gte"] = from_date
+    if to_date:
+        date_range["$lte"] = to_date
+    return date_range
+
+def _cell(value):
+    if isinstance(value, datetime):
+        return value.replace(microsecond=0).isoformat() + "Z"
+    if value is None:
+        return ""
+    if isinstance(value, (int, float)):
+        return value
+    return str(value)
+
+def _row(document: dict, columns) -> list:
+    return [_cell(document.get(field)) for _, field in columns]
+
+def _loans_cursor(lender_id: str, loan_status: Optional[str], from_date: Optional[datetime], to_date: Optional[datetime]):
+    """Cursor over the lender's loans with filters and projection pushed down to Mongo"""
+    query = {"lender_id": lender_id}
+    if loan_status:
+        query["status"] = loan_status
+    created_range = _date_range(from_date, to_date)
+    if created_range:
+        query["created_at"] = created_range
+
+    projection = {field: 1 for _, field in LOAN_COLUMNS}
+    # Walks the (lender_id, created_at, _id) index; _id keeps loans created at the same time in a stable order
+    return get_collection("loans").find(query, projection).sort(
+        [("created_at", 1), ("_id", 1)]
+    ).batch_size(CURSOR_BATCH_SIZE)
+
+def _payments_cursor(lender_id: str, payment_status: Optional[str], from_date: Optional[datetime], to_date: Optional[datetime]):
+    """
+    Cursor over payments received on the lender's loans.
+
+    Payments don't carry the lender, so they are joined from the lender's
+    loans with the status and date filters applied inside the join.
+    """
+    payment_match = {"$expr": {"$eq": ["$loan_id", "$$loan_id"]}}
+    if payment_status:
+        payment_match["status"] = payment_status
+    created_range = _date_range(from_date, to_date)
+    if created_range:
+        payment_match["created_at"] = created_range
+
+    pipeline = [
+        {"$match": {"lender_id": lender_id}},
+        {"$project": {"customer_name": 1, "borrower_nic": 1}},
+        {"$lookup": {
+            "from": "payments",
+            "let": {"loan_id": {"$toString": "$_id"}},
+            "pipeline": [
+                {"$match": payment_match},
+                {"$sort": {"created_at": 1}},
+                {"$project": {field: 1 for _, field in PAYMENT_COLUMNS if field not in ("customer_name", "borrower_nic")}}
+            ],
+            "as": "payment"
+        }},
+        {"$unwind": "$payment"},
+        {"$replaceRoot": {"newRoot": {"$mergeObjects": [
+            "$payment",
+            {"customer_name": "$customer_name", "borrower_nic": "$borrower_nic"}
+        ]}}}
+    ]
+    return get_collection("loans").aggregate(pipeline, batchSize=CURSOR_BATCH_SIZE)
+
+async def _stream_csv(cursor, columns):
+    """Yield CSV text in chunks of CHUNK_ROWS rows, so memory stays flat whatever the row count"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([name for name, _ in columns])
+
+    rows = 0
+    async for document in cursor:
+        writer.writerow(_row(document, columns))
+        rows += 1
+        if rows % CHUNK_ROWS == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue()
+
+async def _stream_xlsx(cursor, columns, sheet_title: str):
+    """
+    Yield an XLSX workbook built with openpyxl's write-only mode.
+
+    Rows are spooled to a temporary file rather than kept in memory, and the
+    finished file is streamed back in fixed-size chunks. Saving and reading
+    the file run in threads so a large export doesn't block the event loop.
+    """
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(title=sheet_title)
+    sheet.append([name for name, _ in columns])
+    async for document in cursor:
+        sheet.append(_row(document, columns))
+
+    handle, path = tempfile.mkstemp(suffix=".xlsx")
+    os.close(handle)
+    try:
+        await asyncio.to_thread(workbook.save, path)
+        f = await asyncio.to_thread(open, path, "rb")
+        try:
+            while True:
+                chunk = await asyncio.to_thread(f.read, 64 * 1024)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            f.close()
+    finally:
+        await asyncio.to_thread(os.remove, path)
+
+def _export_response(cursor, columns, name: str, format: str):
+    timestamp = datetime.utcnow().strftime("%Y%m%d")
+    if format == "xlsx":
+        if importlib.util.find_spec("openpyxl") is None:
+            raise HTTPException(
+                status_code=status.HTTP_501_NOT_IMPLEMENTED,
+                detail="XLSX export requires openpyxl to be installed"
+            )
+        content = _stream_xlsx(cursor, columns, name)
+        media_type = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    else:
+        content = _stream_csv(cursor, columns)
+        media_type = "text/csv"
+
+    return StreamingResponse(
+        content,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{name}_{timestamp}.{format}"'}
+    )
+
+def _require_lender(current_user):
+    if current_user["role"] != "lender":
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Only lenders can export their loan book"
+        )
+
+@router.get("/loans")
+async def export_loans(
+    format: str = Query("csv", pattern="^(csv|xlsx)$"),
+    status_filter: Optional[str] = Query(None, alias="status"),
+    from_date: Optional[datetime] = None,
+    to_date: Optional[datetime] = None,
+    current_user = Depends(get_current_active_user)
+):
+    """Export all loans issued by the current lender"""
+    _require_lender(current_user)
+    cursor = _loans_cursor(str(current_user["_id"]), status_filter, from_date, to_date)
+    return _export_response(cursor, LOAN_COLUMNS, "loans", format)
+
+@router.get("/payments")
+async def export_payments(
+    format: str = Query("csv", pattern="^(csv|xlsx)$"),
+    status_filter: Optional[str] = Query(None, alias="status"),
+    from_date: Optional[datetime] = None,
+    to_date: Optional[datetime] = None,
+    current_user = Depends(get_current_active_user)
+):
+    """Export all payments received on the current lender's loans"""
+    _require_lender(current_user)
+    cursor = _payments_cursor(str(current_user["_id"]), status_filter, from_date, to_date)
+    return _export_response(cursor, PAYMENT_COLUMNS, "payments", format)
@@ -6,6 +6,7 @@ from datetime import datetime
 from ..core.auth import get_current_active_user
 from ..core.database import get_collection
 from ..models.user import UserUpdate
+from ..utils.portfolio_utils import get_lender_summary, month_key
 
 router = APIRouter(
     prefix="/lenders",
@@ -37,6 +38,25 @@ async def get_lender_profile(current_user = Depends(get_current_active_user)):
     
     return lender_profile
 
+@router.get("/dashboard", response_model=dict)
+async def get_lender_dashboard(current_user = Depends(get_current_active_user)):
+    """Get the portfolio summary for the current lender"""
+    if current_user["role"] != "lender":
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Only lenders can access the lender dashboard"
+        )
+    
+    summary = await get_lender_summary(str(current_user["_id"]))
+    
+    return {
+        "outstandingPrincipal": round(max(0, summary.get("outstanding_principal", 0)), 2),
+        "collectedThisMonth": summary.get("collected_by_month", {}).get(month_key(), 0),
+        "overdueCount": max(0, summary.get("overdue_count", 0)),
+        "loansByStatus": {k: v for k, v in summary.get("loans_by_status", {}).items() if v > 0},
+        "updatedAt": summary.get("updated_at")
+    }
+
 @router.put("/business", response_model=dict)
 async def update_lender_business(
     business_data: dict,
@@ -4,10 +4,19 @@ from bson import ObjectId
 from datetime import datetime
 
 from ..core.auth import get_current_active_user
-from ..core.database import get_collection
+from ..core.database import get_collection, run_in_transaction
 from ..models.loan import Loan, LoanStatus, Payment, PaymentStatus, PaymentCreate
-from ..utils.loan_utils import register_borrower_routes
-from ..utils.notification_utils import send_loan_created_notifications
+from ..utils.loan_utils import register_borrower_routes, build_borrower_summary
+from ..utils.notification_utils import loan_created_notifications, notification_event, payment_notifications
+from ..utils.outbox import add_outbox_events
+from ..utils.schedule_engine import generate_schedule, FLAT, SCHEDULE_METHODS
+from ..utils.installment_utils import (
+    attach_installments, complete_next_installment, create_installments, is_normalized, load_installments,
+    loan_guard, LoanChangedError, PAYMENT_ATTEMPTS, set_installments_loan_status, UNPAID_INSTALLMENT_STATUSES
+)
+from ..utils.portfolio_utils import (
+    LOAN_STATUSES, record_loan_created, record_loan_payment, record_loan_status_change, record_overdue_change
+)
 
 router = APIRouter(
     prefix="/loans",
@@ -54,23 +63,19 @@ async def create_loan(loan_data: dict, current_user = Depends(get_current_active
     interest_rate = float(loan_data.get("interest_rate", 0))
     term_months = int(loan_data.get("term_months", 1))
     
-    interest_amount = amount * (interest_rate / 100)
-    total_amount = amount + interest_amount
-    installment_amount = total_amount / term_months
+    schedule_type = loan_data.get("schedule_type", FLAT)
+    if schedule_type not in SCHEDULE_METHODS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Invalid schedule type. Expected one of: {', '.join(SCHEDULE_METHODS)}"
+        )
     
     # Create payment schedule
-    from datetime import datetime, timedelta
-    
     today = datetime.utcnow()
-    payments = []
-    
-    for i in range(term_months):
-        due_date = today + timedelta(days=30 * (i + 1))
-        payments.append({
-            "amount": installment_amount,
-            "due_date": due_date,
-            "status": "PENDING"
-        })
+    schedule = generate_schedule(amount, interest_rate, term_months, today, schedule_type)
+    payments = schedule["payments"]
+    total_amount = schedule["total_amount"]
+    installment_amount = schedule["installment_amount"]
     
     # Prepare loan document
     loan_document = {
@@ -82,8 +87,10 @@ async def create_loan(loan_data: dict, current_user = Depends(get_current_active
         "status": "PENDING",  # Initial status
         "purpose": loan_data.get("purpose", ""),
         "start_date": today,
-        "end_date": today + timedelta(days=30 * term_months),
-        "payments": payments,
+        "end_date": schedule["end_date"],
+        "schedule_type": schedule_type,
+        # The schedule is stored in the installments collection
+        "installments_normalized": True,
         "total_amount": total_amount,
         "remaining_amount": total_amount,
         "total_paid": 0,
@@ -100,17 +107,22 @@ async def create_loan(loan_data: dict, current_user = Depends(get_current_active
         "customer_gender": loan_data.get("customer_gender", "")  # Add this line
     }
     
-    # Insert into database
-    result = await loans_collection.insert_one(loan_document)
+    # The loan, its schedule and the notification event are committed together
+    loan_document["_id"] = ObjectId()
+    events = [notification_event(loan_created_notifications(loan_document))]
     
-    # Add the ID to the loan document for notification
-    loan_document["_id"] = result.inserted_id
+    async def write(session):
+        await loans_collection.insert_one(loan_document, session=session)
+        await create_installments(str(loan_document["_id"]), loan_document, payments, session=session)
+        await add_outbox_events(events, session=session)
+        # Keep the lender's portfolio summary current
+        await record_loan_created(loan_document, session=session)
     
-    # Send notifications
-    await send_loan_created_notifications(loan_document)
+    await run_in_transaction(write)
     
     # Return created loan with ID
-    loan_document["_id"] = str(result.inserted_id)
+    loan_document["_id"] = str(loan_document["_id"])
+    loan_document["payments"] = payments
     return loan_document
 
 # Add this route as well for consistency
@@ -139,6 +151,7 @@ async def get_loans(
     
     cursor = loans_collection.find(query)
     loans = await cursor.to_list(length=100)
+    await attach_installments(loans)
     
     # Convert ObjectId to string for JSON serialization
     for loan in loans:
@@ -168,6 +181,8 @@ async def get_loan(loan_id: str, current_user = Depends(get_current_active_user)
                 detail="Loan not found"
             )
         
+        await attach_installments([loan])
+        
         # Convert ObjectId to string for JSON serialization
         loan["_id"] = str(loan["_id"])
         
@@ -213,6 +228,13 @@ async def update_loan_status(
 ):
     """Update a loan's status"""
     
+    # `status` shadows the status module here
+    if status not in LOAN_STATUSES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid loan status: {status}"
+        )
+    
     # Check if the current user is authorized
     if current_user["role"] not in ["lender", "admin"]:
         raise HTTPException(
@@ -238,14 +260,21 @@ async def update_loan_status(
             detail="You can only update loans you've created"
         )
     
-    # Update loan status
-    await loans_collection.update_one(
-        {"_id": ObjectId(loan_id)},
-        {"$set": {"status": status, "updated_at": datetime.utcnow()}}
-    )
+    # Update loan status, its installments and the lender's summary together
+    async def write(session):
+        await loans_collection.update_one(
+            {"_id": ObjectId(loan_id)},
+            {"$set": {"status": status, "updated_at": datetime.utcnow()}},
+            session=session
+        )
+        await set_installments_loan_status(loan, status, session=session)
+        await record_loan_status_change(loan, status, session=session)
+    
+    await run_in_transaction(write)
     
     # Return updated loan
     updated_loan = await loans_collection.find_one({"_id": ObjectId(loan_id)})
+    await attach_installments([updated_loan])
     updated_loan["_id"] = str(updated_loan["_id"])
     return updated_loan
     
@@ -310,12 +339,10 @@ async def get_lender_loans(
     
     cursor = loans_collection.find(query)
     loans = await cursor.to_list(length=100)
+    await attach_installments(loans)
     
     return loans
 
-# Make sure to import the notification utilities
-from ..utils.notification_utils import send_payment_notifications
-
 @router.post("/{loan_id}/payments")
 async def add_loan_payment(
     loan_id: str,
@@ -391,81 +418,109 @@ async def add_loan_payment(
         "payment_date": payment_data.get("payment_date", datetime.utcnow())
     }
     
+    standalone_payment["_id"] = ObjectId()
+    
+    async def apply_payment(loan):
+        # Update loan with payment information
+        total_paid = loan.get("total_paid", 0) + amount
+        remaining_amount = loan.get("total_amount", 0) - total_paid
+        
+        # Update loan status based on payment
+        new_status = loan["status"]
+        
+        # If first payment received but not fully paid, set to ACTIVE
+        if total_paid > 0 and total_paid < loan.get("total_amount", 0) and loan["status"] == "PENDING":
+            new_status = "ACTIVE"
+        
+        # If fully paid, set to COMPLETED
+        if remaining_amount <= 0:
+            new_status = "COMPLETED"
+        
+        loan_update = {
+            "total_paid": total_paid,
+            "remaining_amount": max(0, remaining_amount),
+            "status": new_status,
+            "updated_at": datetime.utcnow()
+        }
+        
+        # Embedded schedules are rewritten with the first unpaid payment marked as completed
+        settled_overdue = False
+        if not is_normalized(loan):
+            payments = loan.get("payments", [])
+            updated_payments = []
+            payment_marked = False
+            
+            for pmt in payments:
+                # Only mark one payment as completed
+                if pmt.get("status") in UNPAID_INSTALLMENT_STATUSES and not payment_marked:
+                    settled_overdue = pmt.get("status") != "PENDING"
+                    pmt["status"] = "COMPLETED"
+                    pmt["payment_date"] = payment_data.get("payment_date", datetime.utcnow())
+                    pmt["method"] = payment_data.get("method", "cash")
+                    payment_marked = True
+                updated_payments.append(pmt)
+            loan_update["payments"] = updated_payments
+        
+        # The payment record, the loan and schedule updates and the notification
+        # event are committed together; notifications are delivered by the outbox relay
+        events = [notification_event(payment_notifications(standalone_payment, loan))]
+        
+        async def write(session):
+            # Only applies to the loan as it was read; otherwise the payment is recomputed
+            result = await loans_collection.update_one(loan_guard(loan), {"$set": loan_update}, session=session)
+            if not result.matched_count:
+                raise LoanChangedError(f"Loan {loan_id} changed while recording a payment")
+            
+            await payments_collection.insert_one(standalone_payment, session=session)
+            
+            installment = None
+            if is_normalized(loan):
+                # Only the installment being paid is touched
+                installment = await complete_next_installment(
+                    loan, payment_record["payment_date"], payment_record["method"], session=session
+                )
+                await set_installments_loan_status(loan, new_status, session=session)
+            
+            await add_outbox_events(events, session=session)
+            
+            await record_loan_payment(loan, amount, new_status, payment_record["payment_date"], session=session)
+            if is_normalized(loan):
+                settled = bool(installment and installment.get("late_since"))
+            else:
+                settled = settled_overdue
+            if settled:
+                await record_overdue_change(loan.get("lender_id"), -1, session=session)
+        
+        await run_in_transaction(write)
+    
+    # A loan that took another payment or had its schedule migrated since it
+    # was read is read again, so the payment lands where the schedule now lives
     try:
-        payment_result = await payments_collection.insert_one(standalone_payment)
-        standalone_payment["_id"] = payment_result.inserted_id
+        for _ in range(PAYMENT_ATTEMPTS):
+            try:
+                await apply_payment(loan)
+                break
+            except LoanChangedError:
+                loan = await loans_collection.find_one({"_id": ObjectId(loan_id)})
+        else:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="The loan was updated at the same time, please try again"
+            )
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"Error inserting payment: {str(e)}")
+        print(f"Error recording payment: {str(e)}")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Failed to create payment record: {str(e)}"
+            detail=f"Failed to record payment: {str(e)}"
         )
     
-    # Update loan with payment information
-    total_paid = loan.get("total_paid", 0) + amount
-    remaining_amount = loan.get("total_amount", 0) - total_paid
-    
-    # Update loan status based on payment
-    new_status = loan["status"]
-    
-    # If first payment received but not fully paid, set to ACTIVE
-    if total_paid > 0 and total_paid < loan.get("total_amount", 0) and loan["status"] == "PENDING":
-        new_status = "ACTIVE"
-    
-    # If fully paid, set to COMPLETED
-    if remaining_amount <= 0:
-        new_status = "COMPLETED"
-    
-    # Also update the status of the payment in the payment schedule
-    payments = loan.get("payments", [])
-    updated_payments = []
-    payment_marked = False
-    
-    for pmt in payments:
-        # Only mark one payment as completed
-        if pmt.get("status") == "PENDING" and not payment_marked:
-            pmt["status"] = "COMPLETED"
-            pmt["payment_date"] = payment_data.get("payment_date", datetime.utcnow())
-            pmt["method"] = payment_data.get("method", "cash")
-            payment_marked = True
-        updated_payments.append(pmt)
-    
-    # Update the loan document
-    try:
-        await loans_collection.update_one(
-            {"_id": ObjectId(loan_id)},
-            {
-                "$set": {
-                    "payments": updated_payments,
-                    "total_paid": total_paid,
-                    "remaining_amount": max(0, remaining_amount),
-                    "status": new_status,
-                    "updated_at": datetime.utcnow()
-                }
-            }
-        )
-    except Exception as e:
-        print(f"Error updating loan: {str(e)}")
-        # Even if loan update fails, we don't want to roll back the payment
-        # as it might cause data inconsistency. We'll handle this error but still
-        # try to send notifications
-    
     # Get the updated loan to return
     try:
         updated_loan = await loans_collection.find_one({"_id": ObjectId(loan_id)})
         if updated_loan:
-            # Create a clean copy of standalone_payment for notifications
-            payment_for_notification = dict(standalone_payment)
-            # Convert ObjectId to string
-            payment_for_notification["_id"] = str(payment_for_notification["_id"])
-            
-            # Send notifications
-            try:
-                await send_payment_notifications(payment_for_notification, updated_loan)
-            except Exception as e:
-                print(f"Error sending payment notifications: {str(e)}")
-                # We don't want to fail the whole request if notifications fail
-            
+            await attach_installments([updated_loan])
             updated_loan["_id"] = str(updated_loan["_id"])
     except Exception as e:
         print(f"Error fetching updated loan: {str(e)}")
@@ -526,9 +581,10 @@ async def get_loan_payments(
         return payments
     except Exception as e:
         # If there's an error getting payments from the collection,
-        # attempt to return the payments from the loan document itself
-        if "payments" in loan and loan["payments"]:
-            return loan["payments"]
+        # attempt to return the payments from the loan's schedule itself
+        schedule = await load_installments(loan)
+        if schedule:
+            return schedule
         
         # If no payments are found, return an empty list rather than an error
         return []
@@ -571,10 +627,10 @@ async def get_next_installment(
     
     # Find the next pending payment
     next_payment = None
-    payments = loan.get("payments", [])
+    payments = await load_installments(loan)
     
     for payment in payments:
-        if payment.get("status") == "PENDING":
+        if payment.get("status") in UNPAID_INSTALLMENT_STATUSES:
             next_payment = {
                 "amount": payment.get("amount"),
                 "dueDate": payment.get("due_date")
@@ -602,113 +658,7 @@ async def get_borrower_loan_summary(current_user = Depends(get_current_active_us
             detail="Only borrowers can access their loan summary"
         )
     
-    loans_collection = get_collection("loans")
-    
-    # Get all loans for this borrower
-    borrower_id = str(current_user["_id"])
-    cursor = loans_collection.find({"borrower_id": borrower_id})
-    loans = await cursor.to_list(length=100)
-    
-    # Calculate summary statistics
-    active_loans = [loan for loan in loans if loan.get("status") in ["ACTIVE", "APPROVED"]]
-    completed_loans = [loan for loan in loans if loan.get("status") == "COMPLETED"]
-    
-    total_borrowed = sum(loan.get("amount", 0) for loan in loans)
-    current_balance = sum(loan.get("remaining_amount", 0) for loan in active_loans)
-    total_paid = sum(loan.get("total_paid", 0) for loan in loans)
-    
-    # Find next payment due
-    next_payment_due = None
-    next_payment_amount = 0
-    
-    for loan in active_loans:
-        for payment in loan.get("payments", []):
-            if payment.get("status") == "PENDING":
-                payment_date = payment.get("due_date")
-                if payment_date and (next_payment_due is None or payment_date < next_payment_due):
-                    next_payment_due = payment_date
-                    next_payment_amount = payment.get("amount", 0)
-                break
-    
-    # Format loans for response
-    formatted_loans = []
-    for loan in loans:
-        # Calculate remaining installments
-        remaining_installments = len([p for p in loan.get("payments", []) if p.get("status") == "PENDING"])
-        
-        formatted_loan = {
-            "id": str(loan["_id"]),
-            "lender": loan.get("lender_name", "Unknown Lender"),
-            "amount": loan.get("amount", 0),
-            "startDate": loan.get("start_date"),
-            "endDate": loan.get("end_date"),
-            "installments": loan.get("term_months", 0),
-            "installmentAmount": loan.get("installment_amount", 0),
-            "remainingInstallments": remaining_installments,
-            "status": "active" if loan.get("status") in ["ACTIVE", "APPROVED"] else "completed" if loan.get("status") == "COMPLETED" else "pending",
-            "interestRate": loan.get("interest_rate", 0)
-        }
-        formatted_loans.append(formatted_loan)
-    
-    # Get upcoming payments
-    upcoming_payments = []
-    for loan in active_loans:
-        for payment in loan.get("payments", []):
-            if payment.get("status") == "PENDING":
-                due_date = payment.get("due_date")
-                if due_date:
-                    upcoming_payment = {
-                        "id": payment.get("payment_id", str(ObjectId())),
-                        "loanId": str(loan["_id"]),
-                        "dueDate": due_date,
-                        "amount": payment.get("amount", 0),
-                        "status": "upcoming",
-                        "lender": loan.get("lender_name", "Unknown Lender")
-                    }
-                    upcoming_payments.append(upcoming_payment)
-    
-    # Sort upcoming payments by due date
-    upcoming_payments.sort(key=lambda x: x["dueDate"])
-    
-    # Get recent payments
-    recent_payments = []
-    payments_collection = get_collection("payments")
-    payments_cursor = payments_collection.find({"user_id": borrower_id}).sort("created_at", -1).limit(10)
-    payments = await payments_cursor.to_list(length=10)
-    
-    for payment in payments:
-        loan_id = payment.get("loan_id")
-        loan = None
-        if loan_id:
-            try:
-                loan = await loans_collection.find_one({"_id": ObjectId(loan_id)})
-            except:
-                pass
-        
-        recent_payment = {
-            "id": str(payment["_id"]),
-            "loanId": loan_id,
-            "paidDate": payment.get("created_at") or payment.get("payment_date"),
-            "amount": payment.get("amount", 0),
-            "method": payment.get("method", "unknown"),
-            "lender": loan.get("lender_name", "Unknown Lender") if loan else "Unknown Lender"
-        }
-        recent_payments.append(recent_payment)
-    
-    return {
-        "stats": {
-            "activeLoans": len(active_loans),
-            "completedLoans": len(completed_loans),
-            "totalBorrowed": total_borrowed,
-            "currentBalance": current_balance,
-            "totalPaid": total_paid,
-            "nextPaymentDue": next_payment_due,
-            "nextPaymentAmount": next_payment_amount
-        },
-        "loans": formatted_loans,
-        "upcomingPayments": upcoming_payments,
-        "recentPayments": recent_payments
-    }
+    return await build_borrower_summary(str(current_user["_id"]))
 
 @router.get("/test")
 async def test_endpoint():
@@ -0,0 +1,60 @@
+from fastapi import APIRouter, HTTPException, status
+from fastapi.responses import StreamingResponse
+from typing import Optional
+import mimetypes
+import os
+
+from ..utils.storage import LocalStorage, PUBLIC_PREFIXES, get_storage, legacy_storage, normalize_key, verify_local_signature
+
+# Serves objects of the local storage driver. Ad photos are public; anything
+# else, such as KYC documents, needs a signed URL from LocalStorage.signed_url.
+# With another backend configured, only the signed legacy documents still on
+# local disk are served.
+router = APIRouter(
+    prefix="/media",
+    tags=["media"]
+)
+
+@router.get("/{key:path}")
+async def get_media(key: str, expires: Optional[int] = None, signature: Optional[str] = None):
+    storage = get_storage()
+    local = isinstance(storage, LocalStorage)
+    if not local:
+        storage = legacy_storage()
+    
+    # The prefix decides whether a signature is needed, so it is checked on the
+    # key as resolved on disk, after rejecting "." and ".." segments
+    try:
+        key = normalize_key(key)
+        resolved = os.path.relpath(storage.path(key), storage.root).replace(os.sep, "/")
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Not found"
+        )
+    
+    if not (local and resolved.startswith(PUBLIC_PREFIXES)):
+        if expires is None or signature is None or not verify_local_signature(resolved, expires, signature):
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="Invalid or expired link"
+            )
+    
+    try:
+        chunks = storage.stream(resolved)
+        first = await chunks.__anext__()
+    except (FileNotFoundError, ValueError):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Not found"
+        )
+    except StopAsyncIteration:
+        first = b""
+    
+    async def content():
+        yield first
+        async for chunk in chunks:
+            yield chunk
+    
+    media_type = mimetypes.guess_type(key)[0] or "application/octet-stream"
+    return StreamingResponse(content(), media_type=media_type)
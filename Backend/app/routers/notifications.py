@@ -1,12 +1,19 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Query
+from fastapi import APIRouter, Depends, HTTPException, status, Query, Request
+from fastapi.responses import StreamingResponse
 from typing import List, Optional, Dict, Any
 from bson import ObjectId
-from datetime import datetime
+from datetime import datetime, timedelta
+import asyncio
 import json
 
-from ..core.auth import get_current_active_user
-from ..core.database import get_collection
+from ..core.auth import STREAM_TOKEN_SECONDS, create_stream_token, get_current_active_user, get_stream_user
+from ..core.database import get_collection, run_in_transaction
 from ..models.notification import Notification, NotificationCreate, NotificationType
+from ..utils.notification_push import notification_broker
+from ..utils.notification_counters import (
+    get_notification_counts, record_notifications_read, record_notifications_removed, rebuild_notification_counts
+)
+from ..utils.notification_retention import delete_all, mark_all_read
 
 # Custom JSON encoder to handle ObjectId and datetime
 class MongoJSONEncoder(json.JSONEncoder):
@@ -31,21 +38,56 @@ def convert_mongo_doc_to_json(doc):
     else:
         return doc
 
+EPOCH = datetime(1970, 1, 1)
+
+def encode_cursor(notification: dict) -> str:
+    """Opaque page cursor: the notification's timestamp in milliseconds and its id"""
+    millis = (notification["timestamp"] - EPOCH) // timedelta(milliseconds=1)
+    return f"{millis}_{notification['_id']}"
+
+def decode_cursor(cursor: str):
+    try:
+        millis, notification_id = cursor.split("_", 1)
+        return EPOCH + timedelta(milliseconds=int(millis)), ObjectId(notification_id)
+    except Exception:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid pagination cursor"
+        )
+
+# Idle streams get a comment line this often so proxies don't close them
+STREAM_KEEPALIVE_SECONDS = 15
+
 router = APIRouter(
     prefix="/notifications",
     tags=["notifications"],
     dependencies=[Depends(get_current_active_user)]
 )
 
+# The stream authenticates with its own dependency, which also accepts a stream token
+stream_router = APIRouter(
+    prefix="/notifications",
+    tags=["notifications"]
+)
+
 @router.get("/", response_model=Dict[str, Any])
 async def get_notifications(
     read: Optional[bool] = None,
     type: Optional[str] = None,
     limit: int = Query(10, ge=1, le=100),
     offset: int = Query(0, ge=0),
+    before: Optional[str] = None,
     current_user = Depends(get_current_active_user)
 ):
-    """Get notifications for the current user"""
+    """
+    Get notifications for the current user, newest first
+
+    Pass the `next_cursor` of a page as `before` to get the page after it.
+    Cursor pages cost the same at any depth; `offset` is still accepted for
+    older clients.
+    """
+    before_key = decode_cursor(before) if before else None
+    
     try:
         print(f"Fetching notifications for user: {current_user['_id']}, params: limit={limit}, offset={offset}, read={read}, type={type}")
         
@@ -59,15 +101,36 @@ async def get_notifications(
         
         print(f"Query: {query}")
         
-        # Count total notifications for pagination
-        total = await notifications_collection.count_documents(query)
+        # Count total notifications for pagination; the per-user counters cover every filter except type
+        if type is None:
+            counts = await get_notification_counts(str(current_user["_id"]))
+            if read is None:
+                total = counts["total"]
+            elif read:
+                total = max(0, counts["total"] - counts["unread"])
+            else:
+                total = counts["unread"]
+        else:
+            total = await notifications_collection.count_documents(query)
         print(f"Total matching notifications: {total}")
         
-        # Get paginated notifications
-        cursor = notifications_collection.find(query).sort("timestamp", -1).skip(offset).limit(limit)
-        notifications = await cursor.to_list(length=limit)
+        # Get paginated notifications, continuing after the cursor key when one is given
+        if before_key:
+            before_timestamp, before_id = before_key
+            query["$or"] = [
+                {"timestamp": {"$lt": before_timestamp}},
+                {"timestamp": before_timestamp, "_id": {"$lt": before_id}}
+            ]
+        cursor = notifications_collection.find(query).sort([("timestamp", -1), ("_id", -1)])
+        if not before_key:
+            cursor = cursor.skip(offset)
+        notifications = await cursor.limit(limit).to_list(length=limit)
         print(f"Retrieved {len(notifications)} notifications")
         
+        next_cursor = None
+        if len(notifications) == limit and isinstance(notifications[-1].get("timestamp"), datetime):
+            next_cursor = encode_cursor(notifications[-1])
+        
         # Convert all MongoDB objects to JSON-serializable formats
         serialized_notifications = [convert_mongo_doc_to_json(notification) for notification in notifications]
         
@@ -75,7 +138,8 @@ async def get_notifications(
             "notifications": serialized_notifications,
             "total": total,
             "limit": limit,
-            "offset": offset
+            "offset": offset,
+            "next_cursor": next_cursor
         }
     except Exception as e:
         print(f"Error in get_notifications: {str(e)}")
@@ -95,18 +159,56 @@ async def get_notifications(
 async def get_unread_count(current_user = Depends(get_current_active_user)):
     """Get count of unread notifications for the current user"""
     try:
-        notifications_collection = get_collection("notifications")
-        
-        count = await notifications_collection.count_documents({
-            "user_id": str(current_user["_id"]),
-            "read": False
-        })
-        
-        return {"count": count}
+        counts = await get_notification_counts(str(current_user["_id"]))
+        return {"count": counts["unread"]}
     except Exception as e:
         print(f"Error in get_unread_count: {str(e)}")
         return {"count": 0, "error": str(e)}
 
+@router.post("/stream-token", response_model=Dict[str, Any])
+async def get_stream_token(current_user = Depends(get_current_active_user)):
+    """
+    Issue a short-lived token for opening the notification stream
+
+    Browsers' EventSource can't send an Authorization header, so clients pass
+    this token as `?token=` instead, fetching a new one for each connection.
+    """
+    return {"token": create_stream_token(current_user), "expires_in": STREAM_TOKEN_SECONDS}
+
+@stream_router.get("/stream")
+async def stream_notifications(request: Request, current_user = Depends(get_stream_user)):
+    """
+    Stream new notifications for the current user as Server-Sent Events
+
+    Each notification is sent as a `notification` event carrying the same JSON
+    as the list endpoint. Clients fetch the list once on connect and then only
+    listen, instead of polling. Authenticate with a token from /stream-token
+    in the `token` query parameter, or with the usual Authorization header.
+    """
+    user_id = str(current_user["_id"])
+    
+    async def events():
+        queue = notification_broker.subscribe(user_id)
+        try:
+            yield "retry: 5000\n\n"
+            while not await request.is_disconnected():
+                try:
+                    notification = await asyncio.wait_for(queue.get(), STREAM_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                
+                payload = convert_mongo_doc_to_json(notification)
+                yield f"id: {payload['_id']}\nevent: notification\ndata: {json.dumps(payload)}\n\n"
+        finally:
+            notification_broker.unsubscribe(user_id, queue)
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @router.patch("/{notification_id}/read", response_model=Dict[str, Any])
 async def mark_notification_read(
     notification_id: str,
@@ -128,10 +230,16 @@ async def mark_notification_read(
             detail="You can only update your own notifications"
         )
     
-    await notifications_collection.update_one(
-        {"_id": ObjectId(notification_id)},
-        {"$set": {"read": True}}
-    )
+    async def write(session):
+        result = await notifications_collection.update_one(
+            {"_id": ObjectId(notification_id), "read": False},
+            {"$set": {"read": True, "read_at": datetime.utcnow()}},
+            session=session
+        )
+        if result.modified_count:
+            await record_notifications_read(notification["user_id"], 1, session=session)
+    
+    await run_in_transaction(write)
     
     updated_notification = await notifications_collection.find_one({"_id": ObjectId(notification_id)})
     return convert_mongo_doc_to_json(updated_notification)
@@ -139,12 +247,7 @@ async def mark_notification_read(
 @router.patch("/read-all", status_code=status.HTTP_204_NO_CONTENT)
 async def mark_all_notifications_read(current_user = Depends(get_current_active_user)):
     """Mark all notifications as read for the current user"""
-    notifications_collection = get_collection("notifications")
-    
-    await notifications_collection.update_many(
-        {"user_id": str(current_user["_id"]), "read": False},
-        {"$set": {"read": True}}
-    )
+    await mark_all_read(str(current_user["_id"]))
     
     return None
 
@@ -169,16 +272,22 @@ async def delete_notification(
             detail="You can only delete your own notifications"
         )
     
-    await notifications_collection.delete_one({"_id": ObjectId(notification_id)})
+    async def write(session):
+        # Counted as it is at deletion, in case it was read meanwhile
+        deleted = await notifications_collection.find_one_and_delete({"_id": ObjectId(notification_id)}, session=session)
+        if deleted:
+            await record_notifications_removed([deleted], session=session)
+    
+    await run_in_transaction(write)
     
     return None
 
 @router.delete("/", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_all_notifications(current_user = Depends(get_current_active_user)):
     """Delete all notifications for the current user"""
-    notifications_collection = get_collection("notifications")
-    
-    await notifications_collection.delete_many({"user_id": str(current_user["_id"])})
+    await delete_all(str(current_user["_id"]))
+    # Recounted rather than zeroed, so notifications inserted meanwhile stay counted
+    await rebuild_notification_counts(str(current_user["_id"]))
     
     return None
 
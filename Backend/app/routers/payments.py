@@ -4,9 +4,15 @@ from bson import ObjectId
 from datetime import datetime
 
 from ..core.auth import get_current_active_user
-from ..core.database import get_collection
+from ..core.database import get_collection, run_in_transaction
 from ..models.payments import Payment, PaymentCreate, PaymentMethod
-from ..utils.notification_utils import send_payment_notifications
+from ..utils.notification_utils import notification_event, payment_notifications
+from ..utils.outbox import add_outbox_events
+from ..utils.installment_utils import (
+    complete_next_installment, is_normalized, load_installments, loan_guard, LoanChangedError, PAYMENT_ATTEMPTS,
+    set_installments_loan_status
+)
+from ..utils.portfolio_utils import record_loan_payment, record_overdue_change
 
 router = APIRouter(
     prefix="/payments",
@@ -70,45 +76,78 @@ async def create_payment(
         "created_at": datetime.utcnow()
     }
     
-    # Insert payment record
-    payment_result = await payments_collection.insert_one(payment_document)
-    payment_document["_id"] = payment_result.inserted_id
-    
-    # Update loan payment status and remaining amount
-    total_paid = loan.get("total_paid", 0) + payment_document["amount"]
-    remaining_amount = loan["total_amount"] - total_paid if "total_amount" in loan else 0
+    payment_document["_id"] = ObjectId()
     
-    # If remaining amount is zero or negative, mark loan as completed
-    new_status = loan["status"]
-    if remaining_amount <= 0 and loan["status"] != "COMPLETED":
-        new_status = "COMPLETED"
+    # The payment, the loan update and the notification event are committed together
+    events = [notification_event(payment_notifications(payment_document, loan))]
     
-    # Update loan with payment information
-    await loans_collection.update_one(
-        {"_id": ObjectId(loan_id)},
-        {
+    async def apply_payment(loan):
+        # Update loan payment status and remaining amount
+        total_paid = loan.get("total_paid", 0) + payment_document["amount"]
+        remaining_amount = loan["total_amount"] - total_paid if "total_amount" in loan else 0
+        
+        # If remaining amount is zero or negative, mark loan as completed
+        new_status = loan["status"]
+        if remaining_amount <= 0 and loan["status"] != "COMPLETED":
+            new_status = "COMPLETED"
+        
+        # Update loan with payment information
+        loan_update = {
             "$set": {
                 "total_paid": total_paid,
                 "remaining_amount": remaining_amount,
                 "status": new_status,
                 "updated_at": datetime.utcnow()
-            },
-            "$push": {
+            }
+        }
+        if not is_normalized(loan):
+            loan_update["$push"] = {
                 "payments": {
-                    "payment_id": str(payment_result.inserted_id),
+                    "payment_id": str(payment_document["_id"]),
                     "amount": payment_document["amount"],
                     "status": "COMPLETED",
                     "payment_date": payment_document["created_at"]
                 }
             }
-        }
-    )
+        
+        async def write(session):
+            # Only applies to the loan as it was read; otherwise the payment is recomputed
+            result = await loans_collection.update_one(loan_guard(loan), loan_update, session=session)
+            if not result.matched_count:
+                raise LoanChangedError(f"Loan {loan_id} changed while recording a payment")
+            
+            await payments_collection.insert_one(payment_document, session=session)
+            installment = None
+            if is_normalized(loan):
+                # Normalized schedules record the payment on the installment it settles
+                installment = await complete_next_installment(
+                    loan, payment_document["created_at"], payment_document["method"], session=session
+                )
+                await set_installments_loan_status(loan, new_status, session=session)
+            await add_outbox_events(events, session=session)
+            
+            await record_loan_payment(loan, payment_document["amount"], new_status, payment_document["created_at"], session=session)
+            if installment and installment.get("late_since"):
+                await record_overdue_change(loan.get("lender_id"), -1, session=session)
+        
+        await run_in_transaction(write)
     
-    # Send payment notifications
-    await send_payment_notifications(payment_document, loan)
+    # A loan that took another payment or had its schedule migrated since it
+    # was read is read again, so the payment lands where the schedule now lives
+    for _ in range(PAYMENT_ATTEMPTS):
+        try:
+            await apply_payment(loan)
+            break
+        except LoanChangedError:
+            loan = await loans_collection.find_one({"_id": ObjectId(loan_id)})
+    else:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="The loan was updated at the same time, please try again"
+        )
     
     # Return the created payment with id
-    payment_document["_id"] = str(payment_result.inserted_id)
+    payment_document["_id"] = str(payment_document["_id"])
     return payment_document
 
 @router.get("/")
@@ -180,16 +219,17 @@ async def get_payments(
     # If no payments found in payments collection, look in the loan's payments array
     if len(payments) == 0 and loan_id:
         loan = await loans_collection.find_one({"_id": ObjectId(loan_id)})
-        if loan and "payments" in loan and loan["payments"]:
-            # Format payments from loan's payments array
-            for i, payment in enumerate(loan["payments"]):
+        schedule = await load_installments(loan) if loan else []
+        if schedule:
+            # Format payments from loan's payment schedule
+            for i, payment in enumerate(schedule):
                 payment["_id"] = f"loan-payment-{i}"
                 payment["loan_id"] = loan_id
                 if "payment_date" not in payment and "due_date" in payment:
                     payment["payment_date"] = payment["due_date"]
                 if "user_id" not in payment:
                     payment["user_id"] = loan["borrower_id"]
-            payments = loan["payments"]
+            payments = schedule
     
     # Convert ObjectId to string
     for payment in payments:
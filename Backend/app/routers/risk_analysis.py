@@ -8,6 +8,7 @@ import random
 
 from ..core.auth import get_current_active_user
 from ..core.database import get_collection
+from ..utils.installment_utils import is_normalized
 from ..models.risk_analysis import RiskAnalysisRequest, RiskAnalysisResponse, RiskFactor, RiskLevel
 from .loanmodel_inference import predict_risk
 
@@ -68,6 +69,16 @@ async def get_borrower_risk_data(
     total_on_time_payments = len([payment for payment in payments if payment.get("status") == "PAID"])
     total_late_payments = len([payment for payment in payments if payment.get("status") in ["LATE", "MISSED"]])
     
+    # Installments the overdue job flagged, including ones paid late afterwards
+    installments_collection = get_collection("installments")
+    total_late_payments += await installments_collection.count_documents(
+        {"borrower_id": borrower_id, "late_since": {"$exists": True}}
+    )
+    total_late_payments += len([
+        payment for loan in loans if not is_normalized(loan)
+        for payment in loan.get("payments", []) if payment.get("late_since")
+    ])
+    
     # Extract borrower profile data
     try:
         # Try to extract age from date of birth if available
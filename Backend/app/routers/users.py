@@ -6,6 +6,7 @@ from datetime import datetime
 from ..core.auth import get_current_active_user, get_password_hash, verify_password
 from ..core.database import get_collection
 from ..models.user import UserUpdate, PasswordChange
+from ..utils.storage import document_key, document_url
 
 router = APIRouter(
     prefix="/users",
@@ -23,6 +24,14 @@ async def get_current_user_profile(current_user = Depends(get_current_active_use
     user_doc["id"] = str(user_doc.pop("_id"))
     return user_doc
 
+@router.get("/me/documents", response_model=list)
+async def get_my_documents(current_user = Depends(get_current_active_user)):
+    """Short-lived download links for the documents uploaded at registration"""
+    return [
+        {"key": document_key(path), "url": document_url(path)}
+        for path in current_user.get("document_uploads") or []
+    ]
+
 @router.put("/me", response_model=dict)
 async def update_user_profile(
     user_update: UserUpdate,
@@ -0,0 +1,49 @@
+"""
+Full-text search over advertisements.
+
+Ads are searched through a Mongo text index over the shop name, loan types
+and description, weighted so that a match in the shop name ranks above one
+in the loan types, which ranks above one in the description. Results are
+ordered by text score, newest first among equal scores, and can be narrowed
+with the same district/city/loan type/interest filters as the listing.
+"""
+from typing import List, Optional
+
+TEXT_INDEX_NAME = "advertisement_text"
+TEXT_INDEX_KEYS = [("shop_name", "text"), ("loan_types", "text"), ("description", "text")]
+TEXT_INDEX_WEIGHTS = {"shop_name": 10, "loan_types": 5, "description": 1}
+
+async def ensure_text_index(collection):
+    await collection.create_index(
+        TEXT_INDEX_KEYS,
+        name=TEXT_INDEX_NAME,
+        weights=TEXT_INDEX_WEIGHTS,
+        default_language="english"
+    )
+
+def search_query(
+    q: str,
+    district: Optional[str] = None,
+    city: Optional[str] = None,
+    loan_type: Optional[str] = None,
+    max_interest_rate: Optional[float] = None
+) -> dict:
+    """Filter for published ads matching the search terms and the listing filters"""
+    query = {"$text": {"$search": q}, "published": {"$ne": False}}
+    if district:
+        query["location.district"] = district
+    if city:
+        query["location.city"] = city
+    if loan_type:
+        query["loan_types"] = loan_type
+    if max_interest_rate is not None:
+        query["interest_rate"] = {"$lte": max_interest_rate}
+    return query
+
+async def search(collection, q: str, limit: int = 20, offset: int = 0, **filters) -> List[dict]:
+    """Matching ads, most relevant first, each with its text `score`"""
+    cursor = collection.find(
+        search_query(q, **filters),
+        {"score": {"$meta": "textScore"}}
+    ).sort([("score", {"$meta": "textScore"}), ("created_at", -1)]).skip(offset).limit(limit)
+    return await cursor.to_list(length=limit)
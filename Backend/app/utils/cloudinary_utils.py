@@ -1,45 +1,107 @@
 import cloudinary
+import cloudinary.api
 import cloudinary.uploader
-from typing import List, Optional, Dict, Any
-import uuid
+from typing import Dict, Any
 
-def upload_image(file_data: bytes, folder: str = "advertisements") -> Dict[str, Any]:
+UPLOAD_TIMEOUT_SECONDS = 30
+LARGE_UPLOAD_TIMEOUT_SECONDS = 300
+
+# Size of the chunks upload_large sends; Cloudinary requires at least 5 MB
+LARGE_UPLOAD_CHUNK_SIZE = 6 * 1024 * 1024
+
+def upload_image(file_data: bytes, public_id: str, resource_type: str = "image") -> Dict[str, Any]:
     """
-    Upload an image to Cloudinary
+    Upload a file to Cloudinary
     
     Args:
-        file_data: The image binary data
-        folder: The folder in Cloudinary to store the image
+        file_data: The file binary data
+        public_id: The public ID (folder/name) to store the file under
+        resource_type: "image" for photos, "raw" for other files such as documents
         
     Returns:
-        Dict containing image URL and other info
+        Dict containing the file URL and other info
     """
-    public_id = f"{folder}/{uuid.uuid4()}"
-    
     result = cloudinary.uploader.upload(
         file_data,
         public_id=public_id,
-        folder=folder,
-        resource_type="auto"
+        resource_type=resource_type,
+        timeout=UPLOAD_TIMEOUT_SECONDS
     )
     
     return {
         "url": result["secure_url"],
         "public_id": result["public_id"],
-        "width": result["width"],
-        "height": result["height"],
-        "format": result["format"]
+        "width": result.get("width"),
+        "height": result.get("height"),
+        "format": result.get("format")
+    }
+
+def upload_large_file(path: str, public_id: str, resource_type: str = "raw") -> Dict[str, Any]:
+    """
+    Upload a file from disk to Cloudinary in chunks, so it is never read into memory whole
+    
+    Args:
+        path: Path of the local file
+        public_id: The public ID (folder/name) to store the file under
+        resource_type: "image" for photos, "raw" for other files such as documents
+        
+    Returns:
+        Dict containing the file URL and public ID
+    """
+    result = cloudinary.uploader.upload_large(
+        path,
+        public_id=public_id,
+        resource_type=resource_type,
+        chunk_size=LARGE_UPLOAD_CHUNK_SIZE,
+        timeout=LARGE_UPLOAD_TIMEOUT_SECONDS
+    )
+    
+    return {
+        "url": result["secure_url"],
+        "public_id": result["public_id"]
     }
 
-def delete_image(public_id: str) -> Dict[str, Any]:
+def delete_image(public_id: str, resource_type: str = "image") -> Dict[str, Any]:
     """
-    Delete an image from Cloudinary
+    Delete a file from Cloudinary
     
     Args:
-        public_id: The public ID of the image to delete
+        public_id: The public ID of the file to delete
+        resource_type: The resource type it was uploaded as
         
     Returns:
         Dict containing the result of the deletion
     """
-    result = cloudinary.uploader.destroy(public_id)
-    return result
\ No newline at end of file
+    result = cloudinary.uploader.destroy(public_id, resource_type=resource_type, timeout=UPLOAD_TIMEOUT_SECONDS)
+    return result
+
+def list_resources(prefix: str, resource_type: str = "image", max_results: int = 500, next_cursor: str = None) -> Dict[str, Any]:
+    """
+    List uploaded files whose public ID starts with a prefix
+    
+    Args:
+        prefix: Public ID prefix, e.g. a folder followed by "/"
+        resource_type: The resource type to list
+        max_results: Page size (at most 500)
+        next_cursor: Cursor of the next page, from the previous page's "next_cursor"
+        
+    Returns:
+        Dict with the page's "resources" and, if there are more, a "next_cursor"
+    """
+    options = {"type": "upload", "prefix": prefix, "resource_type": resource_type, "max_results": max_results,
+               "timeout": UPLOAD_TIMEOUT_SECONDS}
+    if next_cursor:
+        options["next_cursor"] = next_cursor
+    return cloudinary.api.resources(**options)
+
+def public_id_from_url(url: str, with_extension: bool = False) -> str:
+    """
+    Recover the public ID of a file from its delivery URL, i.e. the path after
+    the upload type and optional version segment
+    """
+    path = url.split("?")[0].split("/upload/", 1)[-1]
+    parts = path.split("/")
+    if parts[0].startswith("v") and parts[0][1:].isdigit():
+        parts = parts[1:]
+    public_id = "/".join(parts)
+    return public_id if with_extension else public_id.rsplit(".", 1)[0]
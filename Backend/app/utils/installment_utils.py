@@ -0,0 +1,322 @@
+import zlib
+from datetime import datetime
+from typing import List, Tuple
+from pymongo import ASCENDING, ReturnDocument, UpdateOne
+
+from ..core.database import get_collection
+
+# Fields copied from an installment document when it is presented as a schedule entry
+SCHEDULE_FIELDS = ["seq", "amount", "principal", "interest", "due_date", "status", "payment_date", "method", "late_fee"]
+
+# Installments still waiting to be paid; LATE and MISSED are set by the overdue job
+UNPAID_INSTALLMENT_STATUSES = ["PENDING", "LATE", "MISSED"]
+
+# Only installments of loans in these states go overdue; installments carry
+# the loan's state as `loan_active` so the overdue job can filter on it
+ACTIVE_LOAN_STATUSES = ["ACTIVE", "APPROVED"]
+
+# Times a loan that changed while being migrated is read again and retried
+MIGRATION_ATTEMPTS = 3
+
+# Times a payment on a loan that changed since it was read is recomputed
+PAYMENT_ATTEMPTS = 3
+
+# Installments carry a stable slot derived from their loan; scans split across
+# workers give each worker a contiguous range of slots, so its query is a
+# range on an index instead of a filter over every installment
+SHARD_SLOTS = 4096
+
+def shard_slot(loan_id) -> int:
+    return zlib.crc32(str(loan_id).encode()) % SHARD_SLOTS
+
+def shard_slot_range(shard_index: int, shard_count: int) -> Tuple[int, int]:
+    """The [start, end) range of slots owned by one of `shard_count` shards"""
+    return shard_index * SHARD_SLOTS // shard_count, (shard_index + 1) * SHARD_SLOTS // shard_count
+
+def shard_of(loan_id, shard_count: int) -> int:
+    """Shard a loan belongs to when a scan is split across `shard_count` workers"""
+    return shard_slot(loan_id) * shard_count // SHARD_SLOTS
+
+def is_normalized(loan: dict) -> bool:
+    """Whether a loan's schedule lives in the installments collection"""
+    return bool(loan.get("installments_normalized"))
+
+class LoanChangedError(Exception):
+    """Raised when a loan changed between being read and written"""
+
+def loan_guard(loan: dict) -> dict:
+    """
+    Filter matching a loan only while it is as it was read.
+
+    A payment applied in between changes `total_paid`, and a migration in
+    between moves the schedule, so either makes the filter match nothing.
+    """
+    return {
+        "_id": loan["_id"],
+        "total_paid": loan.get("total_paid"),
+        "installments_normalized": True if is_normalized(loan) else {"$ne": True}
+    }
+
+def installment_documents(loan_id: str, loan: dict, payments: List[dict]) -> List[dict]:
+    """Turn a loan's schedule entries into installments collection documents"""
+    documents = []
+    for seq, payment in enumerate(payments):
+        document = {
+            "loan_id": loan_id,
+            "seq": seq,
+            "shard_slot": shard_slot(loan_id),
+            "loan_active": loan.get("status") in ACTIVE_LOAN_STATUSES,
+            "borrower_id": loan.get("borrower_id"),
+            "lender_id": loan.get("lender_id"),
+            "lender_name": loan.get("lender_name"),
+            "amount": payment.get("amount", 0),
+            "due_date": payment.get("due_date"),
+            "status": payment.get("status", "PENDING")
+        }
+        for field in ["principal", "interest", "payment_date", "method", "payment_id"]:
+            if payment.get(field) is not None:
+                document[field] = payment[field]
+        documents.append(document)
+    return documents
+
+def _as_schedule_entry(installment: dict) -> dict:
+    return {field: installment[field] for field in SCHEDULE_FIELDS if field in installment}
+
+async def create_installments(loan_id: str, loan: dict, payments: List[dict], session=None):
+    """Store the schedule of a newly created loan"""
+    documents = installment_documents(loan_id, loan, payments)
+    if documents:
+        await get_collection("installments").insert_many(documents, ordered=False, session=session)
+
+async def set_installments_loan_status(loan: dict, new_status: str, session=None):
+    """Keep `loan_active` on a normalized loan's installments in step with a change of the loan's status"""
+    is_active = new_status in ACTIVE_LOAN_STATUSES
+    if not is_normalized(loan) or (loan.get("status") in ACTIVE_LOAN_STATUSES) == is_active:
+        return
+    await get_collection("installments").update_many(
+        {"loan_id": str(loan["_id"])},
+        {"$set": {"loan_active": is_active}},
+        session=session
+    )
+
+async def sync_installments_loan_status(batch_size: int = 1000, changed_since: datetime = None) -> int:
+    """
+    Correct `loan_active` on the installments of normalized loans, and
+    set it on installments written before it existed.
+
+    With `changed_since`, only loans updated from then on are checked; every
+    change of a loan's status also sets its `updated_at`.
+    Returns the number of installments changed.
+    """
+    loans_collection = get_collection("loans")
+    installments_collection = get_collection("installments")
+
+    changed = 0
+    last_id = None
+    while True:
+        query = {"installments_normalized": True}
+        if changed_since is not None:
+            query["updated_at"] = {"$gte": changed_since}
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+        loans = await loans_collection.find(query, {"status": 1}).sort("_id", ASCENDING).limit(batch_size).to_list(length=batch_size)
+        if not loans:
+            return changed
+        last_id = loans[-1]["_id"]
+
+        for is_active in (True, False):
+            loan_ids = [str(loan["_id"]) for loan in loans if (loan.get("status") in ACTIVE_LOAN_STATUSES) == is_active]
+            if loan_ids:
+                result = await installments_collection.update_many(
+                    {"loan_id": {"$in": loan_ids}, "loan_active": {"$ne": is_active}},
+                    {"$set": {"loan_active": is_active}}
+                )
+                changed += result.modified_count
+
+async def load_installments(loan: dict) -> List[dict]:
+    """
+    Read a loan's schedule, wherever it is stored.
+
+    Loans created before the installments collection existed still carry their
+    schedule in the embedded `payments` array until they are migrated.
+    """
+    if not is_normalized(loan):
+        return loan.get("payments", [])
+
+    cursor = get_collection("installments").find({"loan_id": str(loan["_id"])}).sort("seq", ASCENDING)
+    return [_as_schedule_entry(installment) async for installment in cursor]
+
+async def attach_installments(loans: List[dict]) -> List[dict]:
+    """
+    Fill in `payments` on normalized loans so API responses keep their shape.
+
+    All schedules are fetched with a single query regardless of the number of loans.
+    """
+    normalized = {str(loan["_id"]): loan for loan in loans if is_normalized(loan)}
+    if not normalized:
+        return loans
+
+    for loan in normalized.values():
+        loan["payments"] = []
+
+    cursor = get_collection("installments").find(
+        {"loan_id": {"$in": list(normalized.keys())}}
+    ).sort([("loan_id", ASCENDING), ("seq", ASCENDING)])
+    async for installment in cursor:
+        normalized[installment["loan_id"]]["payments"].append(_as_schedule_entry(installment))
+
+    return loans
+
+async def complete_next_installment(loan: dict, payment_date, method: str, session=None):
+    """
+    Mark the earliest unpaid installment of a normalized loan as paid.
+
+    Returns the updated installment, or None if nothing was left to pay.
+    Installments that were overdue keep their `late_since` date.
+    """
+    return await get_collection("installments").find_one_and_update(
+        {"loan_id": str(loan["_id"]), "status": {"$in": UNPAID_INSTALLMENT_STATUSES}},
+        {"$set": {"status": "COMPLETED", "payment_date": payment_date, "method": method}},
+        sort=[("seq", ASCENDING)],
+        return_document=ReturnDocument.AFTER,
+        session=session
+    )
+
+def lookup_installments_stages(as_field: str = "payments") -> List[dict]:
+    """
+    Aggregation stages that resolve `as_field` to a loan's schedule for both
+    normalized and embedded loans, so pipelines can keep reading `$payments`.
+    """
+    return [
+        {"$lookup": {
+            "from": "installments",
+            "let": {"loan_id": {"$toString": "$_id"}},
+            "pipeline": [
+                {"$match": {"$expr": {"$eq": ["$loan_id", "$$loan_id"]}}},
+                {"$sort": {"seq": 1}},
+                {"$project": {"_id": 0, **{field: 1 for field in SCHEDULE_FIELDS}}}
+            ],
+            "as": "_installments"
+        }},
+        {"$addFields": {as_field: {"$cond": [
+            {"$eq": ["$installments_normalized", True]},
+            "$_installments",
+            {"$ifNull": ["$payments", []]}
+        ]}}},
+        {"$project": {"_installments": 0}}
+    ]
+
+async def _migrate_loans(loans: List[dict], keep_embedded: bool) -> List:
+    """
+    Copy the schedules of a batch of loans into the installments collection
+    and flag the loans as normalized.
+
+    A loan is only flagged if its `payments` and `updated_at` are still what
+    was read, so a payment recorded on the embedded array in the meantime is
+    never lost. Returns the ids of the loans that changed and weren't flagged.
+    """
+    loans_collection = get_collection("loans")
+    installments_collection = get_collection("installments")
+
+    operations = []
+    for loan in loans:
+        payments = loan.get("payments") or []
+        for document in installment_documents(str(loan["_id"]), loan, payments):
+            operations.append(UpdateOne(
+                {"loan_id": document["loan_id"], "seq": document["seq"]},
+                {"$set": document},
+                upsert=True
+            ))
+    if operations:
+        await installments_collection.bulk_write(operations, ordered=False)
+
+    changed = []
+    for loan in loans:
+        # Left over from an earlier attempt against a longer schedule
+        await installments_collection.delete_many(
+            {"loan_id": str(loan["_id"]), "seq": {"$gte": len(loan.get("payments") or [])}}
+        )
+
+        loan_update = {"$set": {"installments_normalized": True, "updated_at": datetime.utcnow()}}
+        if not keep_embedded:
+            loan_update["$unset"] = {"payments": ""}
+        result = await loans_collection.update_one(
+            {
+                "_id": loan["_id"],
+                "installments_normalized": {"$ne": True},
+                "payments": loan.get("payments"),
+                "updated_at": loan.get("updated_at")
+            },
+            loan_update
+        )
+        if not result.modified_count:
+            changed.append(loan["_id"])
+    return changed
+
+async def migrate_embedded_installments(batch_size: int = 500, keep_embedded: bool = False) -> int:
+    """
+    Move embedded `payments` schedules into the installments collection.
+
+    Safe to re-run: installments are upserted on (loan_id, seq) and a loan is
+    only flagged as normalized once its installments are written. Loans that
+    change while being migrated are read again and retried.
+    Returns the number of loans migrated.
+    """
+    loans_collection = get_collection("loans")
+    projection = {"payments": 1, "borrower_id": 1, "lender_id": 1, "lender_name": 1, "updated_at": 1}
+
+    migrated = 0
+    skipped = 0
+    last_id = None
+    while True:
+        query = {"installments_normalized": {"$ne": True}}
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+
+        cursor = loans_collection.find(query, projection)
+        loans = await cursor.sort("_id", ASCENDING).limit(batch_size).to_list(length=batch_size)
+        if not loans:
+            break
+        last_id = loans[-1]["_id"]
+
+        batch = loans
+        for _ in range(MIGRATION_ATTEMPTS):
+            changed = await _migrate_loans(batch, keep_embedded)
+            migrated += len(batch) - len(changed)
+            if not changed:
+                break
+            batch = await loans_collection.find(
+                {"_id": {"$in": changed}, "installments_normalized": {"$ne": True}}, projection
+            ).to_list(length=None)
+            if not batch:
+                break
+        else:
+            # Still changing; a later run picks them up
+            skipped += len(changed)
+
+        print(f"Migrated installments for {migrated} loans")
+
+    if skipped:
+        print(f"Skipped {skipped} loans that kept changing during the migration; re-run to migrate them")
+    return migrated
+
+async def backfill_shard_slots(batch_size: int = 1000) -> int:
+    """Set `shard_slot` on installments written before it existed. Returns the number updated."""
+    installments_collection = get_collection("installments")
+
+    updated = 0
+    while True:
+        installments = await installments_collection.find(
+            {"shard_slot": {"$exists": False}}, {"loan_id": 1}
+        ).limit(batch_size).to_list(length=batch_size)
+        if not installments:
+            break
+
+        await installments_collection.bulk_write([
+            UpdateOne({"_id": installment["_id"]}, {"$set": {"shard_slot": shard_slot(installment["loan_id"])}})
+            for installment in installments
+        ], ordered=False)
+        updated += len(installments)
+        print(f"Set shard slots on {updated} installments")
+
+    return updated
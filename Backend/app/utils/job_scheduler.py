@@ -0,0 +1,200 @@
+"""
+Background job scheduling shared by every API worker and scheduler.py.
+
+Each job is declared once in the registry. Whichever process holds the job's
+Mongo lease runs it, so a job runs once per interval no matter how many
+uvicorn workers or standalone schedulers are up.
+"""
+import asyncio
+import os
+import random
+import socket
+import time
+import uuid
+from datetime import datetime, timedelta
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from ..core.database import get_collection
+
+# Identifies this process as a lease owner
+OWNER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+# How often each process checks for due jobs
+TICK_SECONDS = 30
+
+class Job:
+    def __init__(self, name: str, func, interval: float, jitter: float = 0, lease_seconds: float = 600, retry_after: float = None):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.jitter = jitter
+        self.lease_seconds = lease_seconds
+        self.retry_after = retry_after
+
+    def next_run_after(self, when: datetime) -> datetime:
+        return when + timedelta(seconds=self.interval + random.uniform(0, self.jitter))
+
+JOBS = {}
+
+# Tasks of the jobs running in this process, by job name
+_running = {}
+
+def register_job(name: str, func, interval: float, jitter: float = 0, lease_seconds: float = 600, retry_after: float = None):
+    """
+    Declare a background job.
+
+    `func` is an async callable run every `interval` seconds plus up to
+    `jitter` random seconds. The lease is held for `lease_seconds` and renewed
+    while the job runs. A failed run is retried `retry_after` seconds after it
+    ended if set, otherwise at the next interval.
+    """
+    JOBS[name] = Job(name, func, interval, jitter, lease_seconds, retry_after)
+    return JOBS[name]
+
+async def acquire_lease(name: str, lease_seconds: float) -> bool:
+    """
+    Take (or renew) the lease on a job.
+
+    The lease document is only matched when it has expired or is already ours;
+    otherwise the upsert collides with the existing _id and the lease stays
+    with its current owner.
+    """
+    leases_collection = get_collection("job_leases")
+    now = datetime.utcnow()
+    try:
+        lease = await leases_collection.find_one_and_update(
+            {"_id": name, "$or": [{"expires_at": {"$lte": now}}, {"owner": OWNER_ID}]},
+            {"$set": {"owner": OWNER_ID, "expires_at": now + timedelta(seconds=lease_seconds), "acquired_at": now}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        return False
+    return lease is not None and lease.get("owner") == OWNER_ID
+
+async def release_lease(name: str):
+    leases_collection = get_collection("job_leases")
+    await leases_collection.delete_one({"_id": name, "owner": OWNER_ID})
+
+async def _renew_lease(job: Job, task: asyncio.Task):
+    """
+    Keep the lease alive while a long job is running.
+
+    If the lease is lost, or can't be renewed before it expires, another
+    process may already be running the job, so this run is cancelled.
+    """
+    renewed_at = time.monotonic()
+    while True:
+        await asyncio.sleep(job.lease_seconds / 3)
+        try:
+            if await acquire_lease(job.name, job.lease_seconds):
+                renewed_at = time.monotonic()
+                continue
+            print(f"Lost lease on job {job.name}, cancelling it")
+        except Exception as e:
+            if time.monotonic() - renewed_at < job.lease_seconds * 2 / 3:
+                print(f"Error renewing lease on job {job.name}: {str(e)}")
+                continue
+            print(f"Could not renew lease on job {job.name} before it expired, cancelling it: {str(e)}")
+        task.cancel()
+        return
+
+async def _record_run(job: Job, started_at: datetime, duration: float, error: str = None):
+    """Store last/next run times and duration metrics for a job"""
+    runs_collection = get_collection("job_runs")
+    if error and job.retry_after is not None:
+        next_run_at = datetime.utcnow() + timedelta(seconds=job.retry_after)
+    else:
+        next_run_at = job.next_run_after(started_at)
+    await runs_collection.update_one(
+        {"_id": job.name},
+        {
+            "$set": {
+                "last_run_at": started_at,
+                "next_run_at": next_run_at,
+                "last_duration_seconds": duration,
+                "last_status": "failed" if error else "succeeded",
+                "last_error": error,
+                "last_owner": OWNER_ID
+            },
+            "$inc": {
+                "run_count": 1,
+                "failure_count": 1 if error else 0,
+                "total_duration_seconds": duration
+            },
+            "$max": {"max_duration_seconds": duration}
+        },
+        upsert=True
+    )
+
+async def run_job(job: Job) -> bool:
+    """Run a job if this process can take its lease. Returns whether it ran."""
+    if not await acquire_lease(job.name, job.lease_seconds):
+        return False
+
+    # Another process may have finished a run between our due check and taking the lease
+    run = await get_collection("job_runs").find_one({"_id": job.name})
+    if run and run.get("next_run_at") and run["next_run_at"] > datetime.utcnow():
+        await release_lease(job.name)
+        return False
+
+    started_at = datetime.utcnow()
+    started = time.perf_counter()
+    task = asyncio.create_task(job.func())
+    renewal = asyncio.create_task(_renew_lease(job, task))
+    error = None
+    try:
+        await task
+    except asyncio.CancelledError:
+        # Cancelling run_job cancels the job too and propagates; a lost lease only ends this run
+        if not (renewal.done() and task.cancelled()):
+            raise
+        error = "Lease lost"
+    except Exception as e:
+        error = str(e)
+        print(f"Error in scheduled job {job.name}: {error}")
+    finally:
+        renewal.cancel()
+        duration = time.perf_counter() - started
+        await _record_run(job, started_at, duration, error)
+        await release_lease(job.name)
+
+    print(f"Scheduled job {job.name} finished in {duration:.2f}s")
+    return True
+
+async def run_due_jobs():
+    """
+    Start every registered job whose next run time has passed.
+
+    Each job runs as its own task, so a long job doesn't hold up the others;
+    a job still running in this process isn't started again.
+    """
+    runs_collection = get_collection("job_runs")
+    runs = {run["_id"]: run async for run in runs_collection.find({"_id": {"$in": list(JOBS)}})}
+    now = datetime.utcnow()
+
+    for job in JOBS.values():
+        if job.name in _running:
+            continue
+        next_run_at = runs.get(job.name, {}).get("next_run_at")
+        if next_run_at is None or next_run_at <= now:
+            _running[job.name] = asyncio.create_task(run_job(job))
+            _running[job.name].add_done_callback(lambda _, name=job.name: _running.pop(name, None))
+
+async def run_scheduler():
+    """
+    Scheduler loop, safe to start in every process
+    """
+    print(f"Starting job scheduler as {OWNER_ID} with jobs: {', '.join(JOBS)}")
+    try:
+        while True:
+            try:
+                await run_due_jobs()
+            except Exception as e:
+                print(f"Error in job scheduler: {e}")
+
+            await asyncio.sleep(TICK_SECONDS + random.uniform(0, TICK_SECONDS / 3))
+    finally:
+        for task in list(_running.values()):
+            task.cancel()
@@ -0,0 +1,98 @@
+"""
+Cache of public advertisement listings.
+
+A listing depends only on its filters, so each worker keeps recent results
+keyed on the normalized filter set and serves them to every user. Per-user
+fields (is_owner) are added by the caller after the lookup.
+
+Any change to an ad bumps a version number stored in `cache_versions`. A
+worker rereads that version at most every few seconds and drops entries
+cached under an older one, so a change made through any worker shows up in
+every worker's listings within that delay.
+"""
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+from pymongo import ReturnDocument
+
+from ..core.database import get_collection
+
+# How long a listing is served from memory at most, even without changes
+LISTING_CACHE_SECONDS = 60
+
+# How often a worker checks whether another worker changed an ad
+LISTING_VERSION_CHECK_SECONDS = 2
+
+# Distinct filter sets kept per worker; the least recently used are dropped
+LISTING_CACHE_SIZE = 256
+
+VERSION_ID = "advertisements"
+
+_entries = OrderedDict()
+_version = {"value": None, "checked_at": 0.0}
+
+def listing_key(
+    district: Optional[str] = None,
+    city: Optional[str] = None,
+    loan_type: Optional[str] = None,
+    max_interest_rate: Optional[float] = None
+) -> tuple:
+    """Cache key of a filter set; blank filters are the same as missing ones"""
+    return (
+        (district or "").strip() or None,
+        (city or "").strip() or None,
+        (loan_type or "").strip() or None,
+        float(max_interest_rate) if max_interest_rate is not None else None
+    )
+
+def _etag(key: tuple, ads: List[dict]) -> str:
+    digest = hashlib.sha1(repr(key).encode())
+    for ad in ads:
+        digest.update(f"{ad['_id']}:{ad.get('updated_at')}".encode())
+    return digest.hexdigest()[:20]
+
+async def _current_version() -> int:
+    now = time.monotonic()
+    if _version["value"] is None or now - _version["checked_at"] >= LISTING_VERSION_CHECK_SECONDS:
+        doc = await get_collection("cache_versions").find_one({"_id": VERSION_ID})
+        _version["value"] = doc["version"] if doc else 0
+        _version["checked_at"] = now
+    return _version["value"]
+
+async def get_listing(key: tuple, load: Callable[[], Awaitable[List[dict]]]) -> Tuple[List[dict], str]:
+    """
+    The cached ads and ETag for a filter set, loading them with `load` on a miss.
+
+    The returned ads are shared between requests and must not be modified.
+    """
+    version = await _current_version()
+    entry = _entries.get(key)
+    if entry and entry[0] == version and entry[1] > time.monotonic():
+        _entries.move_to_end(key)
+        return entry[2], entry[3]
+
+    ads = await load()
+    etag = _etag(key, ads)
+    _entries[key] = (version, time.monotonic() + LISTING_CACHE_SECONDS, ads, etag)
+    _entries.move_to_end(key)
+    while len(_entries) > LISTING_CACHE_SIZE:
+        _entries.popitem(last=False)
+    return ads, etag
+
+async def invalidate_listings():
+    """Call after creating, changing or deleting an ad"""
+    _entries.clear()
+    try:
+        doc = await get_collection("cache_versions").find_one_and_update(
+            {"_id": VERSION_ID},
+            {"$inc": {"version": 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        _version["value"] = doc["version"]
+        _version["checked_at"] = time.monotonic()
+    except Exception as e:
+        # Other workers catch up once their entries expire
+        print(f"Error invalidating advertisement listings: {str(e)}")
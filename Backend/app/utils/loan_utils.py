@@ -1,10 +1,164 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from typing import Optional
-from bson import ObjectId
-from datetime import datetime
+import asyncio
 
 from ..core.auth import get_current_active_user
 from ..core.database import get_collection
+from .installment_utils import attach_installments, lookup_installments_stages, UNPAID_INSTALLMENT_STATUSES
+
+ACTIVE_LOAN_STATUSES = ["ACTIVE", "APPROVED"]
+
+def _borrower_summary_pipeline(borrower_id: str):
+    """
+    Build the aggregation that computes the loan side of the borrower dashboard in one round-trip.
+
+    Each $facet branch replaces one of the Python passes the summary used to make
+    over the loans.
+    """
+    is_active = {"$in": ["$status", ACTIVE_LOAN_STATUSES]}
+    lender_name = {"$ifNull": ["$lender_name", "Unknown Lender"]}
+    pending_payments = {
+        "$filter": {
+            "input": {"$ifNull": ["$payments", []]},
+            "as": "payment",
+            "cond": {"$in": ["$$payment.status", UNPAID_INSTALLMENT_STATUSES]}
+        }
+    }
+
+    return [
+        {"$match": {"borrower_id": borrower_id}},
+        *lookup_installments_stages(),
+        {"$facet": {
+            "stats": [
+                {"$group": {
+                    "_id": None,
+                    "activeLoans": {"$sum": {"$cond": [is_active, 1, 0]}},
+                    "completedLoans": {"$sum": {"$cond": [{"$eq": ["$status", "COMPLETED"]}, 1, 0]}},
+                    "totalBorrowed": {"$sum": {"$ifNull": ["$amount", 0]}},
+                    "currentBalance": {"$sum": {"$cond": [is_active, {"$ifNull": ["$remaining_amount", 0]}, 0]}},
+                    "totalPaid": {"$sum": {"$ifNull": ["$total_paid", 0]}}
+                }},
+                {"$project": {"_id": 0}}
+            ],
+            # The first pending installment of each active loan, earliest one wins
+            "nextPayment": [
+                {"$match": {"status": {"$in": ACTIVE_LOAN_STATUSES}}},
+                {"$project": {"next": {"$arrayElemAt": [pending_payments, 0]}}},
+                {"$match": {"next.due_date": {"$ne": None}}},
+                {"$sort": {"next.due_date": 1}},
+                {"$limit": 1},
+                {"$project": {
+                    "_id": 0,
+                    "dueDate": "$next.due_date",
+                    "amount": {"$ifNull": ["$next.amount", 0]}
+                }}
+            ],
+            "loans": [
+                {"$project": {
+                    "_id": 0,
+                    "id": {"$toString": "$_id"},
+                    "lender": lender_name,
+                    "amount": {"$ifNull": ["$amount", 0]},
+                    "startDate": "$start_date",
+                    "endDate": "$end_date",
+                    "installments": {"$ifNull": ["$term_months", 0]},
+                    "installmentAmount": {"$ifNull": ["$installment_amount", 0]},
+                    "remainingInstallments": {"$size": pending_payments},
+                    "status": {"$switch": {
+                        "branches": [
+                            {"case": is_active, "then": "active"},
+                            {"case": {"$eq": ["$status", "COMPLETED"]}, "then": "completed"}
+                        ],
+                        "default": "pending"
+                    }},
+                    "interestRate": {"$ifNull": ["$interest_rate", 0]}
+                }}
+            ],
+            "upcomingPayments": [
+                {"$match": {"status": {"$in": ACTIVE_LOAN_STATUSES}}},
+                {"$unwind": {"path": "$payments", "includeArrayIndex": "seq"}},
+                {"$match": {"payments.status": {"$in": UNPAID_INSTALLMENT_STATUSES}, "payments.due_date": {"$ne": None}}},
+                {"$sort": {"payments.due_date": 1}},
+                {"$project": {
+                    "_id": 0,
+                    # Schedule entries have no id of their own, so fall back to loan id + position
+                    "id": {"$ifNull": [
+                        "$payments.payment_id",
+                        {"$concat": [{"$toString": "$_id"}, "-", {"$toString": "$seq"}]}
+                    ]},
+                    "loanId": {"$toString": "$_id"},
+                    "dueDate": "$payments.due_date",
+                    "amount": {"$ifNull": ["$payments.amount", 0]},
+                    "status": {"$cond": [{"$eq": ["$payments.status", "PENDING"]}, "upcoming", "overdue"]},
+                    "lender": lender_name
+                }}
+            ]
+        }}
+    ]
+
+def _recent_payments_pipeline(borrower_id: str):
+    """
+    The borrower's ten latest payments, newest first, on the (user_id, created_at)
+    index, with their lender names joined server-side instead of with one
+    find_one per payment.
+    """
+    return [
+        {"$match": {"user_id": borrower_id}},
+        {"$sort": {"created_at": -1}},
+        {"$limit": 10},
+        {"$lookup": {
+            "from": "loans",
+            "let": {"loan_id": {"$convert": {
+                "input": "$loan_id", "to": "objectId", "onError": None, "onNull": None
+            }}},
+            "pipeline": [
+                {"$match": {"$expr": {"$eq": ["$_id", "$$loan_id"]}}},
+                {"$project": {"_id": 0, "lender_name": 1}}
+            ],
+            "as": "loan"
+        }},
+        {"$project": {
+            "_id": 0,
+            "id": {"$toString": "$_id"},
+            "loanId": "$loan_id",
+            "paidDate": {"$ifNull": ["$created_at", "$payment_date"]},
+            "amount": {"$ifNull": ["$amount", 0]},
+            "method": {"$ifNull": ["$method", "unknown"]},
+            "lender": {"$ifNull": [
+                {"$arrayElemAt": ["$loan.lender_name", 0]},
+                "Unknown Lender"
+            ]}
+        }}
+    ]
+
+async def build_borrower_summary(borrower_id: str):
+    """Compute the borrower dashboard (stats, loans, upcoming and recent payments)"""
+    loans_collection = get_collection("loans")
+    payments_collection = get_collection("payments")
+
+    results, recent_payments = await asyncio.gather(
+        loans_collection.aggregate(_borrower_summary_pipeline(borrower_id)).to_list(length=1),
+        payments_collection.aggregate(_recent_payments_pipeline(borrower_id)).to_list(length=10)
+    )
+    summary = results[0] if results else {}
+
+    stats = (summary.get("stats") or [{}])[0]
+    next_payment = (summary.get("nextPayment") or [{}])[0]
+
+    return {
+        "stats": {
+            "activeLoans": stats.get("activeLoans", 0),
+            "completedLoans": stats.get("completedLoans", 0),
+            "totalBorrowed": stats.get("totalBorrowed", 0),
+            "currentBalance": stats.get("currentBalance", 0),
+            "totalPaid": stats.get("totalPaid", 0),
+            "nextPaymentDue": next_payment.get("dueDate"),
+            "nextPaymentAmount": next_payment.get("amount", 0)
+        },
+        "loans": summary.get("loans", []),
+        "upcomingPayments": summary.get("upcomingPayments", []),
+        "recentPayments": recent_payments
+    }
 
 def register_borrower_routes(router: APIRouter):
     """Register all borrower-related routes to the loans router"""
@@ -18,113 +172,7 @@ def register_borrower_routes(router: APIRouter):
                 detail="Only borrowers can access their loan summary"
             )
         
-        loans_collection = get_collection("loans")
-        
-        # Get all loans for this borrower
-        borrower_id = str(current_user["_id"])
-        cursor = loans_collection.find({"borrower_id": borrower_id})
-        loans = await cursor.to_list(length=100)
-        
-        # Calculate summary statistics
-        active_loans = [loan for loan in loans if loan.get("status") in ["ACTIVE", "APPROVED"]]
-        completed_loans = [loan for loan in loans if loan.get("status") == "COMPLETED"]
-        
-        total_borrowed = sum(loan.get("amount", 0) for loan in loans)
-        current_balance = sum(loan.get("remaining_amount", 0) for loan in active_loans)
-        total_paid = sum(loan.get("total_paid", 0) for loan in loans)
-        
-        # Find next payment due
-        next_payment_due = None
-        next_payment_amount = 0
-        
-        for loan in active_loans:
-            for payment in loan.get("payments", []):
-                if payment.get("status") == "PENDING":
-                    payment_date = payment.get("due_date")
-                    if payment_date and (next_payment_due is None or payment_date < next_payment_due):
-                        next_payment_due = payment_date
-                        next_payment_amount = payment.get("amount", 0)
-                    break
-        
-        # Format loans for response
-        formatted_loans = []
-        for loan in loans:
-            # Calculate remaining installments
-            remaining_installments = len([p for p in loan.get("payments", []) if p.get("status") == "PENDING"])
-            
-            formatted_loan = {
-                "id": str(loan["_id"]),
-                "lender": loan.get("lender_name", "Unknown Lender"),
-                "amount": loan.get("amount", 0),
-                "startDate": loan.get("start_date"),
-                "endDate": loan.get("end_date"),
-                "installments": loan.get("term_months", 0),
-                "installmentAmount": loan.get("installment_amount", 0),
-                "remainingInstallments": remaining_installments,
-                "status": "active" if loan.get("status") in ["ACTIVE", "APPROVED"] else "completed" if loan.get("status") == "COMPLETED" else "pending",
-                "interestRate": loan.get("interest_rate", 0)
-            }
-            formatted_loans.append(formatted_loan)
-        
-        # Get upcoming payments
-        upcoming_payments = []
-        for loan in active_loans:
-            for payment in loan.get("payments", []):
-                if payment.get("status") == "PENDING":
-                    due_date = payment.get("due_date")
-                    if due_date:
-                        upcoming_payment = {
-                            "id": payment.get("payment_id", str(ObjectId())),
-                            "loanId": str(loan["_id"]),
-                            "dueDate": due_date,
-                            "amount": payment.get("amount", 0),
-                            "status": "upcoming",
-                            "lender": loan.get("lender_name", "Unknown Lender")
-                        }
-                        upcoming_payments.append(upcoming_payment)
-        
-        # Sort upcoming payments by due date
-        upcoming_payments.sort(key=lambda x: x["dueDate"])
-        
-        # Get recent payments
-        recent_payments = []
-        payments_collection = get_collection("payments")
-        payments_cursor = payments_collection.find({"user_id": borrower_id}).sort("created_at", -1).limit(10)
-        payments = await payments_cursor.to_list(length=10)
-        
-        for payment in payments:
-            loan_id = payment.get("loan_id")
-            loan = None
-            if loan_id:
-                try:
-                    loan = await loans_collection.find_one({"_id": ObjectId(loan_id)})
-                except:
-                    pass
-            
-            recent_payment = {
-                "id": str(payment["_id"]),
-                "loanId": loan_id,
-                "paidDate": payment.get("created_at") or payment.get("payment_date"),
-                "amount": payment.get("amount", 0),
-                "method": payment.get("method", "unknown"),
-                "lender": loan.get("lender_name", "Unknown Lender") if loan else "Unknown Lender"
-            }
-            recent_payments.append(recent_payment)
-        
-        return {
-            "stats": {
-                "activeLoans": len(active_loans),
-                "completedLoans": len(completed_loans),
-                "totalBorrowed": total_borrowed,
-                "currentBalance": current_balance,
-                "totalPaid": total_paid,
-                "nextPaymentDue": next_payment_due,
-                "nextPaymentAmount": next_payment_amount
-            },
-            "loans": formatted_loans,
-            "upcomingPayments": upcoming_payments,
-            "recentPayments": recent_payments
-        }
+        return await build_borrower_summary(str(current_user["_id"]))
     
     @router.get("/borrower/{borrower_id}")
     async def get_borrower_loans(
@@ -148,6 +196,7 @@ def register_borrower_routes(router: APIRouter):
         
         cursor = loans_collection.find(query)
         loans = await cursor.to_list(length=100)
+        await attach_installments(loans)
         
         # Convert ObjectId to string for JSON serialization
         for loan in loans:
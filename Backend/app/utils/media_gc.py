@@ -0,0 +1,177 @@
+"""
+Garbage collection of orphaned media.
+
+Photos and documents can be left in storage with nothing referring to them:
+a delete that failed, an ad deleted while its photos were processing, a user
+removed without their registration documents. The collector gathers every
+key the database refers to, lists storage page by page, and deletes objects
+that are neither referenced nor recent, at a limited rate.
+
+Deduplicated photos are kept alive by their `media` document, so reference
+counts are first recounted from the ads; documents left without references
+are removed, which orphans their objects.
+
+A dry run only reports what would be deleted.
+"""
+import asyncio
+from collections import Counter
+from datetime import datetime, timedelta
+
+from ..core.config import settings
+from ..core.database import get_collection
+from .media_pipeline import PHOTO_VARIANTS, unadded_media_variants
+from .storage import LocalStorage, document_key, get_storage, legacy_storage
+
+# Objects and media documents younger than this are left alone, so uploads
+# that aren't recorded on their ad or user yet are never collected
+GC_GRACE_PERIOD = timedelta(days=1)
+
+# Deletes are spread out so the storage API isn't hammered
+GC_DELETES_PER_SECOND = 5
+GC_MAX_DELETES_PER_RUN = 5000
+
+GC_BATCH_SIZE = 1000
+
+# Orphaned keys listed in the report per prefix
+GC_REPORT_SAMPLE = 20
+
+def _variant_keys(storage, variants: dict):
+    for name in PHOTO_VARIANTS:
+        if variants.get(name):
+            key = storage.key_for_url(variants[name])
+            if key:
+                yield key
+
+async def _ad_references(storage):
+    """Keys referenced by ads, and the number of ad photos using each content hash"""
+    keys = set()
+    hash_counts = Counter()
+    cursor = get_collection("advertisements").find(
+        {}, {"photos": 1, "photo_variants": 1, "media.url": 1, "media.variants": 1}
+    ).batch_size(GC_BATCH_SIZE)
+    async for ad in cursor:
+        for url in ad.get("photos", []):
+            key = storage.key_for_url(url)
+            if key:
+                keys.add(key)
+        for variants in ad.get("photo_variants", []):
+            keys.update(_variant_keys(storage, variants))
+            if variants.get("hash"):
+                hash_counts[variants["hash"]] += 1
+        for entry in ad.get("media", []):
+            keys.update(_variant_keys(storage, entry.get("variants") or {}))
+        # Once added to the ad, these photos are counted through photo_variants
+        for variants in unadded_media_variants(ad):
+            if variants.get("hash"):
+                hash_counts[variants["hash"]] += 1
+    return keys, hash_counts
+
+async def _reconcile_media(hash_counts: Counter, cutoff: datetime, dry_run: bool):
+    """
+    Reset reference counts of media documents to the number of ad photos
+    using them, removing documents nothing uses. Returns the number fixed
+    and the hashes of the documents removed (or, in a dry run, to remove).
+    """
+    media_collection = get_collection("media")
+    fixed = 0
+    removed = set()
+    cursor = media_collection.find(
+        {"updated_at": {"$lt": cutoff}}, {"refcount": 1}
+    ).batch_size(GC_BATCH_SIZE)
+    async for media in cursor:
+        actual = hash_counts.get(media["_id"], 0)
+        if media.get("refcount") == actual:
+            continue
+        fixed += 1
+        if not actual:
+            removed.add(media["_id"])
+        if dry_run:
+            continue
+        # Only if unchanged since it was read, so a concurrent upload or release wins
+        if actual:
+            await media_collection.update_one(
+                {"_id": media["_id"], "refcount": media.get("refcount")},
+                {"$set": {"refcount": actual}}
+            )
+        else:
+            result = await media_collection.delete_one({"_id": media["_id"], "refcount": media.get("refcount")})
+            if not result.deleted_count:
+                removed.discard(media["_id"])
+    return fixed, removed
+
+async def _media_references(storage, removed: set) -> set:
+    keys = set()
+    cursor = get_collection("media").find({}, {"variants": 1}).batch_size(GC_BATCH_SIZE)
+    async for media in cursor:
+        if media["_id"] in removed:
+            continue
+        keys.update(_variant_keys(storage, media.get("variants") or {}))
+    return keys
+
+async def _document_references() -> set:
+    keys = set()
+    for collection_name in ("users", "borrowers"):
+        cursor = get_collection(collection_name).find(
+            {"document_uploads.0": {"$exists": True}}, {"document_uploads": 1}
+        ).batch_size(GC_BATCH_SIZE)
+        async for doc in cursor:
+            keys.update(document_key(path) for path in doc["document_uploads"])
+    return keys
+
+async def _collect_prefix(storage, prefix: str, referenced: set, cutoff: datetime, dry_run: bool, budget: dict) -> dict:
+    """Diff one prefix of a storage against the referenced keys, page by page, deleting orphans"""
+    stats = {"scanned": 0, "orphaned": 0, "orphaned_bytes": 0, "deleted": 0, "failed": 0, "sample": []}
+    async for page in storage.list(prefix):
+        stats["scanned"] += len(page)
+        for key, size, modified_at in page:
+            if key in referenced or modified_at >= cutoff:
+                continue
+            stats["orphaned"] += 1
+            stats["orphaned_bytes"] += size
+            if len(stats["sample"]) < GC_REPORT_SAMPLE:
+                stats["sample"].append(key)
+            if dry_run or budget["deletes"] <= 0:
+                continue
+
+            budget["deletes"] -= 1
+            try:
+                await storage.delete(key)
+                stats["deleted"] += 1
+            except Exception as e:
+                stats["failed"] += 1
+                print(f"Error deleting orphaned {key} from {storage.name} storage: {str(e)}")
+            await asyncio.sleep(1 / GC_DELETES_PER_SECOND)
+    return stats
+
+async def collect_orphaned_media(dry_run: bool = None, now: datetime = None) -> dict:
+    """
+    Background job: delete stored photos and documents nothing refers to.
+
+    Returns a report with, per storage prefix, the objects scanned, the
+    orphans found (count, bytes and a sample of keys) and what was deleted.
+    """
+    dry_run = settings.MEDIA_GC_DRY_RUN if dry_run is None else dry_run
+    now = now or datetime.utcnow()
+    cutoff = now - GC_GRACE_PERIOD
+    storage = get_storage()
+    print(f"Collecting orphaned media in {storage.name} storage{' (dry run)' if dry_run else ''}...")
+
+    ad_keys, hash_counts = await _ad_references(storage)
+    media_fixed, media_removed = await _reconcile_media(hash_counts, cutoff, dry_run)
+    ad_keys |= await _media_references(storage, media_removed)
+    document_keys = await _document_references()
+
+    targets = [(storage, "advertisements/", ad_keys), (storage, "documents/", document_keys)]
+    # Documents uploaded before the storage drivers stay on local disk whatever the backend
+    if not isinstance(storage, LocalStorage):
+        targets.append((legacy_storage(), "documents/", document_keys))
+
+    report = {"dry_run": dry_run, "media_refcounts_fixed": media_fixed, "prefixes": {}}
+    budget = {"deletes": GC_MAX_DELETES_PER_RUN}
+    for target_storage, prefix, referenced in targets:
+        stats = await _collect_prefix(target_storage, prefix, referenced, cutoff, dry_run, budget)
+        report["prefixes"][f"{target_storage.name}:{prefix}"] = stats
+        print(f"Orphaned media in {target_storage.name}:{prefix}: {stats['scanned']} scanned, "
+              f"{stats['orphaned']} orphaned ({stats['orphaned_bytes'] / (1024 * 1024):.1f} MB), "
+              f"{stats['deleted']} deleted, {stats['failed']} failed")
+    return report
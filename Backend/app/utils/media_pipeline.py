@@ -0,0 +1,456 @@
+"""
+Background processing of advertisement photos.
+
+create_advertisement spools uploaded photos to local disk, stores the ad
+unpublished with one `processing` entry per photo in `media`, and queues a
+`media_jobs` document per photo in the same transaction; update_advertisement
+does the same for photos added to an ad, which stays as it is meanwhile. A
+worker in each API process picks up the jobs spooled on its host (or any
+job, when the spool is shared), renders the thumbnail, medium and full
+variants of each photo locally, puts them in storage and patches their URLs
+back into the ad. Once no photo is still processing, the new photos are
+added to the ad in upload order and the ad is published.
+
+Workers record a heartbeat per host. Jobs spooled on a host that has
+stopped beating can never be processed, so another worker fails them and
+the ad is published without those photos.
+
+Photos are deduplicated by the SHA-256 of their content: `media` maps each
+hash to its stored variants and the number of ad photos referring to them,
+so a re-uploaded photo is never transferred again and is only deleted from
+storage once the last ad using it lets go.
+"""
+import asyncio
+import hashlib
+import io
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta
+from typing import List, Optional
+from bson import ObjectId
+from fastapi import UploadFile
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from ..core.config import settings
+from ..core.database import get_collection
+from .listing_cache import invalidate_listings
+from .storage import delete_urls, get_storage
+
+MEDIA_SPOOL_DIR = settings.MEDIA_SPOOL_DIR
+
+# Bytes copied per write while spooling an upload
+SPOOL_CHUNK_SIZE = 1024 * 1024
+
+# Variants stored for every photo, each scaled down to fit in a square of the given size.
+# Listings show the thumbnail, the ad page the medium variant and the gallery the full one.
+PHOTO_VARIANTS = {"thumbnail": 320, "medium": 1024, "full": 2048}
+
+# Formats variants are kept in; photos in any other format are converted to JPEG
+VARIANT_EXTENSIONS = {"JPEG": ".jpg", "PNG": ".png", "WEBP": ".webp"}
+
+# Photos processed at once by each worker
+MEDIA_CONCURRENCY = 4
+MEDIA_POLL_SECONDS = 1
+
+# A claimed job not finished within this time is picked up again
+MEDIA_CLAIM_SECONDS = 300
+
+MEDIA_MAX_ATTEMPTS = 5
+MEDIA_BACKOFF_SECONDS = 10
+
+# Spool files only exist on the machine that received the upload, unless the spool is shared
+HOST = socket.gethostname()
+
+# How often each worker records that its host is alive, and how long after its
+# last heartbeat a host's pending jobs are given up on
+MEDIA_HEARTBEAT_SECONDS = 30
+MEDIA_HOST_DEADLINE_SECONDS = 600
+
+def _publish_update(now: datetime) -> list:
+    """
+    Pipeline update that adds an ad's processed photos once none of them is processing.
+
+    Photos that finished are appended to `photos` (and their variants to
+    `photo_variants`) in slot order, `media` is emptied and the ad is
+    published, all in one atomic update, so it happens exactly once. Entries
+    for photos the ad already has, left by ads published before `media` was
+    emptied, aren't appended again.
+    """
+    media = {"$ifNull": ["$media", []]}
+    photos = {"$ifNull": ["$photos", []]}
+    processing = {"$in": ["processing", {"$ifNull": ["$media.status", []]}]}
+    ready = {"$filter": {"input": media, "cond": {"$and": [
+        {"$eq": ["$$this.status", "ready"]},
+        {"$not": [{"$in": ["$$this.url", photos]}]}
+    ]}}}
+    adding = {"$and": [{"$gt": [{"$size": media}, 0]}, {"$not": [processing]}]}
+    return [{"$set": {
+        "photos": {"$cond": [
+            adding,
+            {"$concatArrays": [photos, {"$map": {"input": ready, "in": "$$this.url"}}]},
+            "$photos"
+        ]},
+        "photo_variants": {"$cond": [
+            adding,
+            {"$concatArrays": [{"$ifNull": ["$photo_variants", []]}, {"$map": {"input": ready, "in": "$$this.variants"}}]},
+            "$photo_variants"
+        ]},
+        "media": {"$cond": [adding, {"$literal": []}, "$media"]},
+        "published": {"$cond": [adding, True, "$published"]},
+        "updated_at": {"$cond": [adding, now, "$updated_at"]}
+    }}]
+
+async def spool_upload(upload: UploadFile):
+    """Copy an uploaded file to the spool directory in chunks, hashing it on the way. Returns (path, sha256)."""
+    os.makedirs(MEDIA_SPOOL_DIR, exist_ok=True)
+    path = os.path.join(MEDIA_SPOOL_DIR, uuid.uuid4().hex)
+
+    def copy():
+        digest = hashlib.sha256()
+        upload.file.seek(0)
+        with open(path, "wb") as f:
+            while True:
+                chunk = upload.file.read(SPOOL_CHUNK_SIZE)
+                if not chunk:
+                    return digest.hexdigest()
+                digest.update(chunk)
+                f.write(chunk)
+
+    return path, await asyncio.to_thread(copy)
+
+async def spool_photos(ad_id: ObjectId, uploads: List[UploadFile], first_slot: int = 0):
+    """
+    Spool photos for an ad, numbering their slots from `first_slot`.
+
+    Returns the `media` entries to store on the ad and the jobs to insert
+    (in the same transaction as the ad) so the worker processes them.
+    """
+    spooled = await asyncio.gather(*[spool_upload(upload) for upload in uploads])
+    now = datetime.utcnow()
+
+    media = [{"slot": first_slot + index, "status": "processing"} for index in range(len(spooled))]
+    jobs = [
+        {
+            "ad_id": str(ad_id),
+            "slot": slot,
+            "path": path,
+            "sha256": digest,
+            "filename": upload.filename,
+            "host": None if settings.MEDIA_SPOOL_SHARED else HOST,
+            "status": "pending",
+            "attempts": 0,
+            "available_at": now,
+            "created_at": now
+        }
+        for slot, ((path, digest), upload) in enumerate(zip(spooled, uploads), start=first_slot)
+    ]
+    return media, jobs
+
+def _render_variants(data: bytes, extension: str) -> dict:
+    """
+    Render each of PHOTO_VARIANTS as {name: (bytes, extension)}.
+
+    Needs Pillow; without it the original is stored once and serves as every
+    variant. Variants that wouldn't be smaller than the next larger one reuse it.
+    """
+    try:
+        from PIL import Image, ImageOps, UnidentifiedImageError
+    except ImportError:
+        return {name: (data, extension) for name in PHOTO_VARIANTS}
+
+    try:
+        image = Image.open(io.BytesIO(data))
+    except UnidentifiedImageError:
+        raise ValueError("Not an image")
+    image_format = image.format
+    image = ImageOps.exif_transpose(image)
+    if image_format not in VARIANT_EXTENSIONS:
+        image_format = "JPEG"
+    extension = VARIANT_EXTENSIONS[image_format]
+    if image_format == "JPEG" and image.mode != "RGB":
+        image = image.convert("RGB")
+
+    variants = {}
+    previous = None
+    for name, size in sorted(PHOTO_VARIANTS.items(), key=lambda item: -item[1]):
+        if previous and max(previous[1]) <= size:
+            variants[name] = variants[previous[0]]
+            continue
+        variant = image.copy()
+        variant.thumbnail((size, size))
+        output = io.BytesIO()
+        variant.save(output, format=image_format, quality=85, optimize=True)
+        variants[name] = (output.getvalue(), extension)
+        previous = (name, variant.size)
+    return variants
+
+async def _acquire_media(digest: str) -> Optional[dict]:
+    """Take a reference on an already stored photo with this content, returning its variants"""
+    media = await get_collection("media").find_one_and_update(
+        {"_id": digest, "variants": {"$exists": True}},
+        {"$inc": {"refcount": 1}, "$set": {"updated_at": datetime.utcnow()}}
+    )
+    return media["variants"] if media else None
+
+async def _register_media(digest: str, variants: dict) -> dict:
+    """
+    Record freshly stored variants with one reference and return the variants
+    to use. If a concurrent upload of the same photo registered first, a
+    reference is taken on its variants instead and ours are deleted.
+    """
+    media_collection = get_collection("media")
+    now = datetime.utcnow()
+    while True:
+        try:
+            media = await media_collection.find_one_and_update(
+                {"_id": digest},
+                {"$setOnInsert": {"variants": variants, "created_at": now}, "$inc": {"refcount": 1}, "$set": {"updated_at": now}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+            break
+        except DuplicateKeyError:
+            # A concurrent upsert inserted it first; the retry matches its document
+            continue
+
+    if media["variants"] != variants:
+        await delete_urls(variant_urls(variants))
+    return media["variants"]
+
+async def store_photo(digest: str, read, filename: str) -> dict:
+    """
+    Store a photo's variants and return {variant: URL, "hash": sha256}.
+
+    If a photo with the same content is already stored, it gains a reference
+    and its variants are returned without reading or uploading anything.
+    Otherwise `read` is awaited for the content, and the variants are stored
+    under keys made of the hash and a new generation. A release deleting the
+    previous generation of the same photo therefore never deletes these.
+    """
+    variants = await _acquire_media(digest)
+    if variants:
+        return {**variants, "hash": digest}
+
+    extension = os.path.splitext(filename or "")[1].lower() or ".jpg"
+    rendered = await asyncio.to_thread(_render_variants, await read(), extension)
+
+    # Variants that share their content are stored once
+    generation = uuid.uuid4().hex[:12]
+    stored = {}
+    for name in sorted(rendered, key=lambda name: -PHOTO_VARIANTS[name]):
+        content, variant_extension = rendered[name]
+        if id(content) not in stored:
+            key = f"advertisements/{digest}_{generation}_{name}{variant_extension}"
+            stored[id(content)] = get_storage().put(key, content)
+    urls = dict(zip(stored, await asyncio.gather(*stored.values())))
+    variants = {name: urls[id(content)] for name, (content, _) in rendered.items()}
+
+    variants = await _register_media(digest, variants)
+    return {**variants, "hash": digest}
+
+def variant_urls(variants: dict) -> List[str]:
+    """Distinct stored URLs of a photo's variants"""
+    urls = []
+    for name in PHOTO_VARIANTS:
+        if variants.get(name) and variants[name] not in urls:
+            urls.append(variants[name])
+    return urls
+
+def photo_variants_for(ad: dict, photos: List[str]) -> List[dict]:
+    """Variants of the given photos of an ad; photos stored before variants are their own full variant"""
+    variants = {entry["full"]: entry for entry in ad.get("photo_variants", []) if entry.get("full")}
+    return [variants.get(photo, {"full": photo}) for photo in photos]
+
+async def release_photos(photos: List[dict]):
+    """
+    Drop a reference on each photo (given as its variants) and delete from
+    storage the ones nothing refers to anymore. Photos stored before
+    deduplication have no hash and are deleted right away.
+    """
+    media_collection = get_collection("media")
+    urls = []
+    for variants in photos:
+        digest = variants.get("hash")
+        if digest:
+            media = await media_collection.find_one_and_update(
+                {"_id": digest},
+                {"$inc": {"refcount": -1}, "$set": {"updated_at": datetime.utcnow()}},
+                return_document=ReturnDocument.AFTER
+            )
+            if media is None:
+                continue
+            # A concurrent upload may have taken a new reference in the meantime
+            if media["refcount"] > 0 or (await media_collection.delete_one({"_id": digest, "refcount": {"$lte": 0}})).deleted_count == 0:
+                continue
+        urls.extend(url for url in variant_urls(variants) if url not in urls)
+
+    if urls:
+        await delete_urls(urls)
+
+def next_media_slot(ad: dict) -> int:
+    """Slot for the next photo spooled for an ad, after the ones still in `media`"""
+    return max((entry.get("slot", -1) for entry in ad.get("media", [])), default=-1) + 1
+
+def unadded_media_variants(ad: dict) -> List[dict]:
+    """Variants of photos processed for an ad but not added to its photos yet"""
+    photos = set(ad.get("photos", []))
+    return [entry["variants"] for entry in ad.get("media", []) if entry.get("variants") and entry.get("url") not in photos]
+
+def thumbnail_url(ad: dict) -> Optional[str]:
+    """Thumbnail of an ad's first photo; ads stored before variants fall back to the photo itself"""
+    if not ad.get("photos"):
+        return None
+    variants = next((entry for entry in ad.get("photo_variants", []) if entry.get("full") == ad["photos"][0]), None)
+    return variants["thumbnail"] if variants else ad["photos"][0]
+
+async def _finish_slot(job: dict, update: dict):
+    """Record the outcome of a photo on its ad and publish the ad if it was the last one"""
+    ads_collection = get_collection("advertisements")
+    now = datetime.utcnow()
+    await ads_collection.update_one(
+        {"_id": ObjectId(job["ad_id"]), "media.slot": job["slot"]},
+        {"$set": {f"media.$.{field}": value for field, value in update.items()}}
+    )
+    # Only publishing modifies the ad, and makes it appear in listings
+    result = await ads_collection.update_one({"_id": ObjectId(job["ad_id"])}, _publish_update(now))
+    if result.modified_count:
+        await invalidate_listings()
+
+def _remove_spool_file(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+async def _process_job(job: dict):
+    jobs_collection = get_collection("media_jobs")
+
+    ad = await get_collection("advertisements").find_one({"_id": ObjectId(job["ad_id"])}, {"_id": 1})
+    if not ad:
+        # The ad was deleted while its photos were queued
+        await jobs_collection.update_one({"_id": job["_id"]}, {"$set": {
+            "status": "cancelled", "claim": None, "finished_at": datetime.utcnow()
+        }})
+        _remove_spool_file(job["path"])
+        return
+
+    try:
+        variants = await store_photo(
+            job["sha256"], lambda: asyncio.to_thread(_read_file, job["path"]), job.get("filename")
+        )
+    except Exception as e:
+        error = str(e) or type(e).__name__
+        attempts = job.get("attempts", 0) + 1
+        print(f"Error processing photo {job['slot']} of ad {job['ad_id']} (attempt {attempts}): {error}")
+        # Missing spool files and files that aren't images won't succeed on a retry
+        if attempts < MEDIA_MAX_ATTEMPTS and not isinstance(e, (FileNotFoundError, ValueError)):
+            await jobs_collection.update_one({"_id": job["_id"]}, {"$set": {
+                "attempts": attempts,
+                "last_error": error,
+                "claim": None,
+                "available_at": datetime.utcnow() + timedelta(seconds=MEDIA_BACKOFF_SECONDS * 2 ** (attempts - 1))
+            }})
+            return
+        await jobs_collection.update_one({"_id": job["_id"]}, {"$set": {
+            "status": "failed", "attempts": attempts, "last_error": error, "claim": None,
+            "finished_at": datetime.utcnow()
+        }})
+        await _finish_slot(job, {"status": "failed"})
+        _remove_spool_file(job["path"])
+        return
+
+    await _finish_slot(job, {"status": "ready", "url": variants["full"], "variants": variants})
+    await jobs_collection.update_one({"_id": job["_id"]}, {"$set": {"status": "done", "claim": None, "finished_at": datetime.utcnow()}})
+    _remove_spool_file(job["path"])
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+async def _claim_jobs(limit: int) -> List[dict]:
+    """Claim due jobs this host can read the spool files of, pushing their available_at past the claim timeout"""
+    jobs_collection = get_collection("media_jobs")
+    now = datetime.utcnow()
+    host = {"$in": [None, HOST]} if settings.MEDIA_SPOOL_SHARED else HOST
+    due = await jobs_collection.find(
+        {"status": "pending", "host": host, "available_at": {"$lte": now}},
+        {"_id": 1}
+    ).sort("available_at", 1).limit(limit).to_list(length=limit)
+    if not due:
+        return []
+
+    claim = uuid.uuid4().hex
+    await jobs_collection.update_many(
+        {"_id": {"$in": [job["_id"] for job in due]}, "status": "pending", "available_at": {"$lte": now}},
+        {"$set": {"claim": claim, "available_at": now + timedelta(seconds=MEDIA_CLAIM_SECONDS)}}
+    )
+    return await jobs_collection.find({"claim": claim}).to_list(length=limit)
+
+async def process_media_jobs(limit: int = MEDIA_CONCURRENCY) -> int:
+    """Process one batch of queued photos concurrently. Returns the number claimed."""
+    jobs = await _claim_jobs(limit)
+    await asyncio.gather(*[_process_job(job) for job in jobs])
+    return len(jobs)
+
+async def _heartbeat(now: datetime):
+    await get_collection("media_hosts").update_one({"_id": HOST}, {"$set": {"seen_at": now}}, upsert=True)
+
+async def fail_abandoned_jobs(now: datetime = None) -> int:
+    """
+    Fail pending jobs spooled on hosts that stopped sending heartbeats, so
+    their ads are published without the photos instead of never. Jobs younger
+    than the deadline are left alone. Returns the number failed.
+    """
+    jobs_collection = get_collection("media_jobs")
+    now = now or datetime.utcnow()
+    deadline = now - timedelta(seconds=MEDIA_HOST_DEADLINE_SECONDS)
+
+    hosts = [host for host in await jobs_collection.distinct("host", {"status": "pending"}) if host and host != HOST]
+    if not hosts:
+        return 0
+    alive = await get_collection("media_hosts").distinct("_id", {"_id": {"$in": hosts}, "seen_at": {"$gte": deadline}})
+
+    failed = 0
+    for host in set(hosts) - set(alive):
+        cursor = jobs_collection.find(
+            {"status": "pending", "host": host, "created_at": {"$lt": deadline}},
+            {"ad_id": 1, "slot": 1}
+        )
+        async for job in cursor:
+            # Only if still pending, in case the host came back and processed it meanwhile
+            result = await jobs_collection.update_one(
+                {"_id": job["_id"], "status": "pending", "host": host},
+                {"$set": {"status": "failed", "last_error": f"Spool host {host} is gone", "claim": None, "finished_at": now}}
+            )
+            if result.modified_count:
+                await _finish_slot(job, {"status": "failed"})
+                failed += 1
+    if failed:
+        print(f"Failed {failed} photo jobs spooled on unresponsive hosts")
+    return failed
+
+async def run_media_worker():
+    """
+    Worker loop; runs in every API process and takes jobs spooled on its own
+    host (or any job, with a shared spool). It also sends this host's
+    heartbeat and fails the jobs of hosts that stopped sending theirs.
+    """
+    print(f"Starting media worker on {HOST} with {get_storage().name} storage")
+    loop = asyncio.get_running_loop()
+    next_heartbeat = loop.time()
+    while True:
+        try:
+            if loop.time() >= next_heartbeat:
+                next_heartbeat = loop.time() + MEDIA_HEARTBEAT_SECONDS
+                now = datetime.utcnow()
+                await _heartbeat(now)
+                await fail_abandoned_jobs(now)
+            claimed = await process_media_jobs()
+        except Exception as e:
+            print(f"Error in media worker: {e}")
+            claimed = 0
+
+        if claimed < MEDIA_CONCURRENCY:
+            await asyncio.sleep(MEDIA_POLL_SECONDS)
@@ -0,0 +1,178 @@
+"""
+Per-user notification counters.
+
+Each user has a document in `notification_counters` holding their total and
+unread notification counts. Every write to `notifications` adjusts it with
+$inc in the same transaction, so the unread badge is a point read instead of
+a count over the collection, and a recount never sees a write without its
+increment. Reads are additionally cached in-process for a few seconds since
+the frontend polls them constantly.
+"""
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import List
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from ..core.database import get_collection, run_in_transaction
+from .notification_push import publish_inserted
+
+# How long a worker serves counts from memory before reading them again
+COUNTER_CACHE_SECONDS = 5
+
+# Read notifications expire through a TTL index without passing through the
+# counters, so stored totals are recounted once they are this old
+COUNTER_REBUILD_INTERVAL = timedelta(days=1)
+
+DUPLICATE_KEY_ERROR = 11000
+
+# Attempts at storing a recount while increments keep landing on the counters
+REBUILD_ATTEMPTS = 5
+
+_cache = {}
+
+def _invalidate(user_ids):
+    for user_id in user_ids:
+        _cache.pop(user_id, None)
+
+async def _apply_increments(increments: dict, session=None):
+    """
+    Apply {user_id: {"total": n, "unread": m}} to users' counters.
+
+    Every increment bumps the counters' version, so a recount running at the
+    same time notices it and starts over. Counters that don't exist yet are
+    created holding only the increments and without `rebuilt_at`, so the
+    first read recounts them. Pass the session of the write being counted so
+    both commit together; errors then abort that write.
+    """
+    operations = [
+        UpdateOne(
+            {"_id": user_id},
+            {"$inc": {**counts, "version": 1}, "$set": {"updated_at": datetime.utcnow()}},
+            upsert=True
+        )
+        for user_id, counts in increments.items() if any(counts.values())
+    ]
+    _invalidate(increments)
+    if not operations:
+        return
+    try:
+        await get_collection("notification_counters").bulk_write(operations, ordered=False, session=session)
+    except Exception as e:
+        if session is not None:
+            raise
+        print(f"Error updating notification counters: {str(e)}")
+
+async def insert_notifications(notifications: List[dict]) -> int:
+    """
+    Insert notifications, count them on their users' counters and push them
+    to connected clients.
+
+    Notifications whose _id already exists are skipped, so redelivered
+    batches neither duplicate notifications nor inflate the counters.
+    Returns the number inserted.
+    """
+    if not notifications:
+        return 0
+
+    notifications_collection = get_collection("notifications")
+    for notification in notifications:
+        notification.setdefault("_id", ObjectId())
+
+    async def write(session):
+        # Skipped up front, since a duplicate key error would abort the transaction
+        existing = set(await notifications_collection.distinct(
+            "_id", {"_id": {"$in": [notification["_id"] for notification in notifications]}}, session=session
+        ))
+        inserted = [notification for notification in notifications if notification["_id"] not in existing]
+        if not inserted:
+            return []
+        try:
+            await notifications_collection.insert_many(inserted, ordered=False, session=session)
+        except BulkWriteError as e:
+            # Only reachable without transactions, when a concurrent insert wins the race
+            errors = e.details.get("writeErrors", [])
+            if session is not None or any(error.get("code") != DUPLICATE_KEY_ERROR for error in errors):
+                raise
+            duplicates = {error["index"] for error in errors}
+            inserted = [notification for index, notification in enumerate(inserted) if index not in duplicates]
+
+        totals = Counter(notification["user_id"] for notification in inserted)
+        unread = Counter(notification["user_id"] for notification in inserted if not notification.get("read"))
+        await _apply_increments({
+            user_id: {"total": count, "unread": unread.get(user_id, 0)}
+            for user_id, count in totals.items()
+        }, session=session)
+        return inserted
+
+    inserted = await run_in_transaction(write)
+    publish_inserted(inserted)
+    return len(inserted)
+
+async def record_notifications_read(user_id: str, count: int, session=None):
+    """Account for `count` notifications of a user going from unread to read"""
+    await _apply_increments({user_id: {"unread": -count}}, session=session)
+
+async def record_notifications_removed(notifications: List[dict], session=None):
+    """Account for deleted or archived notifications (each needs its user_id and read flag)"""
+    totals = Counter(notification["user_id"] for notification in notifications)
+    unread = Counter(notification["user_id"] for notification in notifications if not notification.get("read"))
+    await _apply_increments({
+        user_id: {"total": -count, "unread": -unread.get(user_id, 0)}
+        for user_id, count in totals.items()
+    }, session=session)
+
+async def rebuild_notification_counts(user_id: str) -> dict:
+    """
+    Recount a user's notifications and store the counters.
+
+    The counts are only stored if no increment landed on the counters while
+    they were being counted; otherwise the count may have missed a
+    notification the increment accounted for, so it is redone.
+    """
+    notifications_collection = get_collection("notifications")
+    counters_collection = get_collection("notification_counters")
+    _invalidate([user_id])
+
+    for _ in range(REBUILD_ATTEMPTS):
+        current = await counters_collection.find_one({"_id": user_id}, {"version": 1})
+        now = datetime.utcnow()
+        counts = {
+            "total": await notifications_collection.count_documents({"user_id": user_id}),
+            "unread": await notifications_collection.count_documents({"user_id": user_id, "read": False}),
+            "updated_at": now,
+            "rebuilt_at": now
+        }
+        try:
+            if current is None:
+                await counters_collection.insert_one({"_id": user_id, "version": 0, **counts})
+                return counts
+            result = await counters_collection.replace_one(
+                {"_id": user_id, "version": current.get("version")},
+                {"version": current.get("version", 0), **counts}
+            )
+            if result.matched_count:
+                return counts
+        except DuplicateKeyError:
+            pass
+
+    # Left for the next read to recount
+    print(f"Notification counters for {user_id} kept changing during rebuild")
+    return counts
+
+async def get_notification_counts(user_id: str) -> dict:
+    """Total and unread notification counts for a user, served from cache when fresh"""
+    cached = _cache.get(user_id)
+    now = time.monotonic()
+    if cached and cached[0] > now:
+        return cached[1]
+
+    counts = await get_collection("notification_counters").find_one({"_id": user_id})
+    if not counts or counts.get("rebuilt_at", datetime.min) < datetime.utcnow() - COUNTER_REBUILD_INTERVAL:
+        counts = await rebuild_notification_counts(user_id)
+    counts = {"total": max(0, counts.get("total", 0)), "unread": max(0, counts.get("unread", 0))}
+
+    _cache[user_id] = (now + COUNTER_CACHE_SECONDS, counts)
+    return counts
@@ -0,0 +1,112 @@
+"""
+Batched, off-request outbox writer.
+
+Notifications that aren't part of a transaction (unlike the ones committed
+with a loan or a payment) are handed to the dispatcher as outbox events and
+the handler returns immediately. A background task drains the queue and
+stores whatever has accumulated with a single insert_many, so events from
+concurrent requests share one round-trip; the outbox relay delivers them.
+"""
+import asyncio
+from typing import List
+
+from .outbox import add_outbox_events
+
+# Events held in memory before enqueueing falls back to a direct insert
+DISPATCH_QUEUE_SIZE = 10000
+
+# Largest insert_many, and how long to wait for more events before writing a partial batch
+DISPATCH_BATCH_SIZE = 200
+DISPATCH_FLUSH_SECONDS = 0.5
+
+# Queued by stop() so the writer finishes the batch it is collecting and exits
+_STOP = object()
+
+class NotificationDispatcher:
+    def __init__(self, queue_size: int = DISPATCH_QUEUE_SIZE, batch_size: int = DISPATCH_BATCH_SIZE,
+                 flush_seconds: float = DISPATCH_FLUSH_SECONDS):
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.queue = None
+        self.task = None
+
+    @property
+    def running(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+    def start(self):
+        """Start the writer task on the running event loop"""
+        if self.running:
+            return
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the writer once it has flushed everything queued so far"""
+        if not self.running:
+            return
+        await self.queue.put(_STOP)
+        await self.task
+        self.task = None
+
+        # Anything queued while the writer was finishing up
+        remaining = []
+        while not self.queue.empty():
+            item = self.queue.get_nowait()
+            if item is not _STOP:
+                remaining.append(item)
+        for start in range(0, len(remaining), self.batch_size):
+            await add_outbox_events(remaining[start:start + self.batch_size])
+
+    async def dispatch(self, events: List[dict]):
+        """
+        Queue outbox events for writing.
+
+        Processes without a running writer (such as the standalone scheduler)
+        and a full queue fall back to writing directly, so nothing is dropped.
+        """
+        if not events:
+            return
+        if not self.running:
+            await add_outbox_events(events)
+            return
+
+        overflow = []
+        for event in events:
+            try:
+                self.queue.put_nowait(event)
+            except asyncio.QueueFull:
+                overflow.append(event)
+        if overflow:
+            await add_outbox_events(overflow)
+
+    async def _next_batch(self) -> List[dict]:
+        """Wait for one event, then collect whatever else arrives within the flush interval"""
+        batch = [await self.queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.flush_seconds
+        while len(batch) < self.batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+            stopping = _STOP in batch
+            events = [item for item in batch if item is not _STOP]
+            if events:
+                try:
+                    await add_outbox_events(events)
+                except Exception as e:
+                    print(f"Error writing {len(events)} outbox events: {str(e)}")
+            if stopping:
+                return
+
+notification_dispatcher = NotificationDispatcher()
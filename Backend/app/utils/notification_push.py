@@ -0,0 +1,83 @@
+"""
+Push delivery of new notifications to connected clients.
+
+Connected clients subscribe to an in-process broker keyed by user id. With
+the default "local" backend, notifications are published by the process
+that inserts them, which is enough for a single worker. With the
+"changestream" backend every worker instead follows inserts on the
+`notifications` collection through a Mongo change stream, so clients get
+notifications written by any worker, the outbox relay or the scheduler.
+"""
+import asyncio
+from collections import defaultdict
+from typing import List
+
+from ..core.config import settings
+from ..core.database import Database, get_collection
+
+# Notifications buffered per connection; a client that falls this far behind misses the overflow
+SUBSCRIBER_QUEUE_SIZE = 100
+
+# Delay before reopening a change stream that failed
+CHANGE_STREAM_RETRY_SECONDS = 5
+
+class NotificationBroker:
+    def __init__(self):
+        self.subscribers = defaultdict(set)
+
+    def subscribe(self, user_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.subscribers[user_id].add(queue)
+        return queue
+
+    def unsubscribe(self, user_id: str, queue: asyncio.Queue):
+        queues = self.subscribers.get(user_id)
+        if queues is None:
+            return
+        queues.discard(queue)
+        if not queues:
+            del self.subscribers[user_id]
+
+    def publish(self, notifications: List[dict]):
+        """Hand notifications to the connections of their users, without waiting on slow clients"""
+        for notification in notifications:
+            for queue in self.subscribers.get(notification.get("user_id"), ()):
+                try:
+                    queue.put_nowait(notification)
+                except asyncio.QueueFull:
+                    pass
+
+notification_broker = NotificationBroker()
+
+def uses_change_stream() -> bool:
+    return settings.NOTIFICATION_PUSH_BACKEND == "changestream" and Database.supports_transactions
+
+def publish_inserted(notifications: List[dict]):
+    """Publish freshly inserted notifications, unless the change stream will pick them up"""
+    if not uses_change_stream():
+        notification_broker.publish(notifications)
+
+async def follow_notification_inserts():
+    """
+    Publish every notification inserted into the collection by any process.
+
+    Change streams need a replica set; on a standalone server the local
+    backend is used instead.
+    """
+    if not uses_change_stream():
+        return
+
+    print("Following notification inserts through a change stream")
+    resume_token = None
+    while True:
+        try:
+            async with get_collection("notifications").watch(
+                [{"$match": {"operationType": "insert"}}],
+                resume_after=resume_token
+            ) as stream:
+                async for change in stream:
+                    resume_token = stream.resume_token
+                    notification_broker.publish([change["fullDocument"]])
+        except Exception as e:
+            print(f"Error in notification change stream: {str(e)}")
+            await asyncio.sleep(CHANGE_STREAM_RETRY_SECONDS)
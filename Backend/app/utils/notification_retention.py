@@ -0,0 +1,180 @@
+"""
+Notification retention.
+
+Read notifications expire through a TTL index on `read_at`. Notifications
+older than the archive age are rolled up into per-user monthly buckets in
+`notification_archive`, each capped at ARCHIVE_BUCKET_SIZE notifications, and
+removed from `notifications`. Bulk changes to a user's notifications run in
+chunks, so the hot collection never sees one unbounded update or delete.
+"""
+import asyncio
+from datetime import datetime, timedelta
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from ..core.config import settings
+from ..core.database import get_collection, run_in_transaction
+from .notification_counters import record_notifications_read, record_notifications_removed
+from .portfolio_utils import month_key
+
+# Notifications touched per bulk update or delete
+RETENTION_CHUNK_SIZE = 1000
+
+# Notifications per archive bucket; a full bucket spills into a new one for the same user and month
+ARCHIVE_BUCKET_SIZE = 500
+
+# Pause between chunks of the background job so it doesn't crowd out request traffic
+RETENTION_CHUNK_PAUSE_SECONDS = 0.1
+
+async def mark_all_read(user_id: str) -> int:
+    """Mark a user's unread notifications as read in chunks. Returns the number marked."""
+    notifications_collection = get_collection("notifications")
+    now = datetime.utcnow()
+
+    marked = 0
+    while True:
+        unread = await notifications_collection.find(
+            {"user_id": user_id, "read": False}, {"_id": 1}
+        ).limit(RETENTION_CHUNK_SIZE).to_list(length=RETENTION_CHUNK_SIZE)
+        if not unread:
+            return marked
+
+        async def write(session):
+            result = await notifications_collection.update_many(
+                {"_id": {"$in": [notification["_id"] for notification in unread]}, "read": False},
+                {"$set": {"read": True, "read_at": now}},
+                session=session
+            )
+            await record_notifications_read(user_id, result.modified_count, session=session)
+            return result.modified_count
+
+        marked += await run_in_transaction(write)
+
+async def _delete_counted(notifications: list) -> int:
+    """Delete notifications and take them off their users' counters in one transaction. Returns the number deleted."""
+    async def write(session):
+        # Only the ones actually deleted here are counted, in case some were deleted meanwhile
+        deleted = await get_collection("notifications").find(
+            {"_id": {"$in": [notification["_id"] for notification in notifications]}},
+            {"user_id": 1, "read": 1},
+            session=session
+        ).to_list(length=None)
+        await get_collection("notifications").delete_many(
+            {"_id": {"$in": [notification["_id"] for notification in deleted]}}, session=session
+        )
+        await record_notifications_removed(deleted, session=session)
+        return len(deleted)
+
+    return await run_in_transaction(write)
+
+async def delete_all(user_id: str) -> int:
+    """Delete all of a user's notifications in chunks. Returns the number deleted."""
+    notifications_collection = get_collection("notifications")
+
+    deleted = 0
+    while True:
+        notifications = await notifications_collection.find(
+            {"user_id": user_id}, {"user_id": 1, "read": 1}
+        ).limit(RETENTION_CHUNK_SIZE).to_list(length=RETENTION_CHUNK_SIZE)
+        if not notifications:
+            return deleted
+
+        deleted += await _delete_counted(notifications)
+
+async def _backfill_read_at(now: datetime) -> int:
+    """
+    Give notifications read before `read_at` existed a read time, so the TTL
+    index can expire them. Their own timestamp is used as the read time.
+    """
+    notifications_collection = get_collection("notifications")
+
+    backfilled = 0
+    while True:
+        notifications = await notifications_collection.find(
+            {"read": True, "read_at": {"$exists": False}}, {"timestamp": 1}
+        ).limit(RETENTION_CHUNK_SIZE).to_list(length=RETENTION_CHUNK_SIZE)
+        if not notifications:
+            return backfilled
+
+        operations = [
+            UpdateOne(
+                {"_id": notification["_id"]},
+                {"$set": {"read_at": notification["timestamp"] if isinstance(notification.get("timestamp"), datetime) else now}}
+            )
+            for notification in notifications
+        ]
+        result = await notifications_collection.bulk_write(operations, ordered=False)
+        backfilled += result.modified_count
+        await asyncio.sleep(RETENTION_CHUNK_PAUSE_SECONDS)
+
+async def _archived_ids(notifications: list) -> set:
+    """Ids of the notifications that are already in an archive bucket"""
+    ids = [notification["_id"] for notification in notifications]
+    archived = await get_collection("notification_archive").distinct("notifications._id", {"notifications._id": {"$in": ids}})
+    return set(archived) & set(ids)
+
+async def archive_old_notifications(now: datetime = None) -> int:
+    """
+    Roll notifications older than the archive age up into per-user monthly
+    buckets and delete them from `notifications`.
+
+    Notifications are selected by _id, whose embedded creation time tracks
+    the timestamp, so the scan runs on the _id index. Each push only goes to
+    a bucket of the user and month with room for all of it, and upserts a
+    new bucket when there is none, so no bucket grows past
+    ARCHIVE_BUCKET_SIZE. Notifications already in a bucket after an
+    interrupted run are not pushed again. Returns the number archived.
+    """
+    notifications_collection = get_collection("notifications")
+    archive_collection = get_collection("notification_archive")
+    now = now or datetime.utcnow()
+    cutoff_id = ObjectId.from_datetime(now - timedelta(days=settings.NOTIFICATION_ARCHIVE_DAYS))
+
+    archived = 0
+    while True:
+        notifications = await notifications_collection.find(
+            {"_id": {"$lt": cutoff_id}}
+        ).sort("_id", 1).limit(RETENTION_CHUNK_SIZE).to_list(length=RETENTION_CHUNK_SIZE)
+        if not notifications:
+            return archived
+
+        already_archived = await _archived_ids(notifications)
+        buckets = {}
+        for notification in notifications:
+            if notification["_id"] in already_archived:
+                continue
+            created = notification["timestamp"] if isinstance(notification.get("timestamp"), datetime) else notification["_id"].generation_time
+            buckets.setdefault((notification["user_id"], month_key(created)), []).append(notification)
+
+        # Ordered, so a push sees the counts left by the pushes before it
+        operations = []
+        for (user_id, month), bucket in buckets.items():
+            for start in range(0, len(bucket), ARCHIVE_BUCKET_SIZE):
+                part = bucket[start:start + ARCHIVE_BUCKET_SIZE]
+                operations.append(UpdateOne(
+                    {"user_id": user_id, "month": month, "count": {"$lte": ARCHIVE_BUCKET_SIZE - len(part)}},
+                    {
+                        "$push": {"notifications": {"$each": part}},
+                        "$inc": {"count": len(part)},
+                        "$set": {"updated_at": now}
+                    },
+                    upsert=True
+                ))
+        if operations:
+            await archive_collection.bulk_write(operations)
+
+        archived += await _delete_counted(notifications)
+        await asyncio.sleep(RETENTION_CHUNK_PAUSE_SECONDS)
+
+async def apply_notification_retention(now: datetime = None) -> dict:
+    """Background job: archive old notifications and backfill read times for the TTL index"""
+    now = now or datetime.utcnow()
+    print("Running notification retention...")
+
+    # Archive first so read times aren't backfilled on notifications about to be archived
+    stats = {
+        "archived": await archive_old_notifications(now),
+        "read_at_backfilled": await _backfill_read_at(now)
+    }
+    print(f"Notification retention done: {stats['archived']} archived, {stats['read_at_backfilled']} read times backfilled")
+    return stats
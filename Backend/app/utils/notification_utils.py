@@ -1,37 +1,52 @@
 from datetime import datetime
 from bson import ObjectId
+from pymongo import UpdateOne
 from ..core.database import get_collection
 from ..models.notification import NotificationType
+from .notification_counters import insert_notifications
+from .notification_dispatcher import notification_dispatcher
+from .outbox import outbox_event, register_handler
+
+NOTIFICATION_EVENT = "notifications"
+
+def build_notification(user_id: str, type: NotificationType, title: str, message: str, related_id: str = None, related_data: dict = None):
+    """
+    Build a notification document ready to be inserted
+    """
+    # Convert any ObjectId values in related_data to strings
+    if related_data:
+        related_data = _serialize_objectids(related_data)
+    
+    notification_data = {
+        "user_id": user_id,
+        "type": type,
+        "title": title,
+        "message": message,
+        "timestamp": datetime.utcnow(),  # Stored as a BSON date, serialized as UTC with 'Z' by the API
+        "read": False
+    }
+    
+    if related_id:
+        notification_data["related_id"] = related_id
+    
+    if related_data:
+        notification_data["related_data"] = related_data
+    
+    return notification_data
 
 async def create_notification(user_id: str, type: NotificationType, title: str, message: str, related_id: str = None, related_data: dict = None):
     """
-    Create a new notification for a user
+    Create a new notification for a user.
+
+    The notification is queued as an outbox event and written by the
+    dispatcher and the relay, off the request path.
     """
     try:
-        notifications_collection = get_collection("notifications")
-        
-        # Convert any ObjectId values in related_data to strings
-        if related_data:
-            related_data = _serialize_objectids(related_data)
-        
-        notification_data = {
-            "user_id": user_id,
-            "type": type,
-            "title": title,
-            "message": message,
-            "timestamp": datetime.utcnow().replace(microsecond=0).isoformat() + "Z",  # Add 'Z' to indicate UTC
-            "read": False
-        }
-        
-        if related_id:
-            notification_data["related_id"] = related_id
-        
-        if related_data:
-            notification_data["related_data"] = related_data
+        notification_data = build_notification(user_id, type, title, message, related_id, related_data)
         
-        result = await notifications_collection.insert_one(notification_data)
-        print(f"Successfully created notification for user {user_id}, ID: {result.inserted_id}")
-        return str(result.inserted_id)
+        await notification_dispatcher.dispatch([notification_event([notification_data])])
+        print(f"Queued notification for user {user_id}, ID: {notification_data['_id']}")
+        return str(notification_data["_id"])
     except Exception as e:
         print(f"Error creating notification: {str(e)}")
         raise
@@ -49,131 +64,172 @@ def _serialize_objectids(data):
     else:
         return data
 
-async def send_loan_created_notifications(loan_data: dict):
+def loan_created_notifications(loan_data: dict):
     """
-    Send notifications when a loan is created
+    Build the notifications for a newly created loan
     - To the lender: Confirmation that loan was created
     - To the borrower: New loan notification
     """
-    # Ensure loan_data doesn't contain ObjectId
-    loan_data = _serialize_objectids(loan_data)
+    loan_id = str(loan_data.get("_id"))
+    notifications = []
     
-    # Send notification to borrower
+    # Notification to borrower
     if loan_data.get("borrower_id"):
         borrower_message = f"You've received a new loan offer of Rs {loan_data.get('amount', 0):,.2f} from {loan_data.get('lender_name', 'a lender')}."
-        await create_notification(
-            user_id=loan_data["borrower_id"],
+        notifications.append(build_notification(
+            user_id=str(loan_data["borrower_id"]),
             type=NotificationType.loan_approved,
             title="New Loan Offer",
             message=borrower_message,
-            related_id=str(loan_data.get("_id")),
+            related_id=loan_id,
             related_data={
                 "amount": loan_data.get("amount"),
                 "lender_name": loan_data.get("lender_name"),
                 "term_months": loan_data.get("term_months")
             }
-        )
+        ))
     
-    # Send notification to lender
+    # Notification to lender
     if loan_data.get("lender_id"):
         lender_message = f"You've created a new loan of Rs {loan_data.get('amount', 0):,.2f} for {loan_data.get('customer_name', 'a borrower')}."
-        await create_notification(
-            user_id=loan_data["lender_id"],
+        notifications.append(build_notification(
+            user_id=str(loan_data["lender_id"]),
             type=NotificationType.loan_approved,
             title="Loan Created",
             message=lender_message,
-            related_id=str(loan_data.get("_id")),
+            related_id=loan_id,
             related_data={
                 "amount": loan_data.get("amount"),
                 "customer_name": loan_data.get("customer_name"),
                 "term_months": loan_data.get("term_months")
             }
-        )
+        ))
+    
+    return notifications
 
-async def send_payment_notifications(payment_data: dict, loan_data: dict):
+def payment_notifications(payment_data: dict, loan_data: dict):
     """
-    Send notifications when a payment is made
+    Build the notifications for a payment
     - To the lender: Payment received notification
     - To the borrower: Payment confirmation
     """
-    try:
-        # Ensure data doesn't contain ObjectId
-        payment_data = _serialize_objectids(payment_data)
-        loan_data = _serialize_objectids(loan_data)
-        
-        # Send notification to borrower
-        if loan_data.get("borrower_id"):
-            try:
-                borrower_message = f"Your payment of Rs {payment_data.get('amount', 0):,.2f} for loan {loan_data.get('_id')} has been processed successfully."
-                await create_notification(
-                    user_id=loan_data["borrower_id"],
-                    type=NotificationType.payment_received,
-                    title="Payment Confirmed",
-                    message=borrower_message,
-                    related_id=str(loan_data.get("_id")),
-                    related_data={
-                        "amount": payment_data.get("amount"),
-                        "payment_id": str(payment_data.get("_id")),
-                        "lender_name": loan_data.get("lender_name")
-                    }
-                )
-                print(f"Successfully sent payment confirmation notification to borrower: {loan_data['borrower_id']}")
-            except Exception as e:
-                print(f"Error sending payment notification to borrower: {str(e)}")
-        
-        # Send notification to lender
-        if loan_data.get("lender_id"):
-            try:
-                lender_message = f"You've received a payment of Rs {payment_data.get('amount', 0):,.2f} from {loan_data.get('customer_name', 'a borrower')}."
-                await create_notification(
-                    user_id=loan_data["lender_id"],
-                    type=NotificationType.payment_received,
-                    title="Payment Received",
-                    message=lender_message,
-                    related_id=str(loan_data.get("_id")),
-                    related_data={
-                        "amount": payment_data.get("amount"),
-                        "payment_id": str(payment_data.get("_id")),
-                        "customer_name": loan_data.get("customer_name")
-                    }
-                )
-                print(f"Successfully sent payment received notification to lender: {loan_data['lender_id']}")
-            except Exception as e:
-                print(f"Error sending payment notification to lender: {str(e)}")
-    except Exception as e:
-        print(f"Error in send_payment_notifications: {str(e)}")
-
-async def send_payment_reminder(loan_data: dict, payment_data: dict, days_until_due: int):
-    """
-    Send payment reminder notifications
-    - To the borrower: Remind about upcoming payment
-    """
-    # Ensure data doesn't contain ObjectId
-    loan_data = _serialize_objectids(loan_data)
-    payment_data = _serialize_objectids(payment_data)
+    loan_id = str(loan_data.get("_id"))
+    payment_id = str(payment_data.get("_id"))
+    notifications = []
     
+    # Notification to borrower
     if loan_data.get("borrower_id"):
-        if days_until_due <= 0:
-            # Payment is overdue
-            days_overdue = abs(days_until_due)
-            title = "Payment Overdue"
-            message = f"Your payment of Rs {payment_data.get('amount', 0):,.2f} for loan {loan_data.get('_id')} is overdue by {days_overdue} day{'s' if days_overdue != 1 else ''}."
-            notification_type = NotificationType.payment_overdue
-        else:
-            # Payment is upcoming
-            title = "Payment Due Soon"
-            message = f"Your payment of Rs {payment_data.get('amount', 0):,.2f} for loan {loan_data.get('_id')} is due in {days_until_due} day{'s' if days_until_due != 1 else ''}."
-            notification_type = NotificationType.payment_due
-            
-        await create_notification(
-            user_id=loan_data["borrower_id"],
-            type=notification_type,
-            title=title,
-            message=message,
-            related_id=str(loan_data.get("_id")),
+        borrower_message = f"Your payment of Rs {payment_data.get('amount', 0):,.2f} for loan {loan_id} has been processed successfully."
+        notifications.append(build_notification(
+            user_id=str(loan_data["borrower_id"]),
+            type=NotificationType.payment_received,
+            title="Payment Confirmed",
+            message=borrower_message,
+            related_id=loan_id,
             related_data={
                 "amount": payment_data.get("amount"),
-                "due_date": payment_data.get("due_date").isoformat() if isinstance(payment_data.get("due_date"), datetime) else payment_data.get("due_date"),
+                "payment_id": payment_id,
                 "lender_name": loan_data.get("lender_name")
             }
-        )
\ No newline at end of file
+        ))
+    
+    # Notification to lender
+    if loan_data.get("lender_id"):
+        lender_message = f"You've received a payment of Rs {payment_data.get('amount', 0):,.2f} from {loan_data.get('customer_name', 'a borrower')}."
+        notifications.append(build_notification(
+            user_id=str(loan_data["lender_id"]),
+            type=NotificationType.payment_received,
+            title="Payment Received",
+            message=lender_message,
+            related_id=loan_id,
+            related_data={
+                "amount": payment_data.get("amount"),
+                "payment_id": payment_id,
+                "customer_name": loan_data.get("customer_name")
+            }
+        ))
+    
+    return notifications
+
+def notification_event(notifications: list):
+    """
+    Outbox event that delivers notifications.
+
+    Ids are assigned up front so a redelivered event doesn't create duplicates.
+    """
+    for notification in notifications:
+        notification.setdefault("_id", ObjectId())
+    return outbox_event(NOTIFICATION_EVENT, {"notifications": notifications})
+
+async def deliver_notifications(payloads: list):
+    """Write the notifications of a batch of outbox events, skipping ones already written"""
+    await insert_notifications([notification for payload in payloads for notification in payload["notifications"]])
+
+register_handler(NOTIFICATION_EVENT, deliver_notifications)
+
+def build_payment_reminder(loan_data: dict, payment_data: dict, days_until_due: int):
+    """
+    Build the payment reminder notification for a borrower
+    - Upcoming payment when days_until_due > 0, overdue payment otherwise
+    """
+    if days_until_due <= 0:
+        # Payment is overdue
+        days_overdue = abs(days_until_due)
+        title = "Payment Overdue"
+        message = f"Your payment of Rs {payment_data.get('amount', 0):,.2f} for loan {loan_data.get('_id')} is overdue by {days_overdue} day{'s' if days_overdue != 1 else ''}."
+        notification_type = NotificationType.payment_overdue
+    else:
+        # Payment is upcoming
+        title = "Payment Due Soon"
+        message = f"Your payment of Rs {payment_data.get('amount', 0):,.2f} for loan {loan_data.get('_id')} is due in {days_until_due} day{'s' if days_until_due != 1 else ''}."
+        notification_type = NotificationType.payment_due
+    
+    return build_notification(
+        user_id=loan_data["borrower_id"],
+        type=notification_type,
+        title=title,
+        message=message,
+        related_id=str(loan_data.get("_id")),
+        related_data={
+            "amount": payment_data.get("amount"),
+            "due_date": payment_data.get("due_date").isoformat() if isinstance(payment_data.get("due_date"), datetime) else payment_data.get("due_date"),
+            "lender_name": loan_data.get("lender_name")
+        }
+    )
+
+async def migrate_notification_timestamps(batch_size: int = 1000) -> int:
+    """
+    Convert notifications whose timestamp is still an ISO string to native dates.
+
+    Safe to re-run: only string timestamps are selected, in _id order.
+    Returns the number of notifications converted.
+    """
+    notifications_collection = get_collection("notifications")
+    
+    converted = 0
+    last_id = None
+    while True:
+        query = {"timestamp": {"$type": "string"}}
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+        
+        notifications = await notifications_collection.find(query, {"timestamp": 1}).sort("_id", 1).limit(batch_size).to_list(length=batch_size)
+        if not notifications:
+            break
+        last_id = notifications[-1]["_id"]
+        
+        operations = []
+        for notification in notifications:
+            try:
+                timestamp = datetime.fromisoformat(notification["timestamp"].replace('Z', '+00:00')).replace(tzinfo=None)
+            except ValueError:
+                print(f"Skipping notification {notification['_id']}: invalid timestamp {notification['timestamp']!r}")
+                continue
+            operations.append(UpdateOne({"_id": notification["_id"]}, {"$set": {"timestamp": timestamp}}))
+        
+        if operations:
+            result = await notifications_collection.bulk_write(operations, ordered=False)
+            converted += result.modified_count
+        print(f"Converted {converted} notification timestamps")
+    
+    return converted
@@ -0,0 +1,141 @@
+"""
+Transactional outbox for side effects of loan and payment writes.
+
+Events are inserted into the `outbox` collection in the same transaction as
+the write that caused them, so they exist exactly when that write committed.
+A relay running next to the job scheduler claims due events in batches, hands
+them to the handler registered for their type and retries failures with
+exponential backoff.
+"""
+import asyncio
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import List
+from pymongo import UpdateOne
+
+from ..core.database import get_collection
+
+OUTBOX_BATCH_SIZE = 100
+
+# How long the relay sleeps when there is nothing to deliver
+OUTBOX_POLL_SECONDS = 1
+
+# A claimed batch not finished within this time is picked up again by any relay
+OUTBOX_CLAIM_SECONDS = 60
+
+# Retry delays grow from OUTBOX_BACKOFF_SECONDS up to OUTBOX_MAX_BACKOFF_SECONDS
+OUTBOX_BACKOFF_SECONDS = 5
+OUTBOX_MAX_BACKOFF_SECONDS = 3600
+OUTBOX_MAX_ATTEMPTS = 10
+
+HANDLERS = {}
+
+def register_handler(event_type: str, handler):
+    """
+    Declare how events of a type are delivered.
+
+    `handler` is an async callable taking the payloads of a batch of events.
+    It may be called again with the same payloads after a failure, so
+    deliveries must be idempotent.
+    """
+    HANDLERS[event_type] = handler
+
+def outbox_event(event_type: str, payload: dict) -> dict:
+    now = datetime.utcnow()
+    return {
+        "type": event_type,
+        "payload": payload,
+        "status": "pending",
+        "attempts": 0,
+        "available_at": now,
+        "created_at": now
+    }
+
+async def add_outbox_events(events: List[dict], session=None):
+    """Store events, inside the caller's transaction when a session is given"""
+    if events:
+        await get_collection("outbox").insert_many(events, session=session)
+
+def retry_delay(attempts: int) -> float:
+    return min(OUTBOX_BACKOFF_SECONDS * 2 ** (attempts - 1), OUTBOX_MAX_BACKOFF_SECONDS)
+
+async def _claim_batch(batch_size: int = OUTBOX_BATCH_SIZE) -> List[dict]:
+    """
+    Claim up to `batch_size` due events.
+
+    Claiming pushes `available_at` past the claim timeout, so other relays
+    skip the events while this one delivers them, and pick them up again if
+    it dies before finishing.
+    """
+    outbox_collection = get_collection("outbox")
+    now = datetime.utcnow()
+
+    due = await outbox_collection.find(
+        {"status": "pending", "available_at": {"$lte": now}},
+        {"_id": 1}
+    ).sort("available_at", 1).limit(batch_size).to_list(length=batch_size)
+    if not due:
+        return []
+
+    claim = uuid.uuid4().hex
+    await outbox_collection.update_many(
+        {"_id": {"$in": [event["_id"] for event in due]}, "status": "pending", "available_at": {"$lte": now}},
+        {"$set": {"claim": claim, "available_at": now + timedelta(seconds=OUTBOX_CLAIM_SECONDS)}}
+    )
+    return await outbox_collection.find({"claim": claim}).to_list(length=batch_size)
+
+async def _record_failure(events: List[dict], error: str):
+    now = datetime.utcnow()
+    operations = []
+    for event in events:
+        attempts = event.get("attempts", 0) + 1
+        update = {"attempts": attempts, "last_error": error, "claim": None}
+        if attempts >= OUTBOX_MAX_ATTEMPTS:
+            update["status"] = "failed"
+        else:
+            update["available_at"] = now + timedelta(seconds=retry_delay(attempts))
+        operations.append(UpdateOne({"_id": event["_id"]}, {"$set": update}))
+    await get_collection("outbox").bulk_write(operations, ordered=False)
+
+async def relay_once(batch_size: int = OUTBOX_BATCH_SIZE) -> int:
+    """Deliver one batch of due events. Returns the number of events claimed."""
+    events = await _claim_batch(batch_size)
+    if not events:
+        return 0
+
+    by_type = defaultdict(list)
+    for event in events:
+        by_type[event["type"]].append(event)
+
+    outbox_collection = get_collection("outbox")
+    for event_type, typed_events in by_type.items():
+        handler = HANDLERS.get(event_type)
+        try:
+            if handler is None:
+                raise ValueError(f"No handler registered for outbox event type {event_type}")
+            await handler([event["payload"] for event in typed_events])
+        except Exception as e:
+            print(f"Error delivering {len(typed_events)} {event_type} outbox events: {str(e)}")
+            await _record_failure(typed_events, str(e))
+            continue
+
+        await outbox_collection.update_many(
+            {"_id": {"$in": [event["_id"] for event in typed_events]}},
+            {"$set": {"status": "delivered", "delivered_at": datetime.utcnow(), "claim": None}}
+        )
+
+    return len(events)
+
+async def run_outbox_relay():
+    """Relay loop, safe to start in every process"""
+    print(f"Starting outbox relay for event types: {', '.join(HANDLERS)}")
+    while True:
+        try:
+            claimed = await relay_once()
+        except Exception as e:
+            print(f"Error in outbox relay: {e}")
+            claimed = 0
+
+        if claimed < OUTBOX_BATCH_SIZE:
+            await asyncio.sleep(OUTBOX_POLL_SECONDS)
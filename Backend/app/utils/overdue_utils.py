@@ -0,0 +1,246 @@
+"""
+Nightly overdue detection and late-fee accrual.
+
+Installments of active loans that are past due move PENDING -> LATE after a
+grace period and LATE -> MISSED once they are a month overdue. Overdue
+installments accrue a daily late fee on their amount until they are paid or
+their loan stops being active. Every step is a bulk update driven by the
+(status, loan_active, due_date, _id) index and everything is computed from the
+run day, so running the batch twice on the same day changes nothing.
+
+Accrued fees are kept on the loan as `late_fees`, owed on top of
+`remaining_amount`; `remaining_amount` stays the unpaid part of the scheduled
+total, which is what the lender summaries derive outstanding principal from.
+"""
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from ..core.config import settings
+from ..core.database import get_collection, run_in_transaction
+from .installment_utils import ACTIVE_LOAN_STATUSES, sync_installments_loan_status
+from .portfolio_utils import record_overdue_change
+
+# Days after the due date before an installment counts as late, and as missed
+LATE_AFTER_DAYS = 3
+MISSED_AFTER_DAYS = 30
+
+# Installments moved to LATE per bulk update
+OVERDUE_CHUNK_SIZE = 1000
+
+OVERDUE_STATUSES = ["LATE", "MISSED"]
+
+# Checkpoint of the last loan status sync; the next sync only checks loans
+# updated since, going back SYNC_OVERLAP for writes that committed late
+SYNC_CHECKPOINT_ID = "overdue:loan_status_sync"
+SYNC_OVERLAP = timedelta(hours=1)
+
+def run_day(now: datetime = None) -> datetime:
+    """Midnight (UTC) of the day the batch runs for; every computation is relative to it"""
+    now = now or datetime.utcnow()
+    return datetime(now.year, now.month, now.day)
+
+async def _sync_loan_status() -> int:
+    """
+    Catch status changes that didn't reach the installments of their loan.
+
+    The first run checks every normalized loan, which also sets `loan_active`
+    on installments written before it existed.
+    """
+    checkpoints_collection = get_collection("job_checkpoints")
+    started = datetime.utcnow()
+
+    checkpoint = await checkpoints_collection.find_one({"_id": SYNC_CHECKPOINT_ID})
+    changed_since = checkpoint["synced_at"] - SYNC_OVERLAP if checkpoint else None
+    changed = await sync_installments_loan_status(changed_since=changed_since)
+
+    await checkpoints_collection.update_one(
+        {"_id": SYNC_CHECKPOINT_ID}, {"$set": {"synced_at": started}}, upsert=True
+    )
+    return changed
+
+async def _mark_late(today: datetime, chunk_size: int = OVERDUE_CHUNK_SIZE) -> int:
+    """
+    Move pending installments past the grace period to LATE.
+
+    Works in (due_date, _id) chunks so each lender's overdue counter can be
+    adjusted by exactly the installments this run moved.
+    """
+    installments_collection = get_collection("installments")
+    cutoff = today - timedelta(days=LATE_AFTER_DAYS)
+
+    marked = 0
+    while True:
+        installments = await installments_collection.find(
+            {"status": "PENDING", "loan_active": True, "due_date": {"$lt": cutoff}},
+            {"lender_id": 1}
+        ).sort([("due_date", 1), ("_id", 1)]).limit(chunk_size).to_list(length=chunk_size)
+        if not installments:
+            return marked
+
+        ids = [installment["_id"] for installment in installments]
+
+        # The move and the counter changes commit together
+        async def write(session, installments=installments):
+            result = await installments_collection.update_many(
+                {"_id": {"$in": ids}, "status": "PENDING"},
+                {"$set": {"status": "LATE", "late_since": today}},
+                session=session
+            )
+
+            if result.modified_count != len(ids):
+                # Some were paid in between; count only the ones this run moved
+                installments = await installments_collection.find(
+                    {"_id": {"$in": ids}, "status": "LATE", "late_since": today},
+                    {"lender_id": 1},
+                    session=session
+                ).to_list(length=None)
+
+            for lender_id, count in Counter(installment.get("lender_id") for installment in installments).items():
+                await record_overdue_change(lender_id, count, session=session)
+            return result.modified_count
+
+        marked += await run_in_transaction(write)
+
+async def _mark_missed(today: datetime) -> int:
+    """Move late installments a month past due to MISSED (they stay overdue, so counters don't change)"""
+    result = await get_collection("installments").update_many(
+        {"status": "LATE", "loan_active": True, "due_date": {"$lt": today - timedelta(days=MISSED_AFTER_DAYS)}},
+        {"$set": {"status": "MISSED"}}
+    )
+    return result.modified_count
+
+async def _accrue_fees(today: datetime) -> int:
+    """
+    Set each overdue installment's late fee for the run day.
+
+    The fee is recomputed from the number of days overdue rather than
+    incremented, and installments already priced for today are skipped.
+    """
+    days_overdue = {"$floor": {"$divide": [{"$subtract": [today, "$due_date"]}, 24 * 3600 * 1000]}}
+    result = await get_collection("installments").update_many(
+        {"status": {"$in": OVERDUE_STATUSES}, "loan_active": True, "late_fee_date": {"$ne": today}},
+        [{"$set": {
+            "late_fee": {"$round": [
+                {"$multiply": [{"$ifNull": ["$amount", 0]}, settings.LATE_FEE_DAILY_RATE, days_overdue]}, 2
+            ]},
+            "late_fee_date": today
+        }}]
+    )
+    return result.modified_count
+
+async def _overdue_loan_ids(chunk_size: int):
+    """Ids of active loans with overdue installments, streamed in chunks"""
+    cursor = get_collection("installments").aggregate([
+        {"$match": {"status": {"$in": OVERDUE_STATUSES}, "loan_active": True}},
+        {"$group": {"_id": "$loan_id"}}
+    ], allowDiskUse=True, batchSize=chunk_size)
+
+    chunk = []
+    async for group in cursor:
+        chunk.append(group["_id"])
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+async def _update_loan_fees(today: datetime, chunk_size: int = OVERDUE_CHUNK_SIZE) -> int:
+    """Store the total late fees on every loan that accrued fees today, separately from `remaining_amount`"""
+    installments_collection = get_collection("installments")
+
+    updated = 0
+    async for chunk in _overdue_loan_ids(chunk_size):
+        cursor = installments_collection.aggregate([
+            {"$match": {"loan_id": {"$in": chunk}, "late_fee": {"$gt": 0}}},
+            {"$group": {"_id": "$loan_id", "late_fees": {"$sum": "$late_fee"}}}
+        ])
+        operations = [
+            UpdateOne(
+                {"_id": ObjectId(total["_id"])},
+                {"$set": {"late_fees": round(total["late_fees"], 2), "late_fees_updated_at": today}}
+            )
+            async for total in cursor
+        ]
+        if operations:
+            result = await get_collection("loans").bulk_write(operations, ordered=False)
+            updated += result.modified_count
+    return updated
+
+async def _mark_embedded(today: datetime) -> int:
+    """
+    Flag overdue payments on loans that still embed their schedule.
+
+    Only statuses are set here; late fees are accrued once a loan's schedule
+    has been moved to the installments collection.
+    """
+    loans_collection = get_collection("loans")
+    late_cutoff = today - timedelta(days=LATE_AFTER_DAYS)
+    missed_cutoff = today - timedelta(days=MISSED_AFTER_DAYS)
+    legacy = {"installments_normalized": {"$ne": True}, "status": {"$in": ACTIVE_LOAN_STATUSES}}
+
+    marked = 0
+    loans = loans_collection.find(
+        {**legacy, "payments": {"$elemMatch": {"status": "PENDING", "due_date": {"$lt": late_cutoff}}}},
+        {"lender_id": 1, "payments.status": 1, "payments.due_date": 1}
+    )
+    async for loan in loans:
+        count = sum(
+            1 for payment in loan.get("payments", [])
+            if payment.get("status") == "PENDING"
+            and isinstance(payment.get("due_date"), datetime) and payment["due_date"] < late_cutoff
+        )
+
+        async def write(session, loan=loan, count=count):
+            result = await loans_collection.update_one(
+                {"_id": loan["_id"]},
+                {"$set": {"payments.$[overdue].status": "LATE", "payments.$[overdue].late_since": today}},
+                array_filters=[{"overdue.status": "PENDING", "overdue.due_date": {"$lt": late_cutoff}}],
+                session=session
+            )
+            if not result.modified_count:
+                return 0
+            await record_overdue_change(loan.get("lender_id"), count, session=session)
+            return count
+
+        marked += await run_in_transaction(write)
+
+    await loans_collection.update_many(
+        {**legacy, "payments": {"$elemMatch": {"status": "LATE", "due_date": {"$lt": missed_cutoff}}}},
+        {"$set": {"payments.$[overdue].status": "MISSED"}},
+        array_filters=[{"overdue.status": "LATE", "overdue.due_date": {"$lt": missed_cutoff}}]
+    )
+    return marked
+
+async def process_overdue_installments(now: datetime = None) -> dict:
+    """
+    Mark overdue installments and accrue late fees for the current day.
+
+    Returns the counts for each step along with the elapsed time.
+    """
+    today = run_day(now)
+    print(f"Running overdue installment batch for {today.date()}...")
+    started = time.perf_counter()
+
+    stats = {
+        "day": today,
+        "installments_resynced": await _sync_loan_status(),
+        "marked_late": await _mark_late(today),
+        "marked_missed": await _mark_missed(today),
+        "fees_accrued": await _accrue_fees(today),
+    }
+    stats["loans_updated"] = await _update_loan_fees(today)
+    stats["embedded_marked_late"] = await _mark_embedded(today)
+    stats["duration_seconds"] = time.perf_counter() - started
+
+    processed = stats["marked_late"] + stats["marked_missed"] + stats["fees_accrued"] + stats["embedded_marked_late"]
+    rate = processed / stats["duration_seconds"] if stats["duration_seconds"] else 0
+    print(
+        f"Overdue batch done in {stats['duration_seconds']:.2f}s: "
+        f"{stats['marked_late']} late, {stats['marked_missed']} missed, "
+        f"{stats['fees_accrued']} fees accrued on {stats['loans_updated']} loans, "
+        f"{stats['embedded_marked_late']} embedded payments late ({rate:.0f} updates/s)"
+    )
+    return stats
@@ -0,0 +1,249 @@
+from datetime import datetime
+
+from pymongo.errors import DuplicateKeyError
+
+from ..core.database import get_collection
+from ..models.loan import LoanStatus
+from .installment_utils import lookup_installments_stages
+
+# Loans in these states no longer carry outstanding principal
+CLOSED_LOAN_STATUSES = ["COMPLETED", "REJECTED"]
+OVERDUE_PAYMENT_STATUSES = ["LATE", "MISSED"]
+LOAN_STATUSES = {loan_status.value for loan_status in LoanStatus}
+
+# Attempts at storing a rebuilt summary while increments keep landing on it
+REBUILD_ATTEMPTS = 5
+
+def month_key(when: datetime = None) -> str:
+    """Key used to bucket collections by calendar month, e.g. '2025-04'"""
+    when = when or datetime.utcnow()
+    return when.strftime("%Y-%m")
+
+def principal_share(loan: dict, amount: float) -> float:
+    """
+    Portion of a repayment that goes towards principal.
+
+    Interest is charged flat over the whole term, so every repayment reduces
+    principal in the same proportion as amount / total_amount.
+    """
+    total_amount = loan.get("total_amount") or 0
+    if total_amount <= 0:
+        return 0
+    return amount * loan.get("amount", 0) / total_amount
+
+def _status_field(status: str):
+    """Counter path of a loan status, or None for a value that isn't one"""
+    return f"loans_by_status.{status}" if status in LOAN_STATUSES else None
+
+async def _apply_increments(lender_id: str, increments: dict, session=None):
+    """
+    Apply $inc updates to a lender summary.
+
+    Every increment bumps the summary's version, so a rebuild running at the
+    same time notices it and starts over. A summary that doesn't exist yet is
+    created holding only the increments; it isn't `materialized`, so the first
+    read rebuilds it from the loans and payments collections.
+
+    Pass the session of the write being accounted for, so the change and its
+    increment commit together and a rebuild can't see one without the other;
+    errors then abort that write.
+    """
+    if not lender_id or not increments:
+        return
+
+    summaries_collection = get_collection("lender_summaries")
+    try:
+        await summaries_collection.update_one(
+            {"_id": lender_id},
+            {"$inc": {**increments, "version": 1}, "$set": {"updated_at": datetime.utcnow()}},
+            upsert=True,
+            session=session
+        )
+    except Exception as e:
+        if session is not None:
+            raise
+        print(f"Error updating lender summary for {lender_id}: {str(e)}")
+
+def _status_increments(loan: dict, old_status: str, new_status: str, remaining_amount: float) -> dict:
+    """Counter changes for moving a loan from one status to another"""
+    if not old_status or old_status == new_status:
+        return {}
+
+    increments = {}
+    if _status_field(old_status):
+        increments[_status_field(old_status)] = -1
+    if _status_field(new_status):
+        increments[_status_field(new_status)] = 1
+
+    # Closing or reopening a loan moves its remaining principal out of / into the book
+    was_open = old_status not in CLOSED_LOAN_STATUSES
+    is_open = new_status not in CLOSED_LOAN_STATUSES
+    if was_open != is_open:
+        outstanding = principal_share(loan, max(0, remaining_amount))
+        increments["outstanding_principal"] = outstanding if is_open else -outstanding
+
+    return increments
+
+async def record_loan_created(loan: dict, session=None):
+    """Add a newly issued loan to its lender's summary"""
+    status = loan.get("status", "PENDING")
+    increments = {_status_field(status): 1} if _status_field(status) else {}
+    if status not in CLOSED_LOAN_STATUSES:
+        increments["outstanding_principal"] = loan.get("amount", 0)
+
+    await _apply_increments(loan.get("lender_id"), increments, session=session)
+
+async def record_loan_payment(loan: dict, amount: float, new_status: str, paid_at: datetime = None, session=None):
+    """
+    Account for a repayment on a loan.
+
+    `loan` is the loan document as it was before the payment was applied.
+    """
+    remaining_before = loan.get("remaining_amount", loan.get("total_amount", 0) - loan.get("total_paid", 0))
+    applied = min(amount, max(0, remaining_before))
+
+    paid_at = paid_at if isinstance(paid_at, datetime) else None
+    increments = {f"collected_by_month.{month_key(paid_at)}": amount}
+    if loan.get("status") not in CLOSED_LOAN_STATUSES:
+        increments["outstanding_principal"] = -principal_share(loan, applied)
+
+    status_increments = _status_increments(
+        loan, loan.get("status"), new_status, remaining_before - applied
+    )
+    # The status change already removes whatever principal was left
+    if "outstanding_principal" in status_increments:
+        status_increments["outstanding_principal"] += increments.pop("outstanding_principal", 0)
+    increments.update(status_increments)
+
+    await _apply_increments(loan.get("lender_id"), increments, session=session)
+
+async def record_loan_status_change(loan: dict, new_status: str, session=None):
+    """Account for a manual status change on a loan"""
+    increments = _status_increments(
+        loan, loan.get("status"), new_status, loan.get("remaining_amount", 0)
+    )
+    await _apply_increments(loan.get("lender_id"), increments, session=session)
+
+async def record_overdue_change(lender_id: str, delta: int, session=None):
+    """Adjust the number of overdue installments in a lender's portfolio"""
+    if delta:
+        await _apply_increments(lender_id, {"overdue_count": delta}, session=session)
+
+async def _compute_lender_summary(lender_id: str) -> dict:
+    loans_collection = get_collection("loans")
+    payments_collection = get_collection("payments")
+
+    loans_cursor = loans_collection.aggregate([
+        {"$match": {"lender_id": lender_id}},
+        *lookup_installments_stages(),
+        {"$project": {
+            "status": 1,
+            "outstanding": {"$cond": [
+                {"$and": [
+                    {"$not": [{"$in": ["$status", CLOSED_LOAN_STATUSES]}]},
+                    {"$gt": [{"$ifNull": ["$total_amount", 0]}, 0]}
+                ]},
+                {"$divide": [
+                    {"$multiply": [
+                        {"$ifNull": ["$amount", 0]},
+                        {"$max": [{"$ifNull": ["$remaining_amount", 0]}, 0]}
+                    ]},
+                    "$total_amount"
+                ]},
+                0
+            ]},
+            "overdue": {"$size": {"$filter": {
+                "input": {"$ifNull": ["$payments", []]},
+                "as": "payment",
+                "cond": {"$in": ["$$payment.status", OVERDUE_PAYMENT_STATUSES]}
+            }}}
+        }},
+        {"$group": {
+            "_id": "$status",
+            "count": {"$sum": 1},
+            "outstanding": {"$sum": "$outstanding"},
+            "overdue": {"$sum": "$overdue"},
+            "loan_ids": {"$push": {"$toString": "$_id"}}
+        }}
+    ])
+    groups = await loans_cursor.to_list(length=None)
+
+    loan_ids = [loan_id for group in groups for loan_id in group["loan_ids"]]
+    collected_by_month = {}
+    if loan_ids:
+        payments_cursor = payments_collection.aggregate([
+            {"$match": {"loan_id": {"$in": loan_ids}, "status": "COMPLETED"}},
+            {"$group": {
+                "_id": {"$dateToString": {"format": "%Y-%m", "date": "$created_at"}},
+                "total": {"$sum": "$amount"}
+            }}
+        ])
+        async for bucket in payments_cursor:
+            if bucket["_id"]:
+                collected_by_month[bucket["_id"]] = bucket["total"]
+
+    return {
+        "outstanding_principal": sum(group["outstanding"] for group in groups),
+        "overdue_count": sum(group["overdue"] for group in groups),
+        "loans_by_status": {group["_id"]: group["count"] for group in groups if group["_id"] in LOAN_STATUSES},
+        "collected_by_month": collected_by_month,
+        "materialized": True,
+        "updated_at": datetime.utcnow()
+    }
+
+async def rebuild_lender_summary(lender_id: str) -> dict:
+    """
+    Recompute a lender summary from scratch and store it.
+
+    The summary is only stored if no increment landed on it while the loans
+    and payments were aggregated; otherwise the aggregation may have missed
+    a change the increment already accounted for, so it is redone.
+    """
+    summaries_collection = get_collection("lender_summaries")
+    for _ in range(REBUILD_ATTEMPTS):
+        current = await summaries_collection.find_one({"_id": lender_id}, {"version": 1})
+        summary = await _compute_lender_summary(lender_id)
+        try:
+            if current is None:
+                await summaries_collection.insert_one({"_id": lender_id, "version": 0, **summary})
+            else:
+                summary["version"] = current.get("version", 0)
+                result = await summaries_collection.replace_one(
+                    {"_id": lender_id, "version": current.get("version")},
+                    summary
+                )
+                if not result.matched_count:
+                    continue
+        except DuplicateKeyError:
+            continue
+        summary["_id"] = lender_id
+        return summary
+
+    # Left for the next read or reconciliation to rebuild
+    print(f"Lender summary for {lender_id} kept changing during rebuild")
+    summary["_id"] = lender_id
+    return summary
+
+async def get_lender_summary(lender_id: str) -> dict:
+    """Read a lender summary, materializing it on first access"""
+    summaries_collection = get_collection("lender_summaries")
+    summary = await summaries_collection.find_one({"_id": lender_id})
+    if not summary or not summary.get("materialized"):
+        summary = await rebuild_lender_summary(lender_id)
+    return summary
+
+async def reconcile_lender_summaries():
+    """
+    Background job: rebuild every materialized lender summary, correcting
+    any drift left by increments that failed to apply.
+    """
+    summaries_collection = get_collection("lender_summaries")
+    rebuilt = 0
+    async for summary in summaries_collection.find({}, {"_id": 1}):
+        try:
+            await rebuild_lender_summary(summary["_id"])
+            rebuilt += 1
+        except Exception as e:
+            print(f"Error rebuilding lender summary for {summary['_id']}: {str(e)}")
+    print(f"Rebuilt {rebuilt} lender summaries")
+    return rebuilt
@@ -1,74 +1,298 @@
 import asyncio
 from datetime import datetime, timedelta
-from motor.motor_asyncio import AsyncIOMotorClient
+from functools import partial
 from bson import ObjectId
+from pymongo.errors import BulkWriteError
 
 from ..core.config import settings
-from ..utils.notification_utils import send_payment_reminder, _serialize_objectids
+from ..core.database import get_collection
+from ..utils.installment_utils import shard_of, shard_slot_range
+from ..utils.notification_utils import build_payment_reminder
+from ..utils.notification_counters import insert_notifications
+from ..utils.job_scheduler import register_job, run_scheduler
+from ..utils.overdue_utils import process_overdue_installments
+from ..utils.outbox import run_outbox_relay
+from ..utils.notification_retention import apply_notification_retention
+from ..utils.media_gc import collect_orphaned_media
+from ..utils.portfolio_utils import reconcile_lender_summaries
 
-async def check_payments():
+ACTIVE_LOAN_STATUSES = ["ACTIVE", "APPROVED"]
+
+# Reminders go out the day before a payment is due and the day after it was missed
+REMINDER_DAYS = [1, -1]
+
+DUPLICATE_KEY_ERROR = 11000
+
+# Installments processed between checkpoints
+REMINDER_CHUNK_SIZE = 500
+
+# A checkpoint older than this belongs to an abandoned run and is not resumed
+RESUME_WITHIN = timedelta(hours=1)
+
+# A failed run is retried this soon, well within RESUME_WITHIN, so it resumes from its checkpoint
+REMINDER_RETRY_SECONDS = 300
+
+def reminder_windows(now: datetime):
     """
-    Check for upcoming and overdue payments and send notifications
+    Due date ranges that produce a reminder when checked at `now`.
+
+    (due_date - now).days == d exactly when due_date falls in [now + d days, now + d+1 days).
     """
-    print("Running scheduled payment check...")
-    
-    # Connect to MongoDB directly
-    client = AsyncIOMotorClient(settings.MONGODB_URL)
-    db = client[settings.MONGODB_DB_NAME]
-    loans_collection = db["loans"]
-    notifications_collection = db["notifications"]
-    
-    # Get current date
-    now = datetime.utcnow()
-    
-    # Find active loans
-    cursor = loans_collection.find({"status": {"$in": ["ACTIVE", "APPROVED"]}})
-    active_loans = await cursor.to_list(length=100)
-    
-    for loan in active_loans:
-        # Convert the loan to a serializable format
-        loan = _serialize_objectids(loan)
-        
-        # Check each pending payment
-        for payment in loan.get("payments", []):
-            if payment.get("status") != "PENDING":
-                continue
-                
-            due_date = payment.get("due_date")
-            if not due_date:
+    return {
+        days: (now + timedelta(days=days), now + timedelta(days=days + 1))
+        for days in REMINDER_DAYS
+    }
+
+def _due_date_clauses(windows, field: str = "due_date"):
+    return [{field: {"$gte": start, "$lt": end}} for start, end in windows.values()]
+
+def _parse_due_date(due_date):
+    if isinstance(due_date, str):
+        return datetime.fromisoformat(due_date.replace('Z', '+00:00')).replace(tzinfo=None)
+    return due_date
+
+async def _installment_chunks(window, shard_index: int, shard_count: int, after=None, chunk_size: int = REMINDER_CHUNK_SIZE):
+    """
+    Pending installments of this shard due inside one reminder window, in
+    (shard_slot, due_date, _id) order.
+
+    Each chunk is a range scan on the (status, shard_slot, due_date, _id)
+    index over this shard's slots, starting after the last processed key,
+    filtered down to active loans with a single lookup. Yields
+    (candidates, last_key) per chunk.
+    """
+    installments_collection = get_collection("installments")
+    loans_collection = get_collection("loans")
+    start, end = window
+    slot_start, slot_end = shard_slot_range(shard_index, shard_count)
+
+    while True:
+        query = {
+            "status": "PENDING",
+            "shard_slot": {"$gte": slot_start, "$lt": slot_end},
+            "due_date": {"$gte": start, "$lt": end}
+        }
+        if after:
+            last_slot, last_due_date, last_id = after
+            query["$or"] = [
+                {"shard_slot": {"$gt": last_slot}},
+                {"shard_slot": last_slot, "due_date": {"$gt": last_due_date}},
+                {"shard_slot": last_slot, "due_date": last_due_date, "_id": {"$gt": last_id}}
+            ]
+
+        installments = await installments_collection.find(
+            query,
+            {"loan_id": 1, "seq": 1, "amount": 1, "due_date": 1, "shard_slot": 1}
+        ).sort([("shard_slot", 1), ("due_date", 1), ("_id", 1)]).limit(chunk_size).to_list(length=chunk_size)
+        if not installments:
+            return
+        last = installments[-1]
+        after = [last["shard_slot"], last["due_date"], last["_id"]]
+
+        loan_ids = list({ObjectId(installment["loan_id"]) for installment in installments})
+        loans = await loans_collection.find(
+            {"_id": {"$in": loan_ids}, "status": {"$in": ACTIVE_LOAN_STATUSES}},
+            {"borrower_id": 1, "lender_name": 1}
+        ).to_list(length=None)
+        loans_by_id = {str(loan["_id"]): loan for loan in loans}
+
+        yield [
+            (loans_by_id[installment["loan_id"]], installment["seq"], installment)
+            for installment in installments
+            if installment["loan_id"] in loans_by_id
+        ], after
+
+async def _embedded_chunks(windows, shard_index: int, shard_count: int, after=None, chunk_size: int = REMINDER_CHUNK_SIZE):
+    """
+    Pending payments due inside the reminder windows on loans that still
+    embed their schedule (not yet moved to the installments collection),
+    in loan _id order. Yields (candidates, last_key) per chunk.
+
+    These loans are on their way out, so they are still split across shards
+    after being read.
+    """
+    loans_collection = get_collection("loans")
+
+    while True:
+        query = {
+            "installments_normalized": {"$ne": True},
+            "status": {"$in": ACTIVE_LOAN_STATUSES},
+            "$or": [
+                {"payments": {"$elemMatch": {"status": "PENDING", **clause}}}
+                for clause in _due_date_clauses(windows)
+            ]
+        }
+        if after:
+            query["_id"] = {"$gt": after}
+
+        loans = await loans_collection.find(
+            query,
+            {"borrower_id": 1, "lender_name": 1, "payments": 1}
+        ).sort("_id", 1).limit(chunk_size).to_list(length=chunk_size)
+        if not loans:
+            return
+        after = loans[-1]["_id"]
+
+        candidates = []
+        for loan in loans:
+            if shard_of(loan["_id"], shard_count) != shard_index:
                 continue
-                
-            # Calculate days until payment is due
-            if isinstance(due_date, str):
-                due_date = datetime.fromisoformat(due_date.replace('Z', '+00:00'))
-            
+            for seq, payment in enumerate(loan.get("payments", [])):
+                if payment.get("status") == "PENDING" and payment.get("due_date"):
+                    candidates.append((loan, seq, payment))
+        yield candidates, after
+
+async def _claim_reminders(entries):
+    """
+    Record reminders in the ledger and return the ones not sent before.
+
+    The ledger's unique index rejects entries that already exist, so
+    deduplication is a single insert_many instead of a lookup per reminder.
+    """
+    if not entries:
+        return []
+
+    ledger_collection = get_collection("reminder_ledger")
+    try:
+        await ledger_collection.insert_many(entries, ordered=False)
+        return entries
+    except BulkWriteError as e:
+        errors = e.details.get("writeErrors", [])
+        if any(error.get("code") != DUPLICATE_KEY_ERROR for error in errors):
+            raise
+        duplicates = {error["index"] for error in errors}
+        return [entry for index, entry in enumerate(entries) if index not in duplicates]
+
+async def _send_reminders(candidates, now: datetime) -> int:
+    """Send the reminders for a chunk of candidate payments that haven't been sent yet"""
+    # Keep only payments whose due date lands in one of the reminder windows
+    reminders = []
+    for loan, seq, payment in candidates:
+        try:
+            due_date = _parse_due_date(payment["due_date"])
             days_until_due = (due_date - now).days
-            
-            # Check if this is a day before payment (days_until_due == 1) or
-            # a day after payment was due (days_until_due == -1)
-            if days_until_due == 1 or days_until_due == -1:
-                # Check if we've already sent a notification for this payment
-                existing_notification = await notifications_collection.find_one({
-                    "user_id": loan["borrower_id"],
-                    "related_id": str(loan["_id"]),
-                    "related_data.due_date": due_date.isoformat() if isinstance(due_date, datetime) else due_date,
-                    "timestamp": {"$gt": (now - timedelta(days=1)).isoformat()}  # Use ISO format consistently
-                })
-                
-                if not existing_notification:
-                    # Send reminder notification
-                    await send_payment_reminder(loan, payment, days_until_due)
-                    print(f"Sent payment reminder for loan {loan['_id']}, due in {days_until_due} days")
+        except Exception as e:
+            print(f"Skipping payment {seq} of loan {loan['_id']}: invalid due date ({e})")
+            continue
+        if days_until_due in REMINDER_DAYS and loan.get("borrower_id"):
+            reminders.append((loan, seq, payment, due_date, days_until_due))
+
+    entries = [
+        {
+            "loan_id": str(loan["_id"]),
+            "seq": seq,
+            "due_date": due_date,
+            "days_until_due": days_until_due,
+            "user_id": loan["borrower_id"],
+            "created_at": now
+        }
+        for loan, seq, payment, due_date, days_until_due in reminders
+    ]
+    claimed = await _claim_reminders(entries)
+    if not claimed:
+        return 0
+
+    claimed_keys = {(entry["loan_id"], entry["seq"], entry["days_until_due"]) for entry in claimed}
+    notifications = [
+        build_payment_reminder(
+            {"_id": str(loan["_id"]), "borrower_id": loan["borrower_id"], "lender_name": loan.get("lender_name")},
+            {"amount": payment.get("amount"), "due_date": due_date},
+            days_until_due
+        )
+        for loan, seq, payment, due_date, days_until_due in reminders
+        if (str(loan["_id"]), seq, days_until_due) in claimed_keys
+    ]
+
+    try:
+        await insert_notifications(notifications)
+    except Exception:
+        # Release the ledger entries so the next run retries these reminders
+        await get_collection("reminder_ledger").delete_many({"_id": {"$in": [entry["_id"] for entry in claimed]}})
+        raise
+
+    return len(notifications)
+
+async def check_payments(now: datetime = None, shard_index: int = 0, shard_count: int = 1):
+    """
+    Check for upcoming and overdue payments and send notifications
+
+    The scan walks installments in key order and checkpoints the last processed
+    key after every chunk. A run that stopped halfway is resumed from its
+    checkpoint (with the same reference time) by the next call, and the scan
+    can be split by loan hash across `shard_count` workers.
+    """
+    print(f"Running scheduled payment check (shard {shard_index + 1}/{shard_count})...")
+    checkpoints_collection = get_collection("job_checkpoints")
+    checkpoint_id = f"payment_reminders:{shard_index}/{shard_count}"
+
+    checkpoint = await checkpoints_collection.find_one({"_id": checkpoint_id})
+    resuming = (
+        now is None and checkpoint is not None and not checkpoint.get("completed")
+        and checkpoint["run_at"] > datetime.utcnow() - RESUME_WITHIN
+    )
+    if resuming:
+        now = checkpoint["run_at"]
+        phase, last_key = checkpoint.get("phase", 0), checkpoint.get("last_key")
+        sent = checkpoint.get("reminders_sent", 0)
+        print(f"Resuming payment check started at {now} from phase {phase}")
+    else:
+        now = now or datetime.utcnow()
+        phase, last_key, sent = 0, None, 0
+
+    async def save_checkpoint(**fields):
+        await checkpoints_collection.update_one(
+            {"_id": checkpoint_id},
+            {"$set": {"run_at": now, "updated_at": datetime.utcnow(), **fields}},
+            upsert=True
+        )
+
+    await save_checkpoint(phase=phase, last_key=last_key, reminders_sent=sent, completed=False)
+
+    windows = reminder_windows(now)
+    # One phase per reminder window over the installments collection, then the embedded schedules
+    phases = [
+        (lambda after, window=window: _installment_chunks(window, shard_index, shard_count, after))
+        for window in windows.values()
+    ]
+    phases.append(lambda after: _embedded_chunks(windows, shard_index, shard_count, after))
+
+    for index in range(phase, len(phases)):
+        after = last_key if index == phase else None
+        async for candidates, key in phases[index](after):
+            sent += await _send_reminders(candidates, now)
+            await save_checkpoint(phase=index, last_key=key, reminders_sent=sent)
+
+    await save_checkpoint(phase=len(phases), last_key=None, reminders_sent=sent, completed=True, finished_at=datetime.utcnow())
+    print(f"Sent {sent} payment reminders")
+    return sent
+
+# Each shard is a separate job with its own lease, so several scheduler
+# processes can scan different parts of the portfolio at the same time
+for _shard_index in range(settings.REMINDER_SHARDS):
+    register_job(
+        f"payment_reminders:{_shard_index}",
+        partial(check_payments, shard_index=_shard_index, shard_count=settings.REMINDER_SHARDS),
+        interval=3600,
+        jitter=60,
+        retry_after=REMINDER_RETRY_SECONDS
+    )
+
+# Statuses and fees are computed per day, so an extra run on the same day is harmless
+register_job("overdue_installments", process_overdue_installments, interval=24 * 3600, jitter=600, lease_seconds=1800)
+
+register_job("lender_summaries", reconcile_lender_summaries, interval=24 * 3600, jitter=600, lease_seconds=1800)
+
+register_job("notification_retention", apply_notification_retention, interval=24 * 3600, jitter=600, lease_seconds=1800)
+
+# Deletes are rate limited, so a run over a large backlog can take a while
+register_job("media_gc", collect_orphaned_media, interval=24 * 3600, jitter=3600, lease_seconds=3 * 3600)
 
 async def start_background_tasks():
     """
     Start background tasks for the application
+    
+    Every worker runs the scheduler loop and the outbox relay; job leases
+    make sure each job only runs in one of them at a time, and outbox events
+    are claimed by one relay at a time.
     """
-    while True:
-        try:
-            await check_payments()
-        except Exception as e:
-            print(f"Error in scheduled payment check: {e}")
-        
-        # Sleep for 1 hour before checking again
-        await asyncio.sleep(3600)
\ No newline at end of file
+    await asyncio.gather(run_scheduler(), run_outbox_relay())
@@ -0,0 +1,544 @@
+"""
+Object storage for uploaded files.
+
+Ad photos and KYC documents are stored through a Storage driver selected by
+STORAGE_BACKEND: Cloudinary, an S3-compatible bucket (AWS, MinIO, ...) or a
+directory on local disk. Objects are addressed by keys such as
+"advertisements/<uuid>.jpg" or "documents/<email>/document_0.pdf"; each driver
+turns a key into a public URL, a short-lived signed URL, and back.
+
+The SDKs are blocking, so their calls run on a small dedicated thread pool.
+"""
+import abc
+import asyncio
+import hashlib
+import hmac
+import os
+import shutil
+import tempfile
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import AsyncIterator, List, Optional, Tuple
+from urllib.parse import quote, unquote, urlparse
+
+import cloudinary.utils
+
+from ..core.config import settings
+from . import cloudinary_utils
+
+STORAGE_CONCURRENCY = 8
+STORAGE_TIMEOUT_SECONDS = 30
+
+# Bytes read per chunk when streaming an object
+STREAM_CHUNK_SIZE = 256 * 1024
+
+# Objects returned per page when listing storage
+LIST_PAGE_SIZE = 500
+
+# Lifetime of signed URLs handed out for private objects such as KYC documents
+SIGNED_URL_SECONDS = 15 * 60
+
+# Keys under these prefixes are served without a signature by the local driver
+PUBLIC_PREFIXES = ("advertisements/",)
+
+IMAGE_EXTENSIONS = {"jpg", "jpeg", "png", "gif", "webp", "bmp"}
+
+# Calls allowed to wait for a free storage thread, and for how long; past
+# either limit callers fail fast instead of piling up behind a slow backend
+STORAGE_MAX_QUEUED = 64
+STORAGE_QUEUE_TIMEOUT_SECONDS = 10
+
+class StorageBusyError(RuntimeError):
+    """Raised when a storage call can't get a thread in time"""
+
+_executor = ThreadPoolExecutor(max_workers=STORAGE_CONCURRENCY, thread_name_prefix="storage")
+
+# One slot per storage thread, held until the call running on it returns
+_threads = asyncio.Semaphore(STORAGE_CONCURRENCY)
+_queued = 0
+
+async def run_blocking(func, *args, timeout: float = STORAGE_TIMEOUT_SECONDS):
+    """
+    Run a blocking storage call on the storage thread pool.
+
+    A call is only submitted once a thread is free for it, so `timeout`
+    counts the time the call runs, not the time it waited for a thread. A
+    call that times out can't be interrupted: it keeps its thread until the
+    SDK gives up on its own timeout, and is logged when it finishes.
+    """
+    global _queued
+    if not _threads.locked():
+        await _threads.acquire()
+    elif _queued >= STORAGE_MAX_QUEUED:
+        raise StorageBusyError("Too many storage calls waiting")
+    else:
+        _queued += 1
+        try:
+            await asyncio.wait_for(_threads.acquire(), STORAGE_QUEUE_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            raise StorageBusyError("Timed out waiting for a storage thread")
+        finally:
+            _queued -= 1
+
+    name = getattr(func, "__qualname__", repr(func))
+    state = {"timed_out": False}
+
+    def done(future):
+        _threads.release()
+        error = None if future.cancelled() else future.exception()
+        if state["timed_out"]:
+            print(f"Storage call {name} finished {'with ' + repr(error) if error else 'successfully'} after its caller timed out")
+
+    future = asyncio.get_running_loop().run_in_executor(_executor, func, *args)
+    future.add_done_callback(done)
+    try:
+        # Shielded, so a timeout or cancellation doesn't release the thread's slot early
+        return await asyncio.wait_for(asyncio.shield(future), timeout)
+    except asyncio.TimeoutError:
+        state["timed_out"] = True
+        print(f"Storage call {name} timed out after {timeout}s")
+        raise
+
+async def spool_chunks(chunks: AsyncIterator[bytes]) -> str:
+    """Write chunks to a temporary file, one chunk in memory at a time, and return its path"""
+    fd, path = tempfile.mkstemp(prefix="storage-")
+    f = os.fdopen(fd, "wb")
+    try:
+        async for chunk in chunks:
+            await run_blocking(f.write, chunk)
+    except BaseException:
+        f.close()
+        os.remove(path)
+        raise
+    f.close()
+    return path
+
+def _extension(key: str) -> str:
+    return os.path.splitext(key)[1].lstrip(".").lower()
+
+class Storage(abc.ABC):
+    """Interface every storage driver implements"""
+    name = ""
+
+    @abc.abstractmethod
+    async def put(self, key: str, data: bytes, content_type: Optional[str] = None) -> str:
+        """Store an object and return its public URL"""
+
+    @abc.abstractmethod
+    async def put_file(self, key: str, path: str, content_type: Optional[str] = None) -> str:
+        """Store a local file without reading it into memory and return its public URL"""
+
+    async def put_stream(self, key: str, chunks: AsyncIterator[bytes], content_type: Optional[str] = None) -> str:
+        """
+        Store an object from an async iterator of chunks and return its public URL.
+
+        The chunks are spooled to a temporary file which is then handed to
+        put_file, so memory use is bounded by the chunk size. Nothing is
+        stored if the iterator raises.
+        """
+        path = await spool_chunks(chunks)
+        try:
+            return await self.put_file(key, path, content_type)
+        finally:
+            os.remove(path)
+
+    @abc.abstractmethod
+    async def get(self, key: str) -> bytes:
+        """An object's content"""
+
+    @abc.abstractmethod
+    async def delete(self, key: str):
+        """Delete an object; deleting a missing object is not an error"""
+
+    @abc.abstractmethod
+    def stream(self, key: str, chunk_size: int = STREAM_CHUNK_SIZE) -> AsyncIterator[bytes]:
+        """Yield an object's content in chunks"""
+
+    @abc.abstractmethod
+    def list(self, prefix: str) -> AsyncIterator[List[Tuple[str, int, datetime]]]:
+        """Yield pages of (key, size in bytes, last modified) for the objects under a prefix"""
+
+    @abc.abstractmethod
+    def url(self, key: str) -> str:
+        """Public URL of an object"""
+
+    @abc.abstractmethod
+    def signed_url(self, key: str, expires_in: int = SIGNED_URL_SECONDS) -> str:
+        """URL of an object that stops working after `expires_in` seconds"""
+
+    @abc.abstractmethod
+    def key_for_url(self, url: str) -> Optional[str]:
+        """Recover the key of an object from its URL, or None if the URL isn't one of ours"""
+
+def sign_local_key(key: str, expires: int) -> str:
+    message = f"{key}:{expires}".encode()
+    return hmac.new(settings.SECRET_KEY.encode(), message, hashlib.sha256).hexdigest()
+
+def verify_local_signature(key: str, expires: int, signature: str) -> bool:
+    return expires >= time.time() and hmac.compare_digest(sign_local_key(key, expires), signature)
+
+class LocalStorage(Storage):
+    """
+    Objects as files under a local directory, served by the /media route.
+
+    Used in development, tests and offline load tests as a stand-in for the
+    hosted backends.
+    """
+    name = "local"
+
+    def __init__(self, root: str, base_url: str):
+        self.root = os.path.abspath(root)
+        self.base_url = base_url.rstrip("/")
+
+    def path(self, key: str) -> str:
+        path = os.path.abspath(os.path.join(self.root, key))
+        if not path.startswith(self.root + os.sep):
+            raise ValueError(f"Invalid storage key: {key}")
+        return path
+
+    def _write(self, key: str, data: bytes):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+
+    def _read(self, key: str) -> bytes:
+        with open(self.path(key), "rb") as f:
+            return f.read()
+
+    def _remove(self, key: str):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    async def put(self, key: str, data: bytes, content_type: Optional[str] = None) -> str:
+        await run_blocking(self._write, key, data)
+        return self.url(key)
+
+    async def put_file(self, key: str, path: str, content_type: Optional[str] = None) -> str:
+        def copy():
+            target = self.path(key)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copyfile(path, target)
+        await run_blocking(copy)
+        return self.url(key)
+
+    async def put_stream(self, key: str, chunks: AsyncIterator[bytes], content_type: Optional[str] = None) -> str:
+        # Written next to the target and renamed into place, so readers never see a partial file
+        target = self.path(key)
+        await run_blocking(os.makedirs, os.path.dirname(target), 0o777, True)
+        fd, partial = tempfile.mkstemp(dir=os.path.dirname(target), prefix=".partial-")
+        f = os.fdopen(fd, "wb")
+        try:
+            async for chunk in chunks:
+                await run_blocking(f.write, chunk)
+            f.close()
+            os.replace(partial, target)
+        except BaseException:
+            f.close()
+            os.remove(partial)
+            raise
+        return self.url(key)
+
+    async def get(self, key: str) -> bytes:
+        return await run_blocking(self._read, key)
+
+    async def delete(self, key: str):
+        await run_blocking(self._remove, key)
+
+    async def stream(self, key: str, chunk_size: int = STREAM_CHUNK_SIZE) -> AsyncIterator[bytes]:
+        f = await run_blocking(open, self.path(key), "rb")
+        try:
+            while True:
+                chunk = await run_blocking(f.read, chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            f.close()
+
+    def _stat_files(self, directory: str, names: List[str]) -> List[Tuple[str, int, datetime]]:
+        objects = []
+        for name in names:
+            # Partial files of uploads in progress are not objects yet
+            if name.startswith(".partial-"):
+                continue
+            path = os.path.join(directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            key = os.path.relpath(path, self.root).replace(os.sep, "/")
+            objects.append((key, stat.st_size, datetime.utcfromtimestamp(stat.st_mtime)))
+        return objects
+
+    async def list(self, prefix: str) -> AsyncIterator[List[Tuple[str, int, datetime]]]:
+        # Walked one directory at a time, so a large tree is never listed in one go
+        walker = os.walk(os.path.join(self.root, prefix))
+        page = []
+        while True:
+            entry = await run_blocking(next, walker, None)
+            if entry is None:
+                break
+            directory, _, names = entry
+            page.extend(await run_blocking(self._stat_files, directory, names))
+            while len(page) >= LIST_PAGE_SIZE:
+                yield page[:LIST_PAGE_SIZE]
+                page = page[LIST_PAGE_SIZE:]
+        if page:
+            yield page
+
+    def url(self, key: str) -> str:
+        return f"{self.base_url}/media/{quote(key)}"
+
+    def signed_url(self, key: str, expires_in: int = SIGNED_URL_SECONDS) -> str:
+        expires = int(time.time()) + expires_in
+        return f"{self.url(key)}?expires={expires}&signature={sign_local_key(key, expires)}"
+
+    def key_for_url(self, url: str) -> Optional[str]:
+        prefix = f"{self.base_url}/media/"
+        if not url.startswith(prefix):
+            return None
+        return unquote(urlparse(url[len(prefix):]).path)
+
+class CloudinaryStorage(Storage):
+    """
+    Objects on Cloudinary. Images are stored as image resources (without the
+    extension in their public ID), everything else as raw resources.
+    """
+    name = "cloudinary"
+
+    @staticmethod
+    def _resource(key: str):
+        """Public ID, resource type and format of a key"""
+        extension = _extension(key)
+        if extension in IMAGE_EXTENSIONS:
+            return os.path.splitext(key)[0], "image", extension
+        return key, "raw", extension
+
+    async def put(self, key: str, data: bytes, content_type: Optional[str] = None) -> str:
+        public_id, resource_type, _ = self._resource(key)
+        result = await run_blocking(cloudinary_utils.upload_image, data, public_id, resource_type)
+        return result["url"]
+
+    async def put_file(self, key: str, path: str, content_type: Optional[str] = None) -> str:
+        public_id, resource_type, _ = self._resource(key)
+        result = await run_blocking(
+            cloudinary_utils.upload_large_file, path, public_id, resource_type,
+            timeout=cloudinary_utils.LARGE_UPLOAD_TIMEOUT_SECONDS
+        )
+        return result["url"]
+
+    async def get(self, key: str) -> bytes:
+        def fetch():
+            with urllib.request.urlopen(self.url(key), timeout=STORAGE_TIMEOUT_SECONDS) as response:
+                return response.read()
+        return await run_blocking(fetch)
+
+    async def delete(self, key: str):
+        public_id, resource_type, _ = self._resource(key)
+        await run_blocking(cloudinary_utils.delete_image, public_id, resource_type)
+
+    async def stream(self, key: str, chunk_size: int = STREAM_CHUNK_SIZE) -> AsyncIterator[bytes]:
+        response = await run_blocking(urllib.request.urlopen, self.url(key), None, STORAGE_TIMEOUT_SECONDS)
+        try:
+            while True:
+                chunk = await run_blocking(response.read, chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            response.close()
+
+    async def list(self, prefix: str) -> AsyncIterator[List[Tuple[str, int, datetime]]]:
+        for resource_type in ("image", "raw"):
+            next_cursor = None
+            while True:
+                page = await run_blocking(
+                    cloudinary_utils.list_resources, prefix, resource_type, LIST_PAGE_SIZE, next_cursor
+                )
+                objects = []
+                for resource in page.get("resources", []):
+                    key = resource["public_id"]
+                    if resource_type == "image":
+                        key = f"{key}.{resource['format']}"
+                    created_at = datetime.strptime(resource["created_at"], "%Y-%m-%dT%H:%M:%SZ")
+                    objects.append((key, resource.get("bytes", 0), created_at))
+                if objects:
+                    yield objects
+                next_cursor = page.get("next_cursor")
+                if not next_cursor:
+                    break
+
+    def url(self, key: str) -> str:
+        public_id, resource_type, extension = self._resource(key)
+        if resource_type == "image":
+            return cloudinary.utils.cloudinary_url(public_id, resource_type="image", format=extension, secure=True)[0]
+        return cloudinary.utils.cloudinary_url(public_id, resource_type="raw", secure=True)[0]
+
+    def signed_url(self, key: str, expires_in: int = SIGNED_URL_SECONDS) -> str:
+        public_id, resource_type, extension = self._resource(key)
+        return cloudinary.utils.private_download_url(
+            public_id, extension, resource_type=resource_type, expires_at=int(time.time()) + expires_in
+        )
+
+    def key_for_url(self, url: str) -> Optional[str]:
+        if "res.cloudinary.com" not in url:
+            return None
+        return cloudinary_utils.public_id_from_url(url, with_extension=True)
+
+class S3Storage(Storage):
+    """
+    Objects in an S3-compatible bucket. Setting S3_ENDPOINT_URL points the
+    driver at another implementation, e.g. a local MinIO for tests.
+    """
+    name = "s3"
+
+    def __init__(self):
+        try:
+            import boto3
+            from botocore.config import Config
+        except ImportError:
+            raise RuntimeError("The s3 storage backend requires boto3 to be installed")
+
+        self.bucket = settings.S3_BUCKET
+        self.client = boto3.client(
+            "s3",
+            endpoint_url=settings.S3_ENDPOINT_URL or None,
+            region_name=settings.S3_REGION or None,
+            aws_access_key_id=settings.S3_ACCESS_KEY or None,
+            aws_secret_access_key=settings.S3_SECRET_KEY or None,
+            # Requests time out in the SDK, so a call run_blocking gave up on frees its thread
+            config=Config(connect_timeout=STORAGE_TIMEOUT_SECONDS, read_timeout=STORAGE_TIMEOUT_SECONDS)
+        )
+        if settings.S3_PUBLIC_URL:
+            self.public_url = settings.S3_PUBLIC_URL.rstrip("/")
+        elif settings.S3_ENDPOINT_URL:
+            self.public_url = f"{settings.S3_ENDPOINT_URL.rstrip('/')}/{self.bucket}"
+        else:
+            self.public_url = f"https://{self.bucket}.s3.amazonaws.com"
+
+    async def put(self, key: str, data: bytes, content_type: Optional[str] = None) -> str:
+        extra = {"ContentType": content_type} if content_type else {}
+        await run_blocking(lambda: self.client.put_object(Bucket=self.bucket, Key=key, Body=data, **extra))
+        return self.url(key)
+
+    async def put_file(self, key: str, path: str, content_type: Optional[str] = None) -> str:
+        # upload_file switches to a multipart upload for large files, reading the file part by part
+        extra = {"ContentType": content_type} if content_type else None
+        await run_blocking(lambda: self.client.upload_file(path, self.bucket, key, ExtraArgs=extra))
+        return self.url(key)
+
+    async def get(self, key: str) -> bytes:
+        def fetch():
+            return self.client.get_object(Bucket=self.bucket, Key=key)["Body"].read()
+        return await run_blocking(fetch)
+
+    async def delete(self, key: str):
+        await run_blocking(lambda: self.client.delete_object(Bucket=self.bucket, Key=key))
+
+    async def stream(self, key: str, chunk_size: int = STREAM_CHUNK_SIZE) -> AsyncIterator[bytes]:
+        body = await run_blocking(lambda: self.client.get_object(Bucket=self.bucket, Key=key)["Body"])
+        try:
+            while True:
+                chunk = await run_blocking(body.read, chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            body.close()
+
+    async def list(self, prefix: str) -> AsyncIterator[List[Tuple[str, int, datetime]]]:
+        token = None
+        while True:
+            options = {"Bucket": self.bucket, "Prefix": prefix, "MaxKeys": LIST_PAGE_SIZE}
+            if token:
+                options["ContinuationToken"] = token
+            page = await run_blocking(lambda: self.client.list_objects_v2(**options))
+            objects = [
+                (item["Key"], item["Size"], item["LastModified"].replace(tzinfo=None))
+                for item in page.get("Contents", [])
+            ]
+            if objects:
+                yield objects
+            token = page.get("NextContinuationToken")
+            if not token:
+                break
+
+    def url(self, key: str) -> str:
+        return f"{self.public_url}/{quote(key)}"
+
+    def signed_url(self, key: str, expires_in: int = SIGNED_URL_SECONDS) -> str:
+        return self.client.generate_presigned_url(
+            "get_object", Params={"Bucket": self.bucket, "Key": key}, ExpiresIn=expires_in
+        )
+
+    def key_for_url(self, url: str) -> Optional[str]:
+        prefix = f"{self.public_url}/"
+        if not url.startswith(prefix):
+            return None
+        return unquote(urlparse(url[len(prefix):]).path)
+
+def normalize_key(key: str) -> str:
+    """
+    Check a key received from a client. Keys with empty, "." or ".." segments
+    could name an object outside the prefix they appear to be under, so they
+    are rejected with ValueError.
+    """
+    if any(segment in ("", ".", "..") or "\\" in segment for segment in key.split("/")):
+        raise ValueError(f"Invalid storage key: {key}")
+    return key
+
+def is_legacy_document(path: str) -> bool:
+    """Whether a registration document was saved before the storage drivers, as a path under uploads/"""
+    return path.startswith("uploads/")
+
+def document_key(path: str) -> str:
+    """
+    Storage key of a registration document. Documents saved before the storage
+    drivers were stored as paths under uploads/, which the legacy storage's
+    default root maps to the same key.
+    """
+    return path[len("uploads/"):] if is_legacy_document(path) else path
+
+def legacy_storage() -> LocalStorage:
+    """Local disk holding the documents saved before the storage drivers, whatever the configured backend"""
+    return LocalStorage(settings.STORAGE_LOCAL_DIR, settings.MEDIA_BASE_URL)
+
+def document_url(path: str, expires_in: int = SIGNED_URL_SECONDS) -> str:
+    """Short-lived download URL of a registration document, from the storage holding it"""
+    storage = legacy_storage() if is_legacy_document(path) else get_storage()
+    return storage.signed_url(document_key(path), expires_in)
+
+_storage = None
+
+def get_storage() -> Storage:
+    """The configured storage driver, created on first use"""
+    global _storage
+    if _storage is None:
+        if settings.STORAGE_BACKEND == "local":
+            _storage = LocalStorage(settings.STORAGE_LOCAL_DIR, settings.MEDIA_BASE_URL)
+        elif settings.STORAGE_BACKEND == "s3":
+            _storage = S3Storage()
+        else:
+            _storage = CloudinaryStorage()
+    return _storage
+
+async def delete_urls(urls):
+    """Delete stored objects by URL concurrently; unknown URLs and failures are logged and skipped"""
+    storage = get_storage()
+
+    async def delete(url):
+        key = storage.key_for_url(url)
+        if key is None:
+            print(f"Not deleting {url}: not stored in {storage.name} storage")
+            return
+        await storage.delete(key)
+
+    results = await asyncio.gather(*[delete(url) for url in urls], return_exceptions=True)
+    for url, result in zip(urls, results):
+        if isinstance(result, BaseException):
+            print(f"Error deleting {url}: {str(result) or type(result).__name__}")
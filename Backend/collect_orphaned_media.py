@@ -0,0 +1,37 @@
+import argparse
+import asyncio
+import json
+import sys
+import logging
+from app.utils.media_gc import collect_orphaned_media
+from app.core.database import connect_to_mongo, close_mongo_connection
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[logging.StreamHandler(sys.stdout)]
+)
+
+logger = logging.getLogger("orphaned-media-collection")
+
+async def main(delete: bool):
+    """
+    Report (and with --delete, remove) stored photos and documents nothing refers to
+    """
+    try:
+        logger.info("Connecting to database...")
+        await connect_to_mongo()
+
+        report = await collect_orphaned_media(dry_run=not delete)
+        print(json.dumps(report, indent=2))
+    finally:
+        logger.info("Closing database connection...")
+        await close_mongo_connection()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Collect orphaned photos and documents in storage")
+    parser.add_argument("--delete", action="store_true", help="Delete orphans instead of only reporting them")
+    args = parser.parse_args()
+
+    logger.info("Starting orphaned media collection...")
+    asyncio.run(main(args.delete))
@@ -0,0 +1,41 @@
+import argparse
+import asyncio
+import sys
+import logging
+from app.utils.installment_utils import backfill_shard_slots, migrate_embedded_installments
+from app.core.database import connect_to_mongo, close_mongo_connection
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[logging.StreamHandler(sys.stdout)]
+)
+
+logger = logging.getLogger("installments-migration")
+
+async def main(batch_size: int, keep_embedded: bool):
+    """
+    Move embedded loan payment schedules into the installments collection
+    """
+    try:
+        logger.info("Connecting to database...")
+        await connect_to_mongo()
+
+        migrated = await migrate_embedded_installments(batch_size=batch_size, keep_embedded=keep_embedded)
+        logger.info(f"Migration completed: {migrated} loans migrated.")
+
+        # Installments migrated before they carried a shard slot are invisible to the reminder scan
+        backfilled = await backfill_shard_slots(batch_size=batch_size)
+        logger.info(f"Shard slots set on {backfilled} installments.")
+    finally:
+        logger.info("Closing database connection...")
+        await close_mongo_connection()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Normalize embedded loan schedules into the installments collection")
+    parser.add_argument("--batch-size", type=int, default=500, help="Number of loans migrated per batch")
+    parser.add_argument("--keep-embedded", action="store_true", help="Keep the embedded payments array on migrated loans")
+    args = parser.parse_args()
+
+    logger.info("Starting installments migration...")
+    asyncio.run(main(args.batch_size, args.keep_embedded))
@@ -0,0 +1,36 @@
+import argparse
+import asyncio
+import sys
+import logging
+from app.utils.notification_utils import migrate_notification_timestamps
+from app.core.database import connect_to_mongo, close_mongo_connection
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[logging.StreamHandler(sys.stdout)]
+)
+
+logger = logging.getLogger("notification-timestamps-migration")
+
+async def main(batch_size: int):
+    """
+    Convert ISO string notification timestamps to native dates
+    """
+    try:
+        logger.info("Connecting to database...")
+        await connect_to_mongo()
+
+        converted = await migrate_notification_timestamps(batch_size=batch_size)
+        logger.info(f"Migration completed: {converted} notifications converted.")
+    finally:
+        logger.info("Closing database connection...")
+        await close_mongo_connection()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Store notification timestamps as native dates")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Number of notifications converted per batch")
+    args = parser.parse_args()
+
+    logger.info("Starting notification timestamps migration...")
+    asyncio.run(main(args.batch_size))
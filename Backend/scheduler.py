@@ -1,7 +1,7 @@
 import asyncio
 import sys
 import logging
-from app.utils.scheduled_tasks import check_payments
+from app.utils.scheduled_tasks import start_background_tasks
 from app.core.database import connect_to_mongo, close_mongo_connection
 
 logging.basicConfig(
@@ -14,25 +14,17 @@ logger = logging.getLogger("payment-reminder-scheduler")
 
 async def main():
     """
-    Main function to run the payment reminder scheduler
+    Main function to run the background job scheduler
     """
     try:
         # Connect to the database
         logger.info("Connecting to database...")
         await connect_to_mongo()
         
-        # Run forever
-        while True:
-            try:
-                logger.info("Running payment reminder check...")
-                await check_payments()
-                logger.info("Payment reminder check completed.")
-            except Exception as e:
-                logger.error(f"Error in payment reminder check: {e}")
-            
-            # Sleep for 1 hour before checking again
-            logger.info("Sleeping for 1 hour...")
-            await asyncio.sleep(3600)
+        # Run forever; the job leases let this process run alongside the API workers
+        # without jobs being executed twice
+        logger.info("Starting job scheduler...")
+        await start_background_tasks()
     except KeyboardInterrupt:
         logger.info("Scheduler stopped by user.")
     finally:
@@ -0,0 +1,180 @@
+"""
+Tests for the background photo pipeline and photo deduplication.
+
+Runs against an in-memory Mongo (mongomock_motor) and the local storage
+driver in a temporary directory, as with STORAGE_BACKEND=local.
+"""
+import asyncio
+import io
+import os
+from datetime import datetime
+
+import pytest
+from bson import ObjectId
+from fastapi import UploadFile
+
+from app.core.config import settings
+from app.core.database import Database, get_collection
+from app.utils import media_pipeline, storage
+from app.utils.media_pipeline import process_media_jobs, release_photos, spool_photos, store_photo, variant_urls
+
+mongomock_motor = pytest.importorskip("mongomock_motor")
+Image = pytest.importorskip("PIL.Image")
+
+def jpeg(color: str, size=(400, 300)) -> bytes:
+    output = io.BytesIO()
+    Image.new("RGB", size, color=color).save(output, format="JPEG")
+    return output.getvalue()
+
+def upload(content: bytes, filename: str = "photo.jpg") -> UploadFile:
+    return UploadFile(io.BytesIO(content), filename=filename)
+
+def stored_path(tmp_path, url: str) -> str:
+    return str(tmp_path / "storage" / storage.get_storage().key_for_url(url))
+
+def _unwrap_not(expression):
+    # mongomock evaluates {"$not": [expr]} as the negation of the list itself;
+    # MongoDB reads a single operand the same with or without the array
+    if isinstance(expression, dict):
+        return {
+            operator: _unwrap_not(operand[0] if operator == "$not" and isinstance(operand, list) else operand)
+            for operator, operand in expression.items()
+        }
+    if isinstance(expression, list):
+        return [_unwrap_not(item) for item in expression]
+    return expression
+
+@pytest.fixture(autouse=True)
+def media_env(tmp_path, monkeypatch):
+    client = mongomock_motor.AsyncMongoMockClient()
+    monkeypatch.setattr(Database, "client", client)
+    monkeypatch.setattr(Database, "db", client["test"])
+    monkeypatch.setattr(settings, "STORAGE_BACKEND", "local")
+    monkeypatch.setattr(settings, "STORAGE_LOCAL_DIR", str(tmp_path / "storage"))
+    monkeypatch.setattr(storage, "_storage", None)
+    monkeypatch.setattr(media_pipeline, "MEDIA_SPOOL_DIR", str(tmp_path / "spool"))
+
+    publish_update = media_pipeline._publish_update
+    monkeypatch.setattr(media_pipeline, "_publish_update", lambda now: _unwrap_not(publish_update(now)))
+
+async def insert_ad_with_photos(contents, **ad_fields) -> ObjectId:
+    """Insert an ad with spooled photos and their jobs, as the ad routes do"""
+    ad_id = ObjectId()
+    media, jobs = await spool_photos(ad_id, [upload(content) for content in contents], ad_fields.pop("first_slot", 0))
+    now = datetime.utcnow()
+    await get_collection("advertisements").insert_one({
+        "_id": ad_id, "photos": [], "photo_variants": [], "published": False,
+        "created_at": now, "updated_at": now, **ad_fields, "media": media
+    })
+    await get_collection("media_jobs").insert_many(jobs)
+    return ad_id
+
+async def run_jobs():
+    while await process_media_jobs():
+        pass
+
+def test_storing_the_same_photo_again_takes_a_reference_without_reading_it(tmp_path):
+    async def run():
+        first = await store_photo("digest", lambda: asyncio.sleep(0, jpeg("red")), "photo.jpg")
+
+        async def unread():
+            raise AssertionError("an already stored photo must not be read again")
+        second = await store_photo("digest", unread, "photo.jpg")
+
+        media = await get_collection("media").find_one({"_id": "digest"})
+        return first, second, media
+
+    first, second, media = asyncio.run(run())
+
+    assert first == second
+    assert first["hash"] == "digest"
+    assert media["refcount"] == 2
+    assert all(os.path.exists(stored_path(tmp_path, url)) for url in variant_urls(first))
+
+def test_photos_are_deleted_once_the_last_reference_is_released(tmp_path):
+    async def run():
+        variants = await store_photo("digest", lambda: asyncio.sleep(0, jpeg("red")), "photo.jpg")
+        await store_photo("digest", lambda: asyncio.sleep(0, jpeg("red")), "photo.jpg")
+        paths = [stored_path(tmp_path, url) for url in variant_urls(variants)]
+
+        await release_photos([variants])
+        after_first = await get_collection("media").find_one({"_id": "digest"}), all(map(os.path.exists, paths))
+        await release_photos([variants])
+        after_last = await get_collection("media").find_one({"_id": "digest"}), any(map(os.path.exists, paths))
+        return after_first, after_last
+
+    (media, kept), (gone, any_left) = asyncio.run(run())
+
+    assert media["refcount"] == 1 and kept
+    assert gone is None and not any_left
+
+def test_photos_stored_before_deduplication_are_deleted_right_away(tmp_path):
+    async def run():
+        url = await storage.get_storage().put("advertisements/legacy.jpg", jpeg("blue"))
+        await release_photos([{"full": url}])
+        return stored_path(tmp_path, url)
+
+    assert not os.path.exists(asyncio.run(run()))
+
+def test_processed_photos_publish_the_ad_in_upload_order(tmp_path):
+    async def run():
+        ad_id = await insert_ad_with_photos([jpeg("red"), jpeg("green"), jpeg("red")])
+        await run_jobs()
+        ad = await get_collection("advertisements").find_one({"_id": ad_id})
+        jobs = await get_collection("media_jobs").find().to_list(length=None)
+        media = await get_collection("media").find().to_list(length=None)
+        return ad, jobs, media
+
+    ad, jobs, media = asyncio.run(run())
+
+    assert ad["published"] is True
+    assert ad["media"] == []
+    assert [variants["full"] for variants in ad["photo_variants"]] == ad["photos"]
+    # The repeated photo is stored once and referenced twice
+    assert ad["photos"][0] == ad["photos"][2] != ad["photos"][1]
+    assert sorted(entry["refcount"] for entry in media) == [1, 2]
+    assert {job["status"] for job in jobs} == {"done"}
+    assert os.listdir(tmp_path / "spool") == []
+
+def test_photos_that_fail_are_left_out_of_the_published_ad():
+    async def run():
+        ad_id = await insert_ad_with_photos([b"not an image", jpeg("red")])
+        await run_jobs()
+        ad = await get_collection("advertisements").find_one({"_id": ad_id})
+        jobs = await get_collection("media_jobs").find().sort("slot", 1).to_list(length=None)
+        return ad, jobs
+
+    ad, jobs = asyncio.run(run())
+
+    assert ad["published"] is True
+    assert len(ad["photos"]) == 1
+    assert [job["status"] for job in jobs] == ["failed", "done"]
+
+def test_photos_added_to_a_published_ad_are_appended_after_its_photos():
+    async def run():
+        ad_id = await insert_ad_with_photos(
+            [jpeg("green")], published=True, photos=["http://testserver/media/advertisements/old.jpg"],
+            photo_variants=[{"full": "http://testserver/media/advertisements/old.jpg"}], first_slot=3
+        )
+        await run_jobs()
+        return await get_collection("advertisements").find_one({"_id": ad_id})
+
+    ad = asyncio.run(run())
+
+    assert ad["published"] is True
+    assert ad["media"] == []
+    assert len(ad["photos"]) == 2
+    assert ad["photos"][0] == "http://testserver/media/advertisements/old.jpg"
+
+def test_jobs_of_deleted_ads_are_cancelled(tmp_path):
+    async def run():
+        ad_id = await insert_ad_with_photos([jpeg("red")])
+        await get_collection("advertisements").delete_one({"_id": ad_id})
+        await run_jobs()
+        return await get_collection("media_jobs").find_one({}), await get_collection("media").count_documents({})
+
+    job, media_count = asyncio.run(run())
+
+    assert job["status"] == "cancelled"
+    assert media_count == 0
+    assert os.listdir(tmp_path / "spool") == []
@@ -0,0 +1,60 @@
+"""
+Tests for rendering the thumbnail, medium and full variants of ad photos.
+"""
+import io
+import sys
+
+import pytest
+
+from app.utils.media_pipeline import PHOTO_VARIANTS, _render_variants
+
+Image = pytest.importorskip("PIL.Image")
+
+def encode(width: int, height: int, image_format: str, mode: str = "RGB") -> bytes:
+    output = io.BytesIO()
+    Image.new(mode, (width, height), color=0).save(output, format=image_format)
+    return output.getvalue()
+
+def size_of(content: bytes):
+    return Image.open(io.BytesIO(content)).size
+
+def test_each_variant_fits_its_box_and_keeps_the_aspect_ratio():
+    variants = _render_variants(encode(4000, 3000, "JPEG"), ".jpg")
+
+    assert set(variants) == set(PHOTO_VARIANTS)
+    for name, box in PHOTO_VARIANTS.items():
+        content, extension = variants[name]
+        width, height = size_of(content)
+        assert extension == ".jpg"
+        assert max(width, height) == box
+        assert width / height == pytest.approx(4 / 3, rel=0.01)
+
+def test_small_photos_reuse_the_larger_variant_instead_of_upscaling():
+    variants = _render_variants(encode(300, 200, "JPEG"), ".jpg")
+
+    assert variants["thumbnail"] is variants["medium"] is variants["full"]
+    assert size_of(variants["full"][0]) == (300, 200)
+
+def test_supported_formats_are_kept():
+    variants = _render_variants(encode(600, 600, "PNG", mode="RGBA"), ".png")
+
+    assert {extension for _, extension in variants.values()} == {".png"}
+    assert Image.open(io.BytesIO(variants["thumbnail"][0])).format == "PNG"
+
+def test_other_formats_are_converted_to_jpeg():
+    variants = _render_variants(encode(600, 600, "GIF", mode="P"), ".gif")
+
+    assert {extension for _, extension in variants.values()} == {".jpg"}
+    thumbnail = Image.open(io.BytesIO(variants["thumbnail"][0]))
+    assert (thumbnail.format, thumbnail.mode) == ("JPEG", "RGB")
+
+def test_content_that_is_not_an_image_is_rejected():
+    with pytest.raises(ValueError):
+        _render_variants(b"%PDF-1.4 not a photo", ".jpg")
+
+def test_without_pillow_the_original_serves_as_every_variant(monkeypatch):
+    monkeypatch.setitem(sys.modules, "PIL", None)
+
+    variants = _render_variants(b"original", ".jpeg")
+
+    assert variants == {name: (b"original", ".jpeg") for name in PHOTO_VARIANTS}
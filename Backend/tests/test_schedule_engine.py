@@ -0,0 +1,161 @@
+"""
+Property tests for the schedule engine.
+
+Each test draws a few hundred random loans (seeded, so failures reproduce)
+and checks invariants that must hold for every one of them.
+"""
+import calendar
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+from app.utils.schedule_engine import FLAT, REDUCING_BALANCE, SCHEDULE_METHODS, build_schedules, generate_schedule
+
+N_LOANS = 500
+CENT = 0.005
+
+def random_portfolio(seed: int, n_loans: int = N_LOANS):
+    rng = np.random.default_rng(seed)
+    principal = rng.uniform(100, 5_000_000, n_loans).round(2)
+    interest_rate = rng.uniform(0, 36, n_loans).round(2)
+    # Some loans without interest, which take a separate path for EMI
+    interest_rate[rng.random(n_loans) < 0.1] = 0
+    term_months = rng.integers(1, 61, n_loans)
+    start_dates = (
+        np.datetime64("2023-01-01T00:00:00", "us")
+        + rng.integers(0, 3 * 365, n_loans).astype("timedelta64[D]")
+        + rng.integers(0, 24 * 3600, n_loans).astype("timedelta64[s]")
+    )
+    return principal, interest_rate, term_months, start_dates
+
+@pytest.fixture(params=SCHEDULE_METHODS)
+def schedules(request):
+    principal, interest_rate, term_months, start_dates = random_portfolio(seed=SCHEDULE_METHODS.index(request.param))
+    schedule = build_schedules(principal, interest_rate, term_months, start_dates, request.param)
+    return request.param, principal, interest_rate, term_months, start_dates, schedule
+
+def test_principal_sums_to_amount(schedules):
+    _, principal, _, _, _, schedule = schedules
+    np.testing.assert_allclose(schedule["principal"].sum(axis=1), principal, atol=CENT)
+
+def test_installments_split_into_principal_and_interest(schedules):
+    _, _, _, _, _, schedule = schedules
+    np.testing.assert_allclose(schedule["installments"], schedule["principal"] + schedule["interest"], atol=CENT)
+
+def test_amounts_are_whole_cents(schedules):
+    _, _, _, _, _, schedule = schedules
+    for name in ("installments", "principal", "interest"):
+        np.testing.assert_allclose(schedule[name] * 100, np.round(schedule[name] * 100), atol=1e-6)
+
+def test_padding_is_zero(schedules):
+    _, _, _, _, _, schedule = schedules
+    for name in ("installments", "principal", "interest", "balance"):
+        assert not schedule[name][~schedule["mask"]].any()
+
+def test_term_matches_mask(schedules):
+    _, _, _, term_months, _, schedule = schedules
+    np.testing.assert_array_equal(schedule["mask"].sum(axis=1), term_months)
+
+def test_balance_is_paid_off(schedules):
+    _, principal, _, term_months, _, schedule = schedules
+    last_balance = schedule["balance"][np.arange(len(term_months)), term_months - 1]
+    np.testing.assert_allclose(last_balance, 0, atol=CENT)
+    assert (schedule["balance"][schedule["mask"]] >= -CENT).all()
+    assert (schedule["balance"][schedule["mask"]] <= np.repeat(principal, term_months) + CENT).all()
+
+def test_totals_add_up(schedules):
+    _, principal, _, _, _, schedule = schedules
+    np.testing.assert_allclose(schedule["total_amount"], schedule["installments"].sum(axis=1), atol=CENT)
+    np.testing.assert_allclose(schedule["total_amount"], principal + schedule["total_interest"], atol=CENT)
+
+def test_flat_totals_match_to_the_cent():
+    principal, interest_rate, term_months, start_dates = random_portfolio(seed=10)
+    schedule = build_schedules(principal, interest_rate, term_months, start_dates, FLAT)
+
+    expected_total = np.round(principal + principal * interest_rate / 100, 2)
+    np.testing.assert_allclose(schedule["total_amount"], expected_total, atol=CENT)
+
+    # Every installment but the last is the even share, rounded to cents
+    even_share = np.round(expected_total / term_months, 2)
+    for row, term in enumerate(term_months):
+        np.testing.assert_allclose(schedule["installments"][row, :term - 1], even_share[row], atol=CENT + 1e-9)
+
+def test_emi_totals_match_to_the_cent():
+    principal, interest_rate, term_months, start_dates = random_portfolio(seed=11)
+    schedule = build_schedules(principal, interest_rate, term_months, start_dates, REDUCING_BALANCE)
+
+    r = interest_rate / 1200
+    with np.errstate(divide="ignore", invalid="ignore"):
+        emi = np.where(r > 0, principal * r * (1 + r) ** term_months / ((1 + r) ** term_months - 1), principal / term_months)
+    emi = np.round(emi, 2)
+
+    for row, term in enumerate(term_months):
+        installments = schedule["installments"][row, :term]
+        np.testing.assert_allclose(installments[:-1], emi[row], atol=CENT + 1e-9)
+        # The last installment only absorbs the rounding residue
+        assert abs(installments[-1] - emi[row]) <= 0.01 * term + CENT
+
+    np.testing.assert_allclose(
+        schedule["total_amount"],
+        np.round(emi * (term_months - 1), 2) + schedule["installments"][np.arange(len(term_months)), term_months - 1],
+        atol=CENT
+    )
+
+def test_emi_interest_is_charged_on_the_outstanding_balance():
+    principal, interest_rate, term_months, start_dates = random_portfolio(seed=12)
+    schedule = build_schedules(principal, interest_rate, term_months, start_dates, REDUCING_BALANCE)
+
+    opening_balance = np.concatenate([principal[:, None], schedule["balance"][:, :-1]], axis=1)
+    expected_interest = opening_balance * interest_rate[:, None] / 1200
+    # Interest is rounded on running totals, so each month may be off by a cent
+    np.testing.assert_allclose(
+        np.where(schedule["mask"], schedule["interest"], 0),
+        np.where(schedule["mask"], expected_interest, 0),
+        atol=0.01 + CENT
+    )
+
+def test_due_dates_are_monthly_and_clamped_to_month_end(schedules):
+    _, _, _, term_months, start_dates, schedule = schedules
+    due_dates = schedule["due_dates"].astype(object)
+
+    for row, term in enumerate(term_months):
+        start = start_dates[row].astype(object)
+        dates = list(due_dates[row, :term])
+        assert all(earlier < later for earlier, later in zip([start] + dates, dates))
+
+        for k, due in enumerate(dates, start=1):
+            month_index = start.month - 1 + k
+            year, month = start.year + month_index // 12, month_index % 12 + 1
+            assert (due.year, due.month) == (year, month)
+            assert due.day == min(start.day, calendar.monthrange(year, month)[1])
+            assert due.time() == start.time()
+
+def test_month_end_start_dates():
+    schedule = generate_schedule(1200, 12, 4, datetime(2024, 1, 31, 9, 30), FLAT)
+    assert [payment["due_date"] for payment in schedule["payments"]] == [
+        datetime(2024, 2, 29, 9, 30),
+        datetime(2024, 3, 31, 9, 30),
+        datetime(2024, 4, 30, 9, 30),
+        datetime(2024, 5, 31, 9, 30)
+    ]
+    assert schedule["end_date"] == datetime(2024, 5, 31, 9, 30)
+
+@pytest.mark.parametrize("method", SCHEDULE_METHODS)
+def test_single_loan_matches_batch(method):
+    principal, interest_rate, term_months, start_dates = random_portfolio(seed=13, n_loans=50)
+    batch = build_schedules(principal, interest_rate, term_months, start_dates, method)
+
+    for row in range(len(principal)):
+        single = generate_schedule(
+            float(principal[row]), float(interest_rate[row]), int(term_months[row]),
+            start_dates[row].astype(object), method
+        )
+        term = int(term_months[row])
+        assert [payment["amount"] for payment in single["payments"]] == batch["installments"][row, :term].tolist()
+        assert single["total_amount"] == batch["total_amount"][row]
+        assert single["installment_amount"] == batch["installments"][row, 0]
+
+def test_unknown_method_is_rejected():
+    with pytest.raises(ValueError):
+        build_schedules([1000], [10], [12], [datetime(2024, 1, 1)], "balloon")
@@ -0,0 +1,102 @@
+"""
+Tests for the local storage driver, the stand-in for the hosted backends.
+
+Objects are written under a temporary directory, the way STORAGE_BACKEND=local
+stores them.
+"""
+import asyncio
+
+import pytest
+
+from app.utils.storage import LocalStorage, Storage, normalize_key
+
+BASE_URL = "http://testserver"
+
+async def collect(iterator) -> list:
+    return [item async for item in iterator]
+
+async def chunks(*parts: bytes):
+    for part in parts:
+        yield part
+
+@pytest.fixture
+def storage(tmp_path):
+    return LocalStorage(str(tmp_path), BASE_URL)
+
+def test_storage_interface_is_abstract():
+    with pytest.raises(TypeError):
+        Storage()
+
+def test_put_returns_a_url_that_maps_back_to_the_key(storage):
+    url = asyncio.run(storage.put("advertisements/photo one.jpg", b"jpeg"))
+
+    assert url == f"{BASE_URL}/media/advertisements/photo%20one.jpg"
+    assert storage.key_for_url(url) == "advertisements/photo one.jpg"
+    assert asyncio.run(storage.get("advertisements/photo one.jpg")) == b"jpeg"
+
+def test_key_for_url_ignores_other_hosts(storage):
+    assert storage.key_for_url("https://res.cloudinary.com/demo/image/upload/photo.jpg") is None
+
+def test_put_stream_writes_every_chunk_and_leaves_no_partial_file(storage, tmp_path):
+    asyncio.run(storage.put_stream("documents/a@example.com/document_0.pdf", chunks(b"part1-", b"part2-", b"part3")))
+
+    directory = tmp_path / "documents" / "a@example.com"
+    assert [path.name for path in directory.iterdir()] == ["document_0.pdf"]
+    assert asyncio.run(storage.get("documents/a@example.com/document_0.pdf")) == b"part1-part2-part3"
+
+def test_put_stream_stores_nothing_when_the_upload_fails(storage, tmp_path):
+    async def failing():
+        yield b"part1"
+        raise IOError("client went away")
+
+    with pytest.raises(IOError):
+        asyncio.run(storage.put_stream("documents/b@example.com/document_0.pdf", failing()))
+
+    assert list((tmp_path / "documents" / "b@example.com").iterdir()) == []
+
+def test_stream_yields_the_content_in_chunks(storage):
+    asyncio.run(storage.put("advertisements/large.jpg", b"x" * 10))
+
+    parts = asyncio.run(collect(storage.stream("advertisements/large.jpg", chunk_size=4)))
+
+    assert [len(part) for part in parts] == [4, 4, 2]
+
+def test_list_pages_objects_under_a_prefix(storage, monkeypatch):
+    monkeypatch.setattr("app.utils.storage.LIST_PAGE_SIZE", 2)
+    for name in ["a.jpg", "b.jpg", "c.jpg"]:
+        asyncio.run(storage.put(f"advertisements/{name}", b"photo"))
+    asyncio.run(storage.put("documents/a@example.com/document_0.pdf", b"pdf"))
+
+    pages = asyncio.run(collect(storage.list("advertisements/")))
+
+    assert [len(page) for page in pages] == [2, 1]
+    keys = sorted(key for page in pages for key, _, _ in page)
+    assert keys == ["advertisements/a.jpg", "advertisements/b.jpg", "advertisements/c.jpg"]
+    assert all(size == len(b"photo") for page in pages for _, size, _ in page)
+
+def test_delete_removes_the_object_and_tolerates_missing_ones(storage):
+    asyncio.run(storage.put("advertisements/gone.jpg", b"photo"))
+
+    asyncio.run(storage.delete("advertisements/gone.jpg"))
+    asyncio.run(storage.delete("advertisements/gone.jpg"))
+
+    assert asyncio.run(collect(storage.list("advertisements/"))) == []
+
+def test_paths_outside_the_root_are_rejected(storage):
+    with pytest.raises(ValueError):
+        storage.path("../outside.jpg")
+
+@pytest.mark.parametrize("key", [
+    "../etc/passwd",
+    "advertisements/../documents/a@example.com/document_0.pdf",
+    "advertisements//photo.jpg",
+    "./advertisements/photo.jpg",
+    "advertisements/..\\photo.jpg",
+    "/advertisements/photo.jpg",
+])
+def test_normalize_key_rejects_traversal(key):
+    with pytest.raises(ValueError):
+        normalize_key(key)
+
+def test_normalize_key_accepts_plain_keys():
+    assert normalize_key("documents/a@example.com/document_0.pdf") == "documents/a@example.com/document_0.pdf"
@@ -7,21 +7,77 @@ interface NotificationContextType {
   refreshUnreadCount: () => Promise<void>;
 }
 
+// Delay before reopening a dropped notification stream
+const STREAM_RETRY_MS = 5000;
+
+// Unread count polling, only while the stream is down
+const FALLBACK_POLL_MS = 180000;
+
 const NotificationContext = createContext<NotificationContextType | undefined>(undefined);
 
 export const NotificationProvider: React.FC<{ children: React.ReactNode }> = ({ children }) => {
   const [unreadCount, setUnreadCount] = useState(0);
   const { isAuthenticated } = useAuth();
   
-  // Fetch unread count when authenticated
+  // Fetch unread count when authenticated, then count new notifications as
+  // they are pushed by the server; polling only runs while the stream is down
   useEffect(() => {
-    if (isAuthenticated) {
-      refreshUnreadCount();
+    if (!isAuthenticated) return;
+    
+    let source: EventSource | null = null;
+    let retry: ReturnType<typeof setTimeout> | null = null;
+    let poll: ReturnType<typeof setInterval> | null = null;
+    let closed = false;
+    
+    const startPolling = () => {
+      if (!poll) poll = setInterval(refreshUnreadCount, FALLBACK_POLL_MS);
+    };
+    
+    const stopPolling = () => {
+      if (poll) clearInterval(poll);
+      poll = null;
+    };
+    
+    const connect = async () => {
+      try {
+        source = await notificationService.openStream();
+      } catch (error) {
+        console.error('Failed to open notification stream:', error);
+        if (!closed) {
+          startPolling();
+          retry = setTimeout(connect, STREAM_RETRY_MS);
+        }
+        return;
+      }
+      if (closed) {
+        source.close();
+        return;
+      }
       
-      // Set up polling interval (every 3 minutes to reduce server load)
-      const interval = setInterval(refreshUnreadCount, 180000);
-      return () => clearInterval(interval);
-    }
+      source.onopen = stopPolling;
+      source.addEventListener('notification', () => setUnreadCount((count) => count + 1));
+      source.onerror = () => {
+        // The stream token is only valid briefly, so reconnect with a new one
+        // instead of letting EventSource retry with the old URL
+        source?.close();
+        if (!closed) {
+          startPolling();
+          retry = setTimeout(() => {
+            refreshUnreadCount();
+            connect();
+          }, STREAM_RETRY_MS);
+        }
+      };
+    };
+    
+    refreshUnreadCount();
+    connect();
+    return () => {
+      closed = true;
+      source?.close();
+      stopPolling();
+      if (retry) clearTimeout(retry);
+    };
   }, [isAuthenticated]);
   
   const refreshUnreadCount = async () => {
@@ -859,6 +859,14 @@ export const notificationService = {
     }
   },
   
+  // Opens the Server-Sent Events stream of new notifications. EventSource can't
+  // send the Authorization header, so a short-lived stream token goes in the URL.
+  openStream: async (): Promise<EventSource> => {
+    const response = await api.post('/notifications/stream-token');
+    const token = encodeURIComponent(response.data.token);
+    return new EventSource(`${API_BASE_URL}/notifications/stream?token=${token}`);
+  },
+
   checkPaymentReminders: async () => {
     try {
       const response = await api.post('/notifications/check-reminders');